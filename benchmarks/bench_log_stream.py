@@ -0,0 +1,120 @@
+"""
+Throughput of the output of a chatty step, from the process to the UI
+
+Compares reading line by line with one UI update per line (how
+DialsCommand used to work) against proc_engine, reading big chunks and
+handing batches of lines to the UI at most MAX_UI_RATE times per second.
+
+The "GUI" is a thread draining a queue of updates, each costing a fixed
+overhead plus some time per line, like a queued Qt signal and a
+QTextEdit.append would. Its responsiveness is the worst delay seen by a
+timer that should fire every 10 ms in that same thread.
+
+    PYTHONPATH=src python benchmarks/bench_log_stream.py [n_lines]
+"""
+from __future__ import absolute_import, division, print_function
+
+import subprocess
+import sys
+import threading
+import time
+
+from six.moves import queue
+
+from dui.proc_engine import LineBatcher, run_process
+
+# cost of delivering one update to the GUI thread and of showing one line
+PER_UPDATE_S = 50e-6
+PER_LINE_S = 2e-6
+TIMER_S = 0.01
+
+
+class FakeGui(object):
+    def __init__(self):
+        self.updates = queue.Queue()
+        self.n_updates = 0
+        self.n_lines = 0
+        self.worst_delay = 0.0
+        self._stop = False
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.start()
+
+    def post(self, str_lines):
+        self.updates.put(str_lines)
+
+    def _busy(self, seconds):
+        end = time.time() + seconds
+        while time.time() < end:
+            pass
+
+    def _loop(self):
+        next_tick = time.time() + TIMER_S
+        while not (self._stop and self.updates.empty()):
+            now = time.time()
+            if now >= next_tick:
+                self.worst_delay = max(self.worst_delay, now - next_tick)
+                next_tick = now + TIMER_S
+
+            try:
+                str_lines = self.updates.get(timeout=max(0, next_tick - now))
+
+            except queue.Empty:
+                continue
+
+            n_lines = str_lines.count("\n") + 1
+            self._busy(PER_UPDATE_S + PER_LINE_S * n_lines)
+            self.n_updates += 1
+            self.n_lines += n_lines
+
+    def close(self):
+        self._stop = True
+        self._thread.join()
+
+
+def chatty_cmd(n_lines):
+    return [
+        sys.executable,
+        "-c",
+        "for i in range({}): print('integrating reflection', i)".format(n_lines),
+    ]
+
+
+def per_line(n_lines, gui):
+    my_process = subprocess.Popen(
+        chatty_cmd(n_lines), stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    for line in iter(my_process.stdout.readline, b""):
+        gui.post(line.rstrip(b"\r\n").decode("utf-8", "replace"))
+
+    my_process.wait()
+    my_process.stdout.close()
+
+
+def batched(n_lines, gui):
+    run_process(chatty_cmd(n_lines), batcher=LineBatcher(on_lines=gui.post))
+
+
+def main():
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    row_fmt = "{:>10} {:>12} {:>10} {:>10} {:>14}"
+    print(row_fmt.format("engine", "lines/s", "updates", "shown", "worst lag ms"))
+    for name, run_fun in (("per line", per_line), ("batched", batched)):
+        gui = FakeGui()
+        start = time.time()
+        run_fun(n_lines, gui)
+        gui.close()
+        # until the GUI has shown everything it was given
+        elapsed = time.time() - start
+        print(
+            row_fmt.format(
+                name,
+                int(n_lines / elapsed),
+                gui.n_updates,
+                gui.n_lines,
+                round(gui.worst_delay * 1000, 1),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
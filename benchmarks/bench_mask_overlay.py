@@ -0,0 +1,112 @@
+"""
+Building the red overlay of the mask in the image viewer
+
+Compares the double Python loop ImgPainter.update_my_mask used to run
+over every pixel against mask_overlay.overlay_bgra, and a second update
+of the same mask file, served by MaskOverlayCache. Qt is left out, the
+QImage/QPixmap conversion costs the same either way.
+
+run with:  PYTHONPATH=src python benchmarks/bench_mask_overlay.py [side]
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import sys
+from timeit import default_timer as timer
+
+import numpy as np
+
+from dui.outputs_n_viewers.mask_overlay import (
+    MaskOverlayCache,
+    overlay_bgra,
+    stacked_mask,
+)
+
+
+def loop_overlay(np_mask):
+    # what update_my_mask did before
+    width = np_mask.shape[0]
+    height = np_mask.shape[1]
+
+    img_array = np.zeros([width, height, 4], dtype=np.uint8)
+
+    for row_pow, ent_row in enumerate(np_mask):
+        for col_pos, elem in enumerate(ent_row):
+            if not elem:
+                img_array[row_pow, col_pos, 2] = 255  # Red
+                img_array[row_pow, col_pos, 3] = 175  # Transp
+
+    return img_array
+
+
+def synthetic_mask(side):
+    # beam stop, its arm and the gaps between modules of a pixel array
+    np_mask = np.ones((side, side), dtype=bool)
+    yy, xx = np.mgrid[0:side, 0:side]
+    np_mask[(yy - side // 2) ** 2 + (xx - side // 2) ** 2 < (side // 20) ** 2] = False
+    np_mask[side // 2 - side // 100 : side // 2 + side // 100, : side // 2] = False
+    np_mask[:, 487::494] = False
+    np_mask[195::212, :] = False
+    return np_mask
+
+
+def time_it(label, fun, n_times=1):
+    t_start = timer()
+    for _ in range(n_times):
+        result = fun()
+
+    t_span = (timer() - t_start) / n_times
+    print("  {:<34} {:10.2f} ms".format(label, t_span * 1.0e3))
+    return result, t_span
+
+
+def bench_mask(side):
+    print("\n{0} x {0} mask".format(side))
+    np_mask = synthetic_mask(side)
+
+    loop_arr, loop_s = time_it("Python loop over pixels", lambda: loop_overlay(np_mask))
+    np_arr, np_s = time_it(
+        "NumPy overlay", lambda: overlay_bgra(stacked_mask([np_mask])), 5
+    )
+    assert np.array_equal(loop_arr, np_arr)
+
+    overlays = MaskOverlayCache()
+    key = ("/data/mask.pickle", 1234567890.0)
+    overlays.get(key, lambda: overlay_bgra(np_mask))
+    time_it(
+        "same mask file, cached",
+        lambda: overlays.get(key, lambda: overlay_bgra(np_mask)),
+        1000,
+    )
+    assert overlays.n_built == 1
+    print("  NumPy is {:.0f} times faster than the loop".format(loop_s / np_s))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        lst_side = [int(sys.argv[1])]
+
+    else:
+        # up to a 4k x 4k detector
+        lst_side = [1024, 2048, 4096]
+
+    for side in lst_side:
+        bench_mask(side)
@@ -0,0 +1,136 @@
+"""
+Benchmark of the navigation tree lookups on big synthetic trees
+
+run with:  dials.python benchmarks/bench_runner_tree.py [n_nodes]
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import random
+import sys
+from timeit import default_timer as timer
+
+from dui.m_idials import Runner
+
+STEPS = ["find_spots", "index", "refine", "integrate", "symmetry", "scale"]
+
+
+def build_tree(n_nodes, branching):
+    """
+    Builds a tree with << n_nodes >> finished steps, with probability
+    << branching >> each new step forks from a random previous node
+    instead of following the last one
+    """
+    runner = Runner()
+    runner.current_node.ll_command_lst = [["import"]]
+    runner.current_node.success = True
+    runner.current_node.json_file_out = "1_experiments.expt"
+    rnd = random.Random(42)
+    for num in range(n_nodes):
+        if rnd.random() < branching:
+            runner.goto(rnd.randint(1, runner.bigger_lin))
+
+        runner.create_step(runner.current_node)
+        node = runner.current_node
+        node.ll_command_lst = [[STEPS[num % len(STEPS)]]]
+        node.success = True
+        node.json_file_out = str(node.lin_num) + "_experiments.expt"
+
+    return runner
+
+
+def naive_goto(runner, new_lin):
+    for node in runner.step_list:
+        if node.lin_num == new_lin:
+            return node
+
+
+def naive_path(node):
+    lst_path = []
+    while node is not None:
+        lst_path.append(node)
+        node = node.prev_step
+
+    return lst_path[::-1]
+
+
+def naive_find(node, command):
+    node = node.prev_step
+    while node is not None:
+        if node.ll_command_lst[0][0] == command:
+            return node
+
+        node = node.prev_step
+
+
+def time_clicks(label, fun, lst_lin):
+    t_start = timer()
+    for lin_num in lst_lin:
+        fun(lin_num)
+
+    t_span = timer() - t_start
+    print(
+        "  {:<34} {:10.2f} us/click".format(label, t_span / len(lst_lin) * 1.0e6)
+    )
+
+
+def bench_tree(n_nodes, branching):
+    print("\n{} nodes, branching = {}".format(n_nodes, branching))
+    runner = build_tree(n_nodes, branching)
+    depth = max(len(naive_path(node)) for node in runner.step_list[-100:])
+    print("  (deepest leaf checked: {} levels)".format(depth))
+
+    rnd = random.Random(7)
+    # GUI sessions keep revisiting a handful of nodes
+    hot_nodes = [rnd.randint(1, runner.bigger_lin) for _ in range(50)]
+    lst_lin = [rnd.choice(hot_nodes) for _ in range(2000)]
+
+    def naive_click(lin_num):
+        node = naive_goto(runner, lin_num)
+        naive_path(node)
+        naive_find(node, "find_spots")
+
+    def indexed_click(lin_num):
+        runner.goto(lin_num)
+        runner.get_ancestor_path()
+        runner.find_ancestor(runner.current_node, "find_spots")
+        runner.get_datablock_path()
+
+    time_clicks("linear scan + parent walk", naive_click, lst_lin)
+    time_clicks("node index + memoized lookups", indexed_click, lst_lin)
+
+    for lin_num in hot_nodes:
+        node = runner.get_node(lin_num)
+        assert runner.get_ancestor_path(node) == naive_path(node)
+        assert runner.find_ancestor(node, "find_spots") is naive_find(
+            node, "find_spots"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        n_nodes = int(sys.argv[1])
+
+    else:
+        n_nodes = 10000
+
+    for branching in (0.01, 0.2, 0.8):
+        bench_tree(n_nodes, branching)
@@ -55,7 +55,15 @@ setup(
         )
     ],
     include_package_data=True,
-    entry_points={"console_scripts": ["dui=dui.main_dui:main"]},
+    entry_points={
+        "console_scripts": [
+            "dui=dui.main_dui:main",
+            "dui-batch=dui.batch_dui:main",
+            "dui-dedupe=dui.dedupe:main",
+            "dui-telemetry=dui.telemetry:main",
+            "dui-worker=dui.executors:worker_main",
+        ]
+    },
 )
 
 # TODO(nick): Work out how to get requirements working, including non-pip like PyQT
@@ -0,0 +1,331 @@
+"""
+DUI's headless batch pipeline, runs the same recipe of DIALS steps on many
+datasets without Qt, each one in its own session the GUI can open later
+with << dui directory=... >>
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import argparse
+import logging
+import multiprocessing
+import os
+import re
+import sys
+
+try:
+    from cli_utils import sys_arg
+    from cpu_budget import detect_cores
+    from m_idials import CommandNode, Runner
+    from session_journal import SessionJournal
+    from step_cache import cache_for_session
+    from telemetry import export_session
+
+except ImportError:
+    from .cli_utils import sys_arg
+    from .cpu_budget import detect_cores
+    from .m_idials import CommandNode, Runner
+    from .session_journal import SessionJournal
+    from .step_cache import cache_for_session
+    from .telemetry import export_session
+
+logger = logging.getLogger(__name__)
+
+
+def parse_recipe(lst_lin):
+    """
+    Reads a recipe, one step per line written as in the << m_idials >>
+    prompt: the DIALS command without "dials." followed by its phil
+    parameters, e.g. "find_spots spotfinder.mp.nproc=4". Empty lines and
+    lines starting with "#" are skipped. The image template of each dataset
+    is added to the "import" step.
+
+    Returns:
+        (List[List[str]]): one command list per step
+    """
+    lst_step = []
+    for lin in lst_lin:
+        lin = lin.strip()
+        if lin and not lin.startswith("#"):
+            lst_step.append(lin.split())
+
+    if not lst_step:
+        raise ValueError("empty recipe")
+
+    for step in lst_step:
+        if step[0] not in CommandNode.dials_com_lst:
+            raise ValueError("unknown step in recipe: " + step[0])
+
+    return lst_step
+
+
+def read_recipe(path):
+    with open(path) as rcp_in:
+        return parse_recipe(rcp_in.readlines())
+
+
+def dataset_dir_name(template, num):
+    """Directory of a dataset inside the batch output directory"""
+    base_name = os.path.basename(template.rstrip(os.sep)) or "dataset"
+    base_name = re.sub("[#*?]+", "", base_name)
+    base_name = re.sub("[^A-Za-z0-9._-]+", "_", base_name).strip("._")
+    return "{:04d}_{}".format(num, base_name or "dataset")
+
+
+def import_arg(template):
+    """
+    dials.import argument for << template >>, a ####-style template is
+    given as input.template, single files (like a master.h5) as they are
+    """
+    if "#" in template:
+        return "input.template=" + template
+
+    return template
+
+
+class _QuietReporter(object):
+    """
+    << ref_to_class >> for the steps of a batch, their output is already
+    in the log file of each step, no need to mix it in the terminal
+    """
+
+    def emit_print_signal(self, str_lin):
+        pass
+
+    def emit_fail_signal(self):
+        pass
+
+
+def batch_jobs(lst_template, lst_step, out_dir, n_workers=1, overrides=None):
+    """
+    One job for << run_dataset >> per template. Every job carries the
+    << sys_arg >> values it runs with, << overrides >> and, with several
+    workers, their share of the cores as << cpu_budget >>: workers started
+    by spawn (macOS, Windows) inherit nothing, and each worker has its own
+    CPU budget.
+    """
+    arg_dict = dict(overrides or {})
+    n_pool = min(n_workers, len(lst_template))
+    if n_pool > 1:
+        n_cores = arg_dict.get("cpu_budget") or sys_arg.cpu_budget or detect_cores()
+        arg_dict["cpu_budget"] = max(1, n_cores // n_pool)
+
+    lst_job = []
+    for num, template in enumerate(lst_template, 1):
+        directory = os.path.join(
+            os.path.abspath(out_dir), dataset_dir_name(template, num)
+        )
+        lst_job.append((template, directory, lst_step, arg_dict))
+
+    return lst_job
+
+
+def run_dataset(job):
+    """
+    Runs every step of a recipe on one dataset, stops at the first failed
+    step. Meant to be called in a worker process, as << sys_arg >> is global.
+
+    Args:
+        job (Tuple[str, str, List[List[str]], dict]): template, directory,
+            steps and the << sys_arg >> values to set
+
+    Returns:
+        (dict): template, directory, number of steps done and failed step
+    """
+    template, directory, lst_step, arg_dict = job
+    summary = {
+        "template": template,
+        "directory": directory,
+        "n_done": 0,
+        "failed_step": None,
+    }
+    for arg_name, value in arg_dict.items():
+        setattr(sys_arg, arg_name, value)
+
+    sys_arg.directory = directory
+    sys_arg.template = template
+    dui_files_path = os.path.join(directory, "dui_files")
+    if not os.path.isdir(dui_files_path):
+        os.makedirs(dui_files_path)
+
+    idials_runner = Runner()
+    idials_runner.step_cache = cache_for_session(dui_files_path)
+    session_journal = SessionJournal(dui_files_path)
+    session_journal.attach(idials_runner, fresh=True)
+    reporter = _QuietReporter()
+    try:
+        for step in lst_step:
+            cmd_lst = list(step)
+            if cmd_lst[0] == "import":
+                cmd_lst.insert(1, import_arg(template))
+
+            idials_runner.run([cmd_lst], reporter)
+            if idials_runner.current_node.success is not True:
+                summary["failed_step"] = cmd_lst[0]
+                break
+
+            summary["n_done"] += 1
+            idials_runner.run(["mkchi"], None)
+
+    except Exception as e:
+        logger.warning("dataset %s crashed: %s", template, e)
+        summary["failed_step"] = "{} ({})".format(step[0], e)
+
+    finally:
+        session_journal.close()
+
+    try:
+        export_session(idials_runner, dui_files_path)
+
+    except Exception as e:
+        # a missing report should not take down the rest of the batch
+        logger.warning("could not export the session of %s: %s", template, e)
+
+    return summary
+
+
+def run_batch(
+    lst_template, lst_step, out_dir, n_workers=1, on_done=None, overrides=None
+):
+    """
+    Runs << lst_step >> on every template, << n_workers >> datasets at the
+    same time, << on_done(summary) >> is called as each dataset finishes.
+    << overrides >> are << sys_arg >> values for every dataset.
+
+    Returns:
+        (List[dict]): summaries in the order of << lst_template >>
+    """
+    lst_job = batch_jobs(lst_template, lst_step, out_dir, n_workers, overrides)
+
+    if n_workers <= 1:
+        lst_summary = []
+        for job in lst_job:
+            lst_summary.append(run_dataset(job))
+            if on_done is not None:
+                on_done(lst_summary[-1])
+
+        return lst_summary
+
+    summary_dict = {}
+    pool = multiprocessing.Pool(min(n_workers, len(lst_job)))
+    try:
+        for summary in pool.imap_unordered(run_dataset, lst_job):
+            summary_dict[summary["directory"]] = summary
+            if on_done is not None:
+                on_done(summary)
+
+    finally:
+        pool.close()
+        pool.join()
+
+    return [summary_dict[job[1]] for job in lst_job]
+
+
+def print_summary(summary):
+    if summary["failed_step"] is None:
+        status = "OK"
+
+    else:
+        status = "FAILED at " + summary["failed_step"]
+
+    print(
+        "{}  ({} steps done)  {}  ->  {}".format(
+            status, summary["n_done"], summary["template"], summary["directory"]
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="DUI batch, runs a recipe of DIALS steps on many datasets",
+        usage=(
+            "dui-batch [-h|--help] [-v[v]] recipe=RECIPE [directory=DIRECTORY]"
+            " [nproc=N] [templates=FILE] [stall_s=S]"
+            " [stall_action=flag|cancel|requeue] TEMPLATE [TEMPLATE ...]"
+        ),
+    )
+    parser.add_argument("positionals", type=str, nargs="*", help=argparse.SUPPRESS)
+    parser.add_argument("--verbose", "-v", action="count", default=0)
+    args = parser.parse_args()
+
+    if args.verbose == 0:
+        logging.basicConfig(level=logging.WARN, format="%(message)s")
+    elif args.verbose == 1:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(
+            level=logging.DEBUG, format="%(levelname)s:%(name)s:%(lineno)s %(message)s"
+        )
+
+    recipe_path = None
+    out_dir = str(os.getcwd())
+    n_workers = 1
+    overrides = {}
+    lst_template = []
+    for arg in args.positionals:
+        if arg.startswith("recipe="):
+            recipe_path = arg[len("recipe=") :]
+        elif arg.startswith("directory="):
+            out_dir = os.path.abspath(arg[len("directory=") :])
+        elif arg.startswith("nproc="):
+            n_workers = int(arg[len("nproc=") :])
+        elif arg.startswith("stall_s="):
+            overrides["stall_s"] = float(arg[len("stall_s=") :])
+        elif arg.startswith("stall_action="):
+            overrides["stall_action"] = arg[len("stall_action=") :]
+        elif arg.startswith("templates="):
+            with open(arg[len("templates=") :]) as tpl_in:
+                lst_template += [lin.strip() for lin in tpl_in if lin.strip()]
+        else:
+            lst_template.append(arg)
+
+    if recipe_path is None or not lst_template:
+        parser.print_usage()
+        sys.exit(2)
+
+    try:
+        lst_step = read_recipe(recipe_path)
+
+    except (IOError, ValueError) as e:
+        print("can not read recipe:", e)
+        sys.exit(2)
+
+    logger.info("running %s datasets on %s workers", len(lst_template), n_workers)
+    lst_summary = run_batch(
+        lst_template,
+        lst_step,
+        out_dir,
+        n_workers=n_workers,
+        on_done=print_summary,
+        overrides=overrides,
+    )
+    n_failed = len([smr for smr in lst_summary if smr["failed_step"] is not None])
+    print(
+        "\n {} of {} datasets done".format(
+            len(lst_summary) - n_failed, len(lst_summary)
+        )
+    )
+    if n_failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
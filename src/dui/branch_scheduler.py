@@ -0,0 +1,200 @@
+"""
+Running several nodes of DUI's navigation tree at the same time
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+from collections import deque
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# states of a node handed to the scheduler, in the order they happen
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class _NodeReporter(object):
+    """
+    Passed to DialsCommand as << ref_to_class >>, tags the output of each
+    process with the lin_num of its node
+    """
+
+    def __init__(self, scheduler, node):
+        self.scheduler = scheduler
+        self.node = node
+
+    def emit_print_signal(self, str_lin):
+        if self.scheduler.on_output is not None:
+            self.scheduler.on_output(self.node.lin_num, str_lin)
+
+    def emit_fail_signal(self):
+        logger.debug("node %s failed", self.node.lin_num)
+
+    def emit_stall_signal(self, stalled):
+        # the flag is in node.dials_command, only the tree needs to know
+        if self.scheduler.on_state_changed is not None:
+            self.scheduler.on_state_changed(self.node.lin_num)
+
+
+class BranchScheduler(object):
+    """
+    Runs independent nodes of a Runner tree, each one with its own
+    DialsCommand process, at most << max_running >> at the same time
+
+    Every node goes through node.run_state = queued -> running -> done
+    or failed, << on_state_changed(lin_num) >> is called on each change.
+    Both callbacks are called from the worker threads.
+    """
+
+    def __init__(self, runner, max_running=2, on_state_changed=None, on_output=None):
+        self.runner = runner
+        self.max_running = max(1, int(max_running))
+        self.on_state_changed = on_state_changed
+        self.on_output = on_output
+        self._queue = deque()
+        self._running = {}
+        self._cancelled = set()
+        self._lock = threading.Lock()
+
+    def _set_state(self, node, state):
+        node.run_state = state
+        if self.on_state_changed is not None:
+            self.on_state_changed(node.lin_num)
+
+    def is_busy(self, node):
+        return node.run_state in (QUEUED, RUNNING)
+
+    def n_active(self):
+        with self._lock:
+            return len(self._queue) + len(self._running)
+
+    def set_max_running(self, max_running):
+        with self._lock:
+            self.max_running = max(1, int(max_running))
+
+        self._start_next()
+
+    def submit(self, node, cmd_lst):
+        """Queues << node >> to run << cmd_lst >>"""
+        if node.success is not None or self.is_busy(node):
+            logger.debug("node %s can not be queued", node.lin_num)
+            return False
+
+        # a copy, the GUI keeps editing the list it passed
+        cmd_lst = [list(cmd) for cmd in cmd_lst]
+        node.ll_command_lst = cmd_lst
+        with self._lock:
+            self._queue.append((node, cmd_lst))
+
+        self._set_state(node, QUEUED)
+        self._start_next()
+        return True
+
+    def _start_next(self):
+        lst_new = []
+        with self._lock:
+            while self._queue and len(self._running) < self.max_running:
+                node, cmd_lst = self._queue.popleft()
+                job_thread = threading.Thread(
+                    target=self._run_job, args=(node, cmd_lst)
+                )
+                job_thread.daemon = True
+                self._running[node.lin_num] = (node, job_thread)
+                lst_new.append((node, job_thread))
+
+        for node, job_thread in lst_new:
+            self._set_state(node, RUNNING)
+            job_thread.start()
+
+    def _run_job(self, node, cmd_lst):
+        try:
+            self.runner.run_node(node, cmd_lst, _NodeReporter(self, node))
+
+        except Exception as e:
+            logger.warning("node %s crashed: %s", node.lin_num, e)
+            node.success = False
+
+        with self._lock:
+            was_cancelled = node.lin_num in self._cancelled
+            self._cancelled.discard(node.lin_num)
+
+        if was_cancelled:
+            # stopped by the user, ready to run again like any new node
+            node.success = None
+            self._set_state(node, None)
+
+        elif node.success is True:
+            self._set_state(node, DONE)
+
+        else:
+            self._set_state(node, FAILED)
+
+        with self._lock:
+            del self._running[node.lin_num]
+
+        self._start_next()
+
+    def cancel(self, node, kill_fun=None):
+        """
+        Removes a queued node, or stops the process of a running one with
+        its DialsCommand.cancel (or << kill_fun(pid) >> if given)
+        """
+        with self._lock:
+            for pos, (queued_node, _) in enumerate(self._queue):
+                if queued_node is node:
+                    del self._queue[pos]
+                    break
+
+            else:
+                queued_node = None
+
+            is_running = node.lin_num in self._running
+            if is_running:
+                self._cancelled.add(node.lin_num)
+
+        if queued_node is not None:
+            self._set_state(node, None)
+
+        elif is_running and kill_fun is None:
+            node.dials_command.cancel()
+
+        elif is_running and getattr(node.dials_command, "my_pid", None) is not None:
+            kill_fun(node.dials_command.my_pid)
+
+    def shutdown(self, kill_fun=None):
+        """Forgets queued nodes and stops the running ones"""
+        with self._lock:
+            lst_queued = [node for node, _ in self._queue]
+            self._queue.clear()
+            lst_running = list(self._running.values())
+
+        for node in lst_queued:
+            self._set_state(node, None)
+
+        for node, _ in lst_running:
+            self.cancel(node, kill_fun)
+
+        for _, job_thread in lst_running:
+            job_thread.join()
@@ -27,10 +27,46 @@ import json
 import logging
 import os
 import subprocess
+import threading
+import time
 
 import libtbx.phil
 from six.moves import range
 
+try:
+    from cpu_budget import (
+        detect_cores,
+        get_budget,
+        nproc_param,
+        requested_nproc,
+        with_nproc,
+    )
+    from executors import Job, get_executor
+    from line_log import LineIndexedLog
+    from proc_engine import LineBatcher
+    from proc_limits import MemoryGuard, StepLimits, says_out_of_memory
+    from resumable import StepCheckpoint, quarantine_outputs, split_integrate
+    from stall_watch import StallWatchdog, stack_dump
+    from telemetry import ProcSampler, merge
+    from tracing import traced, tracer
+
+except ImportError:
+    from .cpu_budget import (
+        detect_cores,
+        get_budget,
+        nproc_param,
+        requested_nproc,
+        with_nproc,
+    )
+    from .executors import Job, get_executor
+    from .line_log import LineIndexedLog
+    from .proc_engine import LineBatcher
+    from .proc_limits import MemoryGuard, StepLimits, says_out_of_memory
+    from .resumable import StepCheckpoint, quarantine_outputs, split_integrate
+    from .stall_watch import StallWatchdog, stack_dump
+    from .telemetry import ProcSampler, merge
+    from .tracing import traced, tracer
+
 logger = logging.getLogger(__name__)
 
 
@@ -41,18 +77,88 @@ class SysArgvData(object):
 
     template = None
     directory = str(os.getcwd())
+    # nodes of the tree allowed to run at the same time in the background
+    max_branches = 2
+    # disk space for results of previous steps reused on identical runs,
+    # 0 turns the step cache off
+    cache_size_mb = 4096
+    # size of dui_files above which reports and predictions get deleted,
+    # 0 for no limit
+    disk_quota_mb = 0
+    # where DIALS steps run: local, pool, spool or warm (see executors.py)
+    executor = "local"
+    # directory watched by the dui-worker daemons, for the spool executor
+    spool_dir = None
+    # seconds a stopped step gets to end by itself before being killed
+    cancel_grace_s = 10.0
+    # integrate in that many resumable blocks of images, 0 or 1 in one go,
+    # the blocks end as separate experiments so this changes the results
+    integrate_blocks = 0
+    # cores shared by all steps, reports and predictions, None to detect
+    cpu_budget = None
+    # seconds without output and with the CPU idle for a step to be
+    # stalled, 0 for no watchdog, and what to do then (see stall_watch.py)
+    stall_s = 600.0
+    stall_action = "flag"
+    # nice level of the steps, cores left to the GUI, resident memory of a
+    # step and address space of each process (MB, 0 for no limit)
+    step_nice = 10
+    gui_cores = 1
+    mem_limit_mb = 0
+    vmem_limit_mb = 0
+    # memory for decoded images in the viewer and positions read ahead
+    frame_cache_mb = 1024
+    read_ahead = 4
+    # frames per second of the movie and its decoder processes (0 for auto)
+    play_fps = 30
+    play_decoders = 0
 
 
 sys_arg = SysArgvData()
 
 
-def prn_lst_lst_cmd(last_idials_node):
+def executor_for_session():
+    """Executor chosen with << sys_arg.executor >>"""
+    spool_dir = sys_arg.spool_dir
+    if spool_dir is None:
+        spool_dir = os.path.join(sys_arg.directory, "dui_spool")
+
+    return get_executor(
+        sys_arg.executor,
+        spool_dir=spool_dir,
+        n_workers=sys_arg.max_branches,
+        grace_s=sys_arg.cancel_grace_s,
+    )
+
+
+def limits_for_session():
+    """Limits of every process launched (see proc_limits.py)"""
+    return StepLimits(sys_arg.step_nice, sys_arg.gui_cores, sys_arg.vmem_limit_mb)
+
+
+def budget_for_session():
+    """
+    CPU budget of << sys_arg.cpu_budget >> cores (see cpu_budget.py), by
+    default the cores not left to the GUI
+    """
+    n_cores = sys_arg.cpu_budget
+    if n_cores is None and limits_for_session().cpus() is not None:
+        n_cores = max(1, detect_cores() - sys_arg.gui_cores)
+
+    return get_budget(n_cores)
+
+
+def prn_lst_lst_cmd(node_path):
+    """
+    Prints every command needed to get to the last node of << node_path >>,
+    that should be the list of nodes from Root down, as given by
+    Runner.get_ancestor_path()
+    """
     try:
-        cur_nod = last_idials_node
         lst_simpl_cmd = []
         lst_full_cmd = []
 
-        while True:
+        for cur_nod in reversed(node_path):
             if cur_nod.ll_command_lst[0] == ["Root"] or cur_nod.lin_num == 0:
                 break
 
@@ -64,8 +170,6 @@ def prn_lst_lst_cmd(last_idials_node):
             for one_cmd in reversed(cur_nod.dials_command.full_cmd_lst):
                 lst_full_cmd.append(one_cmd)
 
-            cur_nod = cur_nod.prev_step
-
         for prn_lin in reversed(lst_simpl_cmd):
             logger.debug(prn_lin)
 
@@ -388,6 +492,13 @@ def build_command_lst(node_obj, cmd_lst):
         '''
 
 
+    if cmd_lst_ini == "integrate" and sys_arg.integrate_blocks > 1:
+        # the captured output of every block is the log of the step
+        node_obj.log_file_out = None
+        return split_integrate(
+            lst_inner, node_obj.lin_num, run_path, sys_arg.integrate_blocks
+        )
+
     cmd_lst_to_run.append(lst_inner)
 
 
@@ -437,6 +548,39 @@ def build_mask_command_lst(mask_itm_lst):
     return [to_run1, to_run2]
 
 
+@traced()
+def run_side_cmd(str_cmd, cwd_path):
+    """
+    Runs a report or prediction command on one core of the budget, in a
+    warm worker with << executor=warm >>, its output goes to the terminal
+
+    Returns:
+        (int): exit status of the command
+    """
+    # InfoJobQueue workers wait for a core like the steps do, the GUI
+    # thread (try_move_last_info) must not: without a free core the report
+    # runs anyway, it is short
+    on_gui_thread = threading.current_thread() is threading.main_thread()
+    with budget_for_session().cores(1, cancelled=lambda: on_gui_thread):
+        executor = executor_for_session()
+        step_limits = limits_for_session()
+        if executor.name == "warm":
+            return executor.run(
+                Job(str_cmd.split(), cwd_path),
+                LineBatcher(on_lines=print),
+                on_start=step_limits.apply,
+            )
+
+        start_us = time.time() * 1e6
+        side_proc = subprocess.Popen(str_cmd, shell=True, cwd=cwd_path)
+        step_limits.apply(side_proc.pid)
+        side_proc.wait()
+        tracer.process(
+            str_cmd.split(" ", 1)[0], side_proc.pid, start_us, side_proc.returncode
+        )
+        return side_proc.returncode
+
+
 def generate_predict(node_obj):
     pre_out = None
     cwd_path = os.path.join(sys_arg.directory, "dui_files")
@@ -452,8 +596,7 @@ def generate_predict(node_obj):
 
             tst_path = os.path.join(cwd_path, pre_fil)
             if not(os.path.exists(tst_path)):
-                gen_pred_proc = subprocess.Popen(pred_cmd, shell=True, cwd=cwd_path)
-                gen_pred_proc.wait()
+                run_side_cmd(pred_cmd, cwd_path)
 
                 if os.path.exists(tst_path):
                     logger.debug("\ngenerated predictions at:  %s %s", tst_path, "\n")
@@ -479,6 +622,7 @@ def generate_predict(node_obj):
     return pre_out
 
 
+@traced()
 def generate_report(node_obj):
 
     rep_out = None
@@ -515,8 +659,7 @@ def generate_report(node_obj):
 
             try:
                 cwd_path = os.path.join(sys_arg.directory, "dui_files")
-                gen_rep_proc = subprocess.Popen(rep_cmd, shell=True, cwd=cwd_path)
-                gen_rep_proc.wait()
+                run_side_cmd(rep_cmd, cwd_path)
 
                 rep_out = htm_fil
                 logger.debug("generated report at:  %s", rep_out)
@@ -545,6 +688,8 @@ class DialsCommand(object):
     def __init__(self):
         logger.debug("creating new DialsCommand (obj)")
         self.full_cmd_lst = [None]
+        self.stalled = False
+        self.out_of_memory = False
 
         os_name = os.name
         logger.debug("\n Running process on  %s %s", os_name, "\n\n")
@@ -554,11 +699,91 @@ class DialsCommand(object):
         else:
             self.use_shell = False
 
-    def __call__(self, lst_cmd_to_run=None, ref_to_class=None):
+    @traced("DialsCommand")
+    def __call__(self, lst_cmd_to_run=None, ref_to_class=None, out_path=None):
+        """
+        Runs every command in << lst_cmd_to_run >>, their combined output
+        goes to << out_path >> (a LineIndexedLog) instead of memory
+        """
         self.full_cmd_lst = []
+        self.telemetry = None
+        self.out_of_memory = False
+
+        cwd_path = os.path.join(sys_arg.directory, "dui_files")
+        if out_path is None:
+            out_path = os.path.join(cwd_path, "dials_out.log")
+
+        self.out_log = LineIndexedLog(out_path)
+        self.out_log.open_new()
+        n_requeue = 1 if sys_arg.stall_action == "requeue" else 0
+        try:
+            while True:
+                self.full_cmd_lst = []
+                self.stall_cancelled = False
+                local_success = self._run_all(
+                    lst_cmd_to_run, ref_to_class, cwd_path, out_path
+                )
+                if not (self.stall_cancelled and n_requeue > 0):
+                    break
+
+                # resumes after the last command that finished
+                n_requeue -= 1
+                self._print_fun(ref_to_class)("stalled step queued again")
+
+        finally:
+            self.out_log.close()
+
+        if local_success is False and self.failed_by_exit:
+            try:
+                ref_to_class.emit_fail_signal()
+
+            except BaseException as e:
+                # We don't want to catch bare exceptions but don't know
+                # what this was supposed to catch. Log it.
+                logger.debug(
+                    "Caught unknown exception type %s: %s", type(e).__name__, e
+                )
+
+        return local_success
+
+    def _run_all(self, lst_cmd_to_run, ref_to_class, cwd_path, out_path):
+        self.failed_by_exit = False
+        self.was_cancelled = False
+        checkpoint = StepCheckpoint(out_path + ".ckpt", lst_cmd_to_run)
+        n_done = checkpoint.n_done(cwd_path)
+        if n_done:
+            resume_msg = "resuming, {} of {} commands already done".format(
+                n_done, len(lst_cmd_to_run)
+            )
+            self.out_log.append(resume_msg)
+            self._print_fun(ref_to_class)(resume_msg)
+
+        for pos, lst_single in enumerate(lst_cmd_to_run):
+            if pos < n_done:
+                self.full_cmd_lst.append(lst_single)
+                local_success = True
+                continue
+
+            self._executor = executor_for_session()
+            run_job = self.run_job = Job(None, cwd_path, self.use_shell)
+            n_cores = 0
+            if self._executor.name != "spool":
+                # cores of another host are not in this budget
+                n_wanted = 1
+                if nproc_param(lst_single) is not None:
+                    n_wanted = requested_nproc(lst_single)
+
+                n_cores = budget_for_session().acquire(
+                    n_wanted, cancelled=lambda: run_job.cancelled
+                )
+                if n_cores == 0:
+                    self.was_cancelled = True
+                    self.failed_by_exit = True
+                    self.run_job = None
+                    return False
+
+                lst_single = with_nproc(lst_single, n_cores)
 
-        self.tmp_std_all = []
-        for lst_single in lst_cmd_to_run:
             try:
                 single_string = ""
 
@@ -574,49 +799,62 @@ class DialsCommand(object):
                 else:
                     run_cmd = lst_single
 
-                cwd_path = os.path.join(sys_arg.directory, "dui_files")
-
                 print("\nRunning:", run_cmd, "\n")
 
-                my_process = subprocess.Popen(
-                    run_cmd,
-                    shell=self.use_shell,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    bufsize=1,
-                    cwd=cwd_path,
+                self.live_out = LineBatcher(
+                    self.out_log, on_lines=self._print_fun(ref_to_class)
+                )
+                self._sampler = None
+                self._guard = None
+                self.my_pid = None
+                run_job.run_cmd = run_cmd
+                watchdog = StallWatchdog(
+                    self.live_out,
+                    self._stall_fun(ref_to_class, out_path),
+                    cpu_fun=self._cpu_now,
+                    stall_s=sys_arg.stall_s,
                 )
-                self.my_pid = my_process.pid
-                for line in iter(my_process.stdout.readline, b""):
-                    single_line = line[0 : len(line) - 1]
-                    # print(">>: ", single_line)
-                    self.tmp_std_all.append(single_line)
-                    try:
-                        ref_to_class.emit_print_signal(single_line)
-
-                    except AttributeError:
-                        print(">>: ", single_line)
-
-                my_process.wait()
-                my_process.stdout.close()
-                if my_process.poll() == 0:
+                if sys_arg.stall_s > 0:
+                    watchdog.start()
+
+                try:
+                    exit_status = self._executor.run(
+                        run_job, self.live_out, on_start=self._set_pid
+                    )
+
+                finally:
+                    watchdog.stop()
+                    if watchdog.stalled:
+                        self._stall_fun(ref_to_class, out_path)(False, 0)
+
+                    # its pid may belong to another process from now on
+                    self.run_job = None
+                    budget_for_session().release(n_cores)
+                    if self._guard is not None:
+                        self._guard.stop()
+                    if self._sampler is not None:
+                        self.telemetry = merge(self.telemetry, self._sampler.stop())
+
+                if exit_status != 0 and (
+                    (self._guard is not None and self._guard.rss_over is not None)
+                    or says_out_of_memory(self.live_out.tail_lines()[-50:])
+                ):
+                    self._report_oom(ref_to_class)
+
+                if run_job.cancelled:
+                    self.was_cancelled = True
+                    lst_moved = quarantine_outputs(cwd_path, lst_single)
+                    logger.info("stopped, partial outputs quarantined: %s", lst_moved)
+
+                if exit_status == 0 and not run_job.cancelled:
                     local_success = True
+                    checkpoint.mark_done(pos, cwd_path)
 
                 else:
-                    local_success = False
                     # TODO handle error outputs
                     print("\n __________________ Failed ______________________ \n")
-                    try:
-                        ref_to_class.emit_fail_signal()
-                        return False
-
-                    except BaseException as e:
-                        # We don't want to catch bare exceptions but don't know
-                        # what this was supposed to catch. Log it.
-                        logger.debug(
-                            "Caught unknown exception type %s: %s", type(e).__name__, e
-                        )
-                        return False
+                    self.failed_by_exit = True
+                    return False
 
                 logger.debug("Done all step")
 
@@ -627,8 +865,119 @@ class DialsCommand(object):
 
             self.full_cmd_lst.append(lst_single)
 
+        if local_success is True:
+            checkpoint.clear()
+
         return local_success
 
+    def _set_pid(self, pid):
+        # None when the executor runs it on another host
+        self.my_pid = pid
+        if pid is not None:
+            limits_for_session().apply(pid)
+            # a warm worker keeps the I/O counters of the jobs it ran before
+            self._sampler = ProcSampler(pid, baseline=self._executor.name == "warm")
+            self._sampler.start()
+            if sys_arg.mem_limit_mb > 0:
+                self._guard = MemoryGuard(
+                    pid, sys_arg.mem_limit_mb, lambda rss: self.cancel()
+                )
+                self._guard.start()
+
+    def _report_oom(self, ref_to_class):
+        self.out_of_memory = True
+        oom_msg = "out of memory"
+        if self._guard is not None and self._guard.rss_over is not None:
+            oom_msg += ", stopped using {:.0f} MB, over the limit of {} MB".format(
+                self._guard.rss_over / 1024 ** 2, sys_arg.mem_limit_mb
+            )
+
+        elif sys_arg.vmem_limit_mb > 0:
+            oom_msg += ", address space limited to {} MB".format(
+                sys_arg.vmem_limit_mb
+            )
+
+        logger.warning(oom_msg)
+        self.out_log.append(oom_msg)
+        self._print_fun(ref_to_class)(oom_msg)
+
+    def _cpu_now(self):
+        sampler = getattr(self, "_sampler", None)
+        if sampler is None:
+            return None
+
+        return sampler.cpu_last
+
+    def _stall_fun(self, ref_to_class, out_path):
+        """What the StallWatchdog of a command calls"""
+
+        def on_stall(stalled, silent_s):
+            self.stalled = stalled
+            if stalled:
+                stall_msg = (
+                    "no output for {:.0f} s with the CPU idle,"
+                    " the step looks stalled".format(silent_s)
+                )
+                logger.warning(stall_msg)
+                if self.my_pid is not None:
+                    stacks_path = out_path + ".stacks"
+                    with open(stacks_path, "a") as stacks_out:
+                        stacks_out.write(
+                            stack_dump(
+                                self.my_pid, signal_ok=self._executor.name == "warm"
+                            )
+                            + "\n"
+                        )
+
+                    stall_msg += ", stacks in " + os.path.basename(stacks_path)
+
+                self._print_fun(ref_to_class)(stall_msg)
+                if sys_arg.stall_action in ("cancel", "requeue"):
+                    self.stall_cancelled = True
+                    self.cancel()
+
+            try:
+                ref_to_class.emit_stall_signal(stalled)
+
+            except AttributeError:
+                pass
+
+        return on_stall
+
+    def cancel(self):
+        """Stops the command running, if any, whatever runs it"""
+        run_job = getattr(self, "run_job", None)
+        if run_job is not None:
+            self._executor.cancel(run_job)
+
+    @staticmethod
+    def _print_fun(ref_to_class):
+        """Where batches of output lines go, one string per batch"""
+        try:
+            return ref_to_class.emit_print_signal
+
+        except AttributeError:
+            return lambda str_lines: print(">>: ", str_lines)
+
+    def live_tail(self):
+        """Last lines of the running (or last run) process, [] if none"""
+        live_out = getattr(self, "live_out", None)
+        if live_out is None:
+            return []
+
+        return live_out.tail_lines()
+
+    def __getstate__(self):
+        # the output lives in its file, not in the session
+        state = self.__dict__.copy()
+        state.pop("out_log", None)
+        state.pop("live_out", None)
+        state.pop("_sampler", None)
+        state.pop("_guard", None)
+        state.pop("run_job", None)
+        state.pop("_executor", None)
+        return state
+
 
 def print_list(lst, curr):
     print("__________________________listing:")
@@ -668,6 +1017,7 @@ class TreeShow(object):
         self.ind_spc = "      "
         self.ind_lin = "------"
 
+    @traced("TreeShow")
     def __call__(self, my_runner):
 
         #print("\n\n TreeShow debug \n my_runner.step_list:\n")
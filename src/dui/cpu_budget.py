@@ -0,0 +1,252 @@
+"""
+One budget of CPU cores shared by everything DUI runs at the same time
+
+Every step, report or prediction asks the budget for cores before its
+process starts and gives them back when it ends. Steps that take
+<< mp.nproc >> get as many as are free (never more than they asked for),
+the rest get one. When no core is free the caller waits in the queue, so
+branches running in parallel never oversubscribe the machine.
+
+The size of the budget is the number of cores DUI may use: the CPU
+affinity of the process, lowered by a cgroup CPU quota (containers, batch
+systems), or << cpu_budget=N >> from the command line. Cores busy with
+processes outside DUI (the CPU use of the machine over the last poll,
+less the cores DUI handed out) are left alone.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import contextlib
+import logging
+import math
+import os
+import threading
+import time
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# parameter setting the number of processes of each command that has one
+NPROC_PARAMS = {
+    "dials.find_spots": "spotfinder.mp.nproc",
+    "dials.integrate": "integration.mp.nproc",
+}
+
+# seconds between checks of the load and of << cancelled() >> while waiting
+WAIT_POLL = 0.5
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as file_in:
+            return file_in.readline().strip()
+
+    except (IOError, OSError):
+        return None
+
+
+def cgroup_cores(cgroup_root=CGROUP_ROOT):
+    """
+    Cores allowed by the CPU quota of the cgroup (v2 or v1), None without
+    a quota
+    """
+    # cgroup v2: "max 100000" or "<quota> <period>"
+    cpu_max = _read_first_line(os.path.join(cgroup_root, "cpu.max"))
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max" and period:
+            return max(1, int(math.ceil(int(quota) / int(period))))
+
+        return None
+
+    quota = _read_first_line(os.path.join(cgroup_root, "cpu", "cpu.cfs_quota_us"))
+    period = _read_first_line(os.path.join(cgroup_root, "cpu", "cpu.cfs_period_us"))
+    if quota is None or period is None or int(quota) <= 0:
+        return None
+
+    return max(1, int(math.ceil(int(quota) / int(period))))
+
+
+def detect_cores(cgroup_root=CGROUP_ROOT):
+    """Cores this process may use, see the docstring of the module"""
+    try:
+        n_cores = len(os.sched_getaffinity(0))
+
+    except AttributeError:
+        n_cores = os.cpu_count() or 1
+
+    n_quota = cgroup_cores(cgroup_root)
+    if n_quota is not None:
+        n_cores = min(n_cores, n_quota)
+
+    return max(1, n_cores)
+
+
+# last measure of the CPU use of the whole machine, in busy cores
+_cpu_sample = {"time": None, "busy": 0.0}
+
+
+def external_load(n_assigned, now=None):
+    """
+    Cores kept busy by processes DUI did not start. Measured over the last
+    << WAIT_POLL >> seconds or so, not by the load average, which still
+    counts the steps DUI ended a minute ago.
+    """
+    now = time.time() if now is None else now
+    last_time = _cpu_sample["time"]
+    if last_time is None or now - last_time >= WAIT_POLL:
+        try:
+            # CPU use since the previous call
+            cpu_percent = psutil.cpu_percent(interval=None)
+
+        except (psutil.Error, OSError):
+            cpu_percent = 0.0
+
+        _cpu_sample["busy"] = cpu_percent * (psutil.cpu_count() or 1) / 100.0
+        _cpu_sample["time"] = now
+
+    return max(0, int(_cpu_sample["busy"]) - n_assigned)
+
+
+def nproc_param(lst_single):
+    """The mp.nproc parameter of a command, None if it does not take one"""
+    return NPROC_PARAMS.get(lst_single[0])
+
+
+def requested_nproc(lst_single):
+    """Value of mp.nproc in the command, None when not given"""
+    for arg in lst_single[1:]:
+        if "mp.nproc=" in arg:
+            try:
+                return int(arg.split("=", 1)[1])
+
+            except ValueError:
+                return None
+
+    return None
+
+
+def with_nproc(lst_single, n_cores):
+    """Copy of the command << lst_single >> running on << n_cores >> cores"""
+    par_name = nproc_param(lst_single)
+    if par_name is None:
+        return list(lst_single)
+
+    lst_new = [arg for arg in lst_single if "mp.nproc=" not in arg]
+    lst_new.insert(1, "{}={}".format(par_name, n_cores))
+    return lst_new
+
+
+class CpuBudget(object):
+    """
+    << n_cores >> cores handed out by << acquire >> and back by << release >>,
+    waiting callers are served first come first served
+    """
+
+    def __init__(self, n_cores=None, use_load=True):
+        self.n_cores = n_cores or detect_cores()
+        self.use_load = use_load
+        self.n_assigned = 0
+        self._cond = threading.Condition()
+        self._waiting = []
+        if use_load:
+            # the first measure only starts the clock of the CPU use
+            external_load(0)
+
+    def n_free(self):
+        with self._cond:
+            return self._n_free()
+
+    def _n_free(self):
+        n_busy = self.n_assigned
+        if self.use_load:
+            n_busy += external_load(self.n_assigned)
+
+        n_free = self.n_cores - n_busy
+        if self.n_assigned == 0:
+            # the machine being busy elsewhere must not stall DUI forever
+            n_free = max(1, n_free)
+
+        return n_free
+
+    def acquire(self, n_wanted=None, cancelled=None):
+        """
+        Waits for a free core and takes up to << n_wanted >> (all free cores
+        when None). Gives up, returning 0, once << cancelled() >> is True.
+
+        Returns:
+            (int): number of cores taken, to hand back to << release >>
+        """
+        if n_wanted is None:
+            n_wanted = self.n_cores
+
+        n_wanted = max(1, min(int(n_wanted), self.n_cores))
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while self._waiting[0] is not ticket or self._n_free() < 1:
+                    if cancelled is not None and cancelled():
+                        return 0
+
+                    self._cond.wait(WAIT_POLL)
+
+                n_taken = min(n_wanted, self._n_free())
+                self.n_assigned += n_taken
+
+            finally:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+
+        logger.debug("%s of %s cores taken", n_taken, n_wanted)
+        return n_taken
+
+    def release(self, n_taken):
+        with self._cond:
+            self.n_assigned -= n_taken
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def cores(self, n_wanted=None, cancelled=None):
+        n_taken = self.acquire(n_wanted, cancelled)
+        try:
+            yield n_taken
+
+        finally:
+            self.release(n_taken)
+
+
+_budget_cache = {}
+
+
+def get_budget(n_cores=None):
+    """
+    The budget shared by the whole process, << n_cores >> (None to detect
+    them) only counts the first time
+    """
+    if "budget" not in _budget_cache:
+        _budget_cache["budget"] = CpuBudget(n_cores)
+        logger.info("CPU budget of %s cores", _budget_cache["budget"].n_cores)
+
+    return _budget_cache["budget"]
@@ -0,0 +1,267 @@
+"""
+Deduplication of identical outputs in dui_files
+
+Branches forked from the same parent often write byte-identical files,
+those are stored once: as reflinks (copy-on-write clones) where the file
+system supports them, as hard links otherwise.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+
+try:
+    from disk_gc import is_log, owner_lin
+
+except ImportError:
+    from .disk_gc import is_log, owner_lin
+
+logger = logging.getLogger(__name__)
+
+MEMO_NAME = "dedupe.json"
+
+# smaller files are not worth hashing
+MIN_SIZE = 64 * 1024
+
+# ioctl of Linux to clone a file sharing its extents (btrfs, XFS ...)
+FICLONE = 0x40049409
+
+
+def reflink(src_path, dst_path):
+    """Copy-on-write clone of << src_path >>, raises OSError if not supported"""
+    import fcntl
+
+    with open(src_path, "rb") as src_in:
+        with open(dst_path, "wb") as dst_out:
+            try:
+                fcntl.ioctl(dst_out.fileno(), FICLONE, src_in.fileno())
+
+            except (IOError, OSError):
+                dst_out.close()
+                os.remove(dst_path)
+                raise
+
+
+def clone_file(src_path, dst_path, allow_copy=True):
+    """
+    Replaces << dst_path >> by a file with the contents of << src_path >>
+    sharing its storage when possible
+
+    Returns:
+        (str): "reflink", "hardlink" or "copy"
+    """
+    tmp_path = dst_path + ".dedupe.tmp"
+    try:
+        reflink(src_path, tmp_path)
+        method = "reflink"
+
+    except (IOError, OSError, ImportError):
+        try:
+            os.link(src_path, tmp_path)
+            method = "hardlink"
+
+        except (OSError, AttributeError):
+            if not allow_copy:
+                raise OSError("can not share storage of " + src_path)
+
+            shutil.copy2(src_path, tmp_path)
+            method = "copy"
+
+    os.replace(tmp_path, dst_path)
+    return method
+
+
+def _file_hash(path):
+    f_hash = hashlib.sha256()
+    with open(path, "rb") as f_in:
+        for chunk in iter(lambda: f_in.read(1024 * 1024), b""):
+            f_hash.update(chunk)
+
+    return f_hash.hexdigest()
+
+
+class Deduper(object):
+    """
+    Shares the storage of identical step outputs in << dir_path >>
+
+    Only files of finished nodes are touched, they are never written again
+    (hard links would otherwise carry the writes to the other names). Hashes
+    are remembered in << dedupe.json >> so each run only reads new files.
+    """
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.memo = {}
+        try:
+            with open(os.path.join(dir_path, MEMO_NAME)) as memo_in:
+                self.memo = json.load(memo_in)
+
+        except (IOError, OSError, ValueError):
+            logger.debug("starting a new dedupe memo")
+
+    def _save_memo(self):
+        memo_path = os.path.join(self.dir_path, MEMO_NAME)
+        with open(memo_path + ".tmp", "w") as memo_out:
+            json.dump(self.memo, memo_out)
+
+        os.replace(memo_path + ".tmp", memo_path)
+
+    def _entry(self, file_name, f_stat, with_hash):
+        """Memo entry of a file, hashing it only if needed and not known"""
+        entry = self.memo.get(file_name)
+        if (
+            entry is None
+            or entry["size"] != f_stat.st_size
+            or entry["mtime"] != f_stat.st_mtime
+        ):
+            entry = {"size": f_stat.st_size, "mtime": f_stat.st_mtime, "sha": None}
+            entry["shared"] = False
+            self.memo[file_name] = entry
+
+        if with_hash and entry["sha"] is None:
+            entry["sha"] = _file_hash(os.path.join(self.dir_path, file_name))
+
+        return entry
+
+    def run(self, done_lins=None):
+        """
+        Dedupes the outputs of the nodes in << done_lins >> (every node when
+        None, only for sessions not in use)
+
+        Returns:
+            (int): bytes no longer stored twice
+        """
+        size_dict = {}
+        for file_name in sorted(os.listdir(self.dir_path)):
+            lin_num = owner_lin(file_name)
+            if lin_num is None or is_log(file_name):
+                continue
+
+            if done_lins is not None and lin_num not in done_lins:
+                continue
+
+            path = os.path.join(self.dir_path, file_name)
+            if not os.path.isfile(path) or os.path.islink(path):
+                continue
+
+            f_stat = os.stat(path)
+            if f_stat.st_size >= MIN_SIZE:
+                size_dict.setdefault(f_stat.st_size, []).append((file_name, f_stat))
+
+        sha_dict = {}
+        for lst_same in size_dict.values():
+            if len(lst_same) < 2:
+                continue
+
+            for file_name, f_stat in lst_same:
+                entry = self._entry(file_name, f_stat, with_hash=True)
+                sha_dict.setdefault(entry["sha"], []).append(file_name)
+
+        saved = 0
+        for lst_name in sha_dict.values():
+            canonical = os.path.join(self.dir_path, lst_name[0])
+            for file_name in lst_name[1:]:
+                entry = self.memo[file_name]
+                path = os.path.join(self.dir_path, file_name)
+                if entry["shared"] or os.path.samefile(canonical, path):
+                    continue
+
+                try:
+                    method = clone_file(canonical, path, allow_copy=False)
+
+                except (IOError, OSError) as e:
+                    logger.debug("could not dedupe %s: %s", file_name, e)
+                    continue
+
+                logger.debug("%s now a %s of %s", file_name, method, lst_name[0])
+                saved += entry["size"]
+                f_stat = os.stat(path)
+                entry["mtime"] = f_stat.st_mtime
+                entry["shared"] = True
+
+        # forget files deleted since last time
+        for file_name in list(self.memo):
+            if not os.path.exists(os.path.join(self.dir_path, file_name)):
+                del self.memo[file_name]
+
+        self._save_memo()
+        return saved
+
+
+def finished_lins(dui_files_path):
+    """lin_num of the nodes of a saved session that finished running"""
+    try:
+        from session_journal import SessionJournal
+
+    except ImportError:
+        from .session_journal import SessionJournal
+
+    state = SessionJournal(dui_files_path).load_state()
+    return set(
+        lin_num
+        for lin_num, node_dict in state["nodes"].items()
+        if node_dict["success"] is not None
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Stores identical outputs of a DUI session only once",
+        usage="dui-dedupe [-h|--help] [-v] [directory=DIRECTORY]",
+    )
+    parser.add_argument("positionals", type=str, nargs="*", help=argparse.SUPPRESS)
+    parser.add_argument("--verbose", "-v", action="count", default=0)
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARN, format="%(message)s"
+    )
+
+    directory = str(os.getcwd())
+    for arg in args.positionals:
+        if arg.startswith("directory="):
+            directory = os.path.abspath(arg[len("directory=") :])
+
+    try:
+        from session_format import SessionFormatError
+
+    except ImportError:
+        from .session_format import SessionFormatError
+
+    dui_files_path = os.path.join(directory, "dui_files")
+    try:
+        done_lins = finished_lins(dui_files_path)
+
+    except (IOError, OSError, ValueError, SessionFormatError) as e:
+        print("no DUI session to compact in", directory, "(", e, ")")
+        sys.exit(1)
+
+    saved = Deduper(dui_files_path).run(done_lins)
+    print("{:.1f} MB no longer stored twice".format(saved / 1024 ** 2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Garbage collection and quota of the files in dui_files
+
+Every output of a step carries the lin_num of its node in its name
+(3_reflections.refl, 5_report.html, lin_4_bravais_summary.json ...), that
+is how files get mapped to the nodes of the navigation tree.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import os
+import re
+import threading
+
+try:
+    from branch_scheduler import QUEUED, RUNNING
+
+except ImportError:
+    from .branch_scheduler import QUEUED, RUNNING
+
+logger = logging.getLogger(__name__)
+
+_owner_re = re.compile(r"^(?:lin_)?(\d+)_")
+
+# products that can be generated again from the outputs of their node,
+# evicted first when the session is over its quota
+DERIVED_ATTRS = {"report_out": "report", "predict_pickle_out": "predict"}
+
+
+def owner_lin(file_name):
+    """lin_num of the node that wrote << file_name >>, None for session files"""
+    owner_match = _owner_re.match(file_name)
+    if owner_match is None:
+        return None
+
+    return int(owner_match.group(1))
+
+
+# logs of failed steps are the only way to know why they failed, with the
+# index of the log and the stacks dumped by the stall watchdog next to it
+LOG_SUFFIXES = (".log", ".log.idx", ".log.stacks")
+
+
+def is_log(file_name):
+    return file_name.endswith(LOG_SUFFIXES)
+
+
+def scan_dir(dir_path):
+    """
+    Returns:
+        (dict): lin_num -> list of (file name, size, mtime) of its files
+    """
+    file_dict = {}
+    for file_name in os.listdir(dir_path):
+        lin_num = owner_lin(file_name)
+        path = os.path.join(dir_path, file_name)
+        if lin_num is None or not os.path.isfile(path):
+            continue
+
+        f_stat = os.stat(path)
+        file_dict.setdefault(lin_num, []).append(
+            (file_name, f_stat.st_size, f_stat.st_mtime)
+        )
+
+    return file_dict
+
+
+def dir_size(dir_path):
+    """
+    Bytes used by the files in << dir_path >> and its subdirectories (the
+    step_cache among them), hard links counted once
+    """
+    total = 0
+    set_inode = set()
+    for sub_path, _, lst_name in os.walk(dir_path):
+        for file_name in lst_name:
+            path = os.path.join(sub_path, file_name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+
+            f_stat = os.stat(path)
+            if (f_stat.st_dev, f_stat.st_ino) not in set_inode:
+                set_inode.add((f_stat.st_dev, f_stat.st_ino))
+                total += f_stat.st_size
+
+    return total
+
+
+class DiskGC(object):
+    """
+    Removes the files of nodes no longer in the tree and the outputs of
+    failed steps, then evicts reports and predictions (oldest first) while
+    dui_files, step_cache included, is above << quota_bytes >> (None for no
+    quota)
+
+    With a << deduper >> (see dedupe.Deduper), identical outputs of finished
+    nodes are then stored only once.
+
+    Runs in a background thread, << on_done(summary) >> is called from it.
+    """
+
+    def __init__(
+        self, runner, dir_path, quota_bytes=None, on_done=None, deduper=None
+    ):
+        self.runner = runner
+        self.dir_path = dir_path
+        self.quota_bytes = quota_bytes
+        self.on_done = on_done
+        self.deduper = deduper
+        self._thread = None
+
+    def _tree_state(self):
+        """What the GC needs from the tree, read at once holding its lock"""
+        with self.runner.lock:
+            lst_node = []
+            for node in self.runner.step_list:
+                lst_node.append(
+                    {
+                        "node": node,
+                        "lin_num": node.lin_num,
+                        "parent": (
+                            None if node.prev_step is None else node.prev_step.lin_num
+                        ),
+                        "success": node.success,
+                        # DONE and FAILED stay on a node after it ran
+                        "busy": (
+                            node is self.runner.current_node
+                            or getattr(node, "run_state", None) in (QUEUED, RUNNING)
+                        ),
+                    }
+                )
+
+            return lst_node, self.runner.bigger_lin
+
+    def plan(self):
+        """
+        Works out what can be removed without touching anything
+
+        Returns:
+            (dict): with keys
+                "orphans"   files of removed nodes and outputs of failed ones
+                "derived"   (node, attribute, file name, size, mtime) of reports
+                            and predictions, oldest first
+                "reclaimable"   lin_num -> bytes that can be freed in the
+                                branch starting at that node
+        """
+        file_dict = scan_dir(self.dir_path)
+        lst_node, bigger_lin = self._tree_state()
+        node_info = {info["lin_num"]: info for info in lst_node}
+
+        lst_orphan = []
+        lst_derived = []
+        own_bytes = {}
+        for lin_num, lst_file in file_dict.items():
+            info = node_info.get(lin_num)
+            if info is None:
+                if lin_num <= bigger_lin:
+                    # removed from the tree (nodes created after reading it
+                    # have a bigger lin_num and are left alone)
+                    lst_orphan += [name for name, _, _ in lst_file]
+
+                continue
+
+            if info["busy"]:
+                continue
+
+            node = info["node"]
+            derived_names = {}
+            if info["success"] is True:
+                for attr in DERIVED_ATTRS:
+                    if getattr(node, attr, None) is not None:
+                        derived_names[getattr(node, attr)] = attr
+
+            for name, size, mtime in lst_file:
+                if info["success"] is False and not is_log(name):
+                    lst_orphan.append(name)
+                    own_bytes[lin_num] = own_bytes.get(lin_num, 0) + size
+
+                elif name in derived_names:
+                    lst_derived.append((node, derived_names[name], name, size, mtime))
+                    own_bytes[lin_num] = own_bytes.get(lin_num, 0) + size
+
+        # children always have a bigger lin_num than their parent
+        reclaimable = dict(own_bytes)
+        for info in sorted(lst_node, key=lambda info: -info["lin_num"]):
+            if info["parent"] is not None and info["lin_num"] in reclaimable:
+                reclaimable[info["parent"]] = (
+                    reclaimable.get(info["parent"], 0) + reclaimable[info["lin_num"]]
+                )
+
+        lst_derived.sort(key=lambda derived: derived[4])
+        return {
+            "orphans": lst_orphan,
+            "derived": lst_derived,
+            "reclaimable": reclaimable,
+        }
+
+    def _remove(self, file_name):
+        path = os.path.join(self.dir_path, file_name)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+
+        except OSError as e:
+            logger.debug("could not remove %s: %s", file_name, e)
+            return 0
+
+    def collect(self):
+        """
+        Returns:
+            (dict): "freed" bytes, "evicted" list of (lin_num, kind) whose
+            files are gone, the "reclaimable" bytes per branch left and
+            the bytes "deduped"
+        """
+        gc_plan = self.plan()
+        freed = 0
+        for file_name in gc_plan["orphans"]:
+            freed += self._remove(file_name)
+
+        lst_evicted = []
+        if self.quota_bytes is not None:
+            used = dir_size(self.dir_path)
+            for node, attr, file_name, _, _ in gc_plan["derived"]:
+                if used <= self.quota_bytes:
+                    break
+
+                size = self._remove(file_name)
+                used -= size
+                freed += size
+                setattr(node, attr, None)
+                lst_evicted.append((node.lin_num, DERIVED_ATTRS[attr]))
+
+            if used > self.quota_bytes:
+                logger.warning(
+                    "dui_files uses %s MB, over its quota even without reports",
+                    used // 1024 ** 2,
+                )
+
+        if freed:
+            logger.info("disk GC freed %s bytes", freed)
+
+        if lst_evicted:
+            gc_plan = self.plan()
+
+        deduped = 0
+        if self.deduper is not None:
+            lst_node, _ = self._tree_state()
+            deduped = self.deduper.run(
+                set(
+                    info["lin_num"]
+                    for info in lst_node
+                    if info["success"] is not None and not info["busy"]
+                )
+            )
+
+        return {
+            "freed": freed,
+            "evicted": lst_evicted,
+            "reclaimable": gc_plan["reclaimable"],
+            "deduped": deduped,
+        }
+
+    def _run(self):
+        try:
+            summary = self.collect()
+
+        except (IOError, OSError) as e:
+            logger.warning("disk GC failed: %s", e)
+            return
+
+        if self.on_done is not None:
+            self.on_done(summary)
+
+    def start(self):
+        """Collects in a background thread, unless already collecting"""
+        if self._thread is not None and self._thread.is_alive():
+            return False
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
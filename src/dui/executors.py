@@ -0,0 +1,778 @@
+"""
+Backends that run the commands of DIALS steps
+
+    local   a child process of DUI, as always
+    pool    a process of a pool of worker processes on this host
+    spool   a job file in a spool directory, picked up by a separate
+            << dui-worker >> daemon, stand-in for a cluster queue
+    warm    a long-lived Python process with DIALS already imported
+            (see warm_worker.py), saves the start up of short steps
+
+Every backend streams the output to a LineBatcher, can cancel a job and
+returns its exit status. Outputs are written by the command itself in its
+working directory (dui_files), which the spool workers must also see.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import select
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import psutil
+from six.moves import queue
+
+try:
+    import warm_worker
+    from proc_engine import CHUNK_SIZE, MAX_UI_RATE, run_process
+    from tracing import tracer
+
+except ImportError:
+    from . import warm_worker
+    from .proc_engine import CHUNK_SIZE, MAX_UI_RATE, run_process
+    from .tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+EXECUTOR_NAMES = ["local", "pool", "spool", "warm"]
+
+# exit status of a job cancelled before it started, as if killed by SIGTERM
+CANCELLED_STATUS = -15
+
+# seconds between checks of the spool directory
+SPOOL_POLL = 0.2
+
+# seconds a cancelled command gets to end by itself before being killed
+GRACE_S = 10.0
+
+# a warm worker is replaced after that many jobs, or once its memory grew
+# by that many MB since its first job
+WARM_MAX_JOBS = 100
+WARM_MAX_GROWTH_MB = 1024
+
+
+def stop_tree(pid, grace_s=GRACE_S):
+    """
+    Asks a process and all of its children to end (SIGTERM), kills the
+    ones still running after << grace_s >> seconds
+    """
+    try:
+        parent_proc = psutil.Process(pid)
+        lst_proc = parent_proc.children(recursive=True) + [parent_proc]
+
+    except psutil.Error as e:
+        logger.debug("no process %s to stop: %s", pid, e)
+        return
+
+    for proc in lst_proc:
+        try:
+            proc.terminate()
+
+        except psutil.Error:
+            continue
+
+    _, lst_alive = psutil.wait_procs(lst_proc, timeout=grace_s)
+    for proc in lst_alive:
+        logger.info("killing %s, still running after %s s", proc.pid, grace_s)
+        try:
+            proc.kill()
+
+        except psutil.Error:
+            continue
+
+
+def stop_tree_later(pid, grace_s=GRACE_S):
+    """stop_tree in a background thread, the caller does not wait the grace"""
+    stop_thread = threading.Thread(target=stop_tree, args=(pid, grace_s))
+    stop_thread.daemon = True
+    stop_thread.start()
+
+
+def cmd_name(run_cmd):
+    if isinstance(run_cmd, list):
+        return run_cmd[0]
+
+    return run_cmd.split(" ", 1)[0]
+
+
+class Job(object):
+    """
+    One command to run, << run_cmd >> being a list or, with << use_shell >>,
+    a string. << pid >> is set once it runs on this host.
+    """
+
+    def __init__(self, run_cmd, cwd_path, use_shell=False):
+        self.run_cmd = run_cmd
+        self.cwd_path = cwd_path
+        self.use_shell = use_shell
+        # sorts in the order jobs were created
+        self.job_id = "{:017.6f}_{}".format(time.time(), uuid.uuid4().hex[:8])
+        self.pid = None
+        self.cancelled = False
+
+    def to_dict(self):
+        return {
+            "run_cmd": self.run_cmd,
+            "cwd_path": self.cwd_path,
+            "use_shell": self.use_shell,
+        }
+
+
+class LocalExecutor(object):
+    """Runs each job as a child process of DUI"""
+
+    name = "local"
+
+    def __init__(self, grace_s=GRACE_S):
+        self.grace_s = grace_s
+
+    def _started(self, job, on_start):
+        def set_pid(pid):
+            job.pid = pid
+            if job.cancelled:
+                stop_tree_later(pid, self.grace_s)
+
+            if on_start is not None:
+                on_start(pid)
+
+        return set_pid
+
+    def run(self, job, batcher, on_start=None):
+        """
+        Runs << job >> until it ends, << on_start(pid) >> is called once it
+        started, with None if it runs on another host
+
+        Returns:
+            (int): exit status of the command
+        """
+        return run_process(
+            job.run_cmd,
+            cwd_path=job.cwd_path,
+            batcher=batcher,
+            use_shell=job.use_shell,
+            on_start=self._started(job, on_start),
+        )
+
+    def cancel(self, job):
+        job.cancelled = True
+        if job.pid is not None:
+            stop_tree_later(job.pid, self.grace_s)
+
+    def shutdown(self):
+        pass
+
+
+def _pool_job(run_cmd, cwd_path, use_shell, msg_q):
+    """Runs in a worker of the pool, sends ("pid"|"data"|"exit"|"error", ...)"""
+    try:
+        my_process = subprocess.Popen(
+            run_cmd,
+            shell=use_shell,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=cwd_path,
+        )
+
+    except (IOError, OSError) as e:
+        msg_q.put(("error", str(e)))
+        return
+
+    msg_q.put(("pid", my_process.pid))
+    out_fd = my_process.stdout.fileno()
+    for chunk in iter(lambda: os.read(out_fd, CHUNK_SIZE), b""):
+        msg_q.put(("data", chunk))
+
+    my_process.stdout.close()
+    msg_q.put(("exit", my_process.wait()))
+
+
+class PoolExecutor(LocalExecutor):
+    """
+    Runs each job from one of << n_workers >> worker processes, their
+    output comes back through a queue
+    """
+
+    name = "pool"
+
+    def __init__(self, n_workers=2, grace_s=GRACE_S):
+        super(PoolExecutor, self).__init__(grace_s)
+        self.n_workers = max(1, n_workers)
+        self._pool = None
+        self._manager = None
+        self._lock = threading.Lock()
+
+    def _start_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # no fork of a process already running GUI threads
+                mp_ctx = multiprocessing.get_context("spawn")
+                self._manager = mp_ctx.Manager()
+                self._pool = mp_ctx.Pool(self.n_workers)
+
+    def run(self, job, batcher, on_start=None):
+        self._start_pool()
+        msg_q = self._manager.Queue()
+        async_result = self._pool.apply_async(
+            _pool_job, (job.run_cmd, job.cwd_path, job.use_shell, msg_q)
+        )
+        set_pid = self._started(job, on_start)
+        start_us = time.time() * 1e6
+        next_flush = time.time() + 1.0 / MAX_UI_RATE
+        while True:
+            try:
+                kind, value = msg_q.get(timeout=1.0 / MAX_UI_RATE)
+
+            except queue.Empty:
+                kind = None
+                if async_result.ready() and not async_result.successful():
+                    # raises what went wrong in the worker
+                    async_result.get()
+
+            if kind == "pid":
+                set_pid(value)
+
+            elif kind == "data":
+                batcher.feed(value)
+
+            elif kind == "error":
+                raise OSError(value)
+
+            elif kind == "exit":
+                break
+
+            if time.time() >= next_flush:
+                batcher.flush()
+                next_flush = time.time() + 1.0 / MAX_UI_RATE
+
+        batcher.finish()
+        batcher.flush()
+        tracer.process(cmd_name(job.run_cmd), job.pid, start_us, value)
+        return value
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._manager.shutdown()
+                self._pool = None
+
+
+class WarmWorker(object):
+    """One warm_worker.py process, running one job at a time"""
+
+    def __init__(self):
+        # unbuffered, the output streams while the command runs
+        self.proc = subprocess.Popen(
+            [sys.executable, "-u", os.path.abspath(warm_worker.__file__)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        self.pid = self.proc.pid
+        self.n_jobs = 0
+        self.rss_first = None
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def rss(self):
+        try:
+            return psutil.Process(self.pid).memory_info().rss
+
+        except psutil.Error:
+            return 0
+
+    def run(self, job, batcher):
+        """
+        Returns:
+            (int): exit status of the command, None if the worker died
+        """
+        token = uuid.uuid4().hex
+        end_mark = "{} {} ".format(warm_worker.END_MARK, token).encode("utf-8")
+        job_line = json.dumps(
+            {"argv": job.run_cmd, "cwd": job.cwd_path, "token": token}
+        )
+        try:
+            self.proc.stdin.write(job_line.encode("utf-8") + b"\n")
+            self.proc.stdin.flush()
+
+        except (IOError, OSError):
+            return None
+
+        out_fd = self.proc.stdout.fileno()
+        pending = b""
+        exit_status = None
+        next_flush = time.time() + 1.0 / MAX_UI_RATE
+        while True:
+            if select.select([out_fd], [], [], 1.0 / MAX_UI_RATE)[0]:
+                chunk = os.read(out_fd, CHUNK_SIZE)
+                if not chunk:
+                    # the worker is gone
+                    batcher.feed(pending)
+                    self.proc.wait()
+                    break
+
+                pending += chunk
+                mark_pos = pending.find(end_mark)
+                if mark_pos >= 0:
+                    line_end = pending.find(b"\n", mark_pos + len(end_mark))
+                    if line_end >= 0:
+                        batcher.feed(pending[:mark_pos])
+                        exit_status = int(pending[mark_pos + len(end_mark) : line_end])
+                        break
+
+                else:
+                    # only what may be the start of the end mark waits
+                    n_feed = pending.rfind(end_mark[:1])
+                    if n_feed < 0 or not end_mark.startswith(pending[n_feed:]):
+                        n_feed = len(pending)
+
+                    batcher.feed(pending[:n_feed])
+                    pending = pending[n_feed:]
+
+            if time.time() >= next_flush:
+                batcher.flush()
+                next_flush = time.time() + 1.0 / MAX_UI_RATE
+
+        batcher.finish()
+        batcher.flush()
+        self.n_jobs += 1
+        if self.rss_first is None:
+            self.rss_first = self.rss()
+
+        return exit_status
+
+    def worn_out(self, max_jobs, max_growth_mb):
+        if not self.alive() or self.n_jobs >= max_jobs:
+            return True
+
+        return self.rss() - self.rss_first > max_growth_mb * 1024 ** 2
+
+    def close(self):
+        if self.alive():
+            self.proc.stdin.close()
+            stop_tree(self.pid, grace_s=1.0)
+
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+class WarmExecutor(LocalExecutor):
+    """
+    Runs << dials.* >> commands in one of << n_workers >> warm workers,
+    started ahead of time, replaced after a crash, after << max_jobs >>
+    jobs or once they grew by << max_growth_mb >>. Anything else (shell
+    strings, other programs) runs like the local executor does.
+    """
+
+    name = "warm"
+
+    def __init__(
+        self,
+        n_workers=2,
+        grace_s=GRACE_S,
+        max_jobs=WARM_MAX_JOBS,
+        max_growth_mb=WARM_MAX_GROWTH_MB,
+    ):
+        super(WarmExecutor, self).__init__(grace_s)
+        self.n_workers = max(1, n_workers)
+        self.max_jobs = max_jobs
+        self.max_growth_mb = max_growth_mb
+        self._idle = queue.Queue()
+        self._n_alive = 0
+        self._lock = threading.Lock()
+        self.n_recycled = 0
+        for _ in range(self.n_workers):
+            self._add_worker()
+
+    def _add_worker(self):
+        with self._lock:
+            self._n_alive += 1
+
+        try:
+            self._idle.put(WarmWorker())
+
+        except OSError:
+            with self._lock:
+                self._n_alive -= 1
+
+            raise
+
+    def _retire(self, worker):
+        worker.close()
+        with self._lock:
+            self._n_alive -= 1
+            self.n_recycled += 1
+
+        self._add_worker()
+
+    @staticmethod
+    def can_run(job):
+        return (
+            os.name != "nt"
+            and not job.use_shell
+            and isinstance(job.run_cmd, list)
+            and job.run_cmd[0].startswith("dials.")
+        )
+
+    def run(self, job, batcher, on_start=None):
+        if not self.can_run(job):
+            return super(WarmExecutor, self).run(job, batcher, on_start)
+
+        worker = self._idle.get()
+        if not worker.alive():
+            self._retire(worker)
+            worker = self._idle.get()
+
+        start_us = time.time() * 1e6
+        self._started(job, on_start)(worker.pid)
+        try:
+            exit_status = worker.run(job, batcher)
+
+        finally:
+            if job.cancelled or worker.worn_out(self.max_jobs, self.max_growth_mb):
+                self._retire(worker)
+
+            else:
+                self._idle.put(worker)
+
+        if job.cancelled:
+            exit_status = CANCELLED_STATUS
+
+        elif exit_status is None:
+            logger.warning("warm worker %s died running %s", worker.pid, job.run_cmd)
+            exit_status = worker.proc.returncode or 1
+
+        tracer.process(cmd_name(job.run_cmd), worker.pid, start_us, exit_status)
+        return exit_status
+
+    def shutdown(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+
+            except queue.Empty:
+                return
+
+            worker.close()
+
+
+class SpoolDir(object):
+    """
+    Layout of a spool directory, a job << id >> moves through:
+
+        new/<id>.json    submitted
+        run/<id>.json    claimed by a worker (renamed, only one can)
+        out/<id>.log     output of the command, as it runs
+        done/<id>.json   {"exit_status": N}
+        cancel/<id>      cancel request
+    """
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        for sub_dir in ("new", "run", "out", "done", "cancel"):
+            if not os.path.isdir(os.path.join(dir_path, sub_dir)):
+                os.makedirs(os.path.join(dir_path, sub_dir))
+
+    def path(self, sub_dir, job_id):
+        ext = {"out": ".log", "cancel": ""}.get(sub_dir, ".json")
+        return os.path.join(self.dir_path, sub_dir, job_id + ext)
+
+    def write_json(self, sub_dir, job_id, json_dict):
+        final_path = self.path(sub_dir, job_id)
+        with open(final_path + ".tmp", "w") as json_out:
+            json.dump(json_dict, json_out)
+
+        os.replace(final_path + ".tmp", final_path)
+
+    def read_json(self, sub_dir, job_id):
+        with open(self.path(sub_dir, job_id)) as json_in:
+            return json.load(json_in)
+
+    def remove(self, sub_dir, job_id):
+        try:
+            os.remove(self.path(sub_dir, job_id))
+            return True
+
+        except OSError:
+            return False
+
+
+class SpoolExecutor(object):
+    """
+    Hands each job to the << dui-worker >> daemons watching << spool_dir >>
+    and follows its output file until the job is done
+    """
+
+    name = "spool"
+
+    def __init__(self, spool_dir):
+        self.spool = SpoolDir(spool_dir)
+        # ids of the jobs << run >> is following
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def run(self, job, batcher, on_start=None):
+        with self._lock:
+            self._active.add(job.job_id)
+
+        try:
+            return self._follow(job, batcher, on_start)
+
+        finally:
+            with self._lock:
+                self._active.discard(job.job_id)
+                self.spool.remove("cancel", job.job_id)
+
+    def _follow(self, job, batcher, on_start):
+        self.spool.write_json("new", job.job_id, job.to_dict())
+        out_path = self.spool.path("out", job.job_id)
+        offset = 0
+        started = False
+        while True:
+            if job.cancelled and self.spool.remove("new", job.job_id):
+                # cancelled before it was submitted, nobody took it
+                return CANCELLED_STATUS
+
+            is_done = os.path.isfile(self.spool.path("done", job.job_id))
+            if os.path.isfile(out_path):
+                if not started:
+                    started = True
+                    if on_start is not None:
+                        on_start(None)
+
+                with open(out_path, "rb") as out_in:
+                    out_in.seek(offset)
+                    chunk = out_in.read()
+
+                offset += len(chunk)
+                batcher.feed(chunk)
+                batcher.flush()
+
+            if is_done:
+                break
+
+            time.sleep(1.0 / MAX_UI_RATE)
+
+        batcher.finish()
+        batcher.flush()
+        exit_status = self.spool.read_json("done", job.job_id)["exit_status"]
+        for sub_dir in ("done", "out"):
+            self.spool.remove(sub_dir, job.job_id)
+
+        return exit_status
+
+    def cancel(self, job):
+        with self._lock:
+            job.cancelled = True
+            if job.job_id not in self._active:
+                # not submitted yet, or already over
+                return
+
+            if self.spool.remove("new", job.job_id):
+                # no worker claimed it, so none ever will
+                self.spool.write_json(
+                    "done", job.job_id, {"exit_status": CANCELLED_STATUS}
+                )
+                return
+
+            with open(self.spool.path("cancel", job.job_id), "w"):
+                pass
+
+    def shutdown(self):
+        pass
+
+
+class SpoolWorker(object):
+    """Daemon side of the spool, runs up to << n_jobs >> jobs at a time"""
+
+    def __init__(self, spool_dir, n_jobs=1, grace_s=GRACE_S):
+        self.spool = SpoolDir(spool_dir)
+        self.n_jobs = max(1, n_jobs)
+        self.grace_s = grace_s
+        self._running = {}
+        self._stopped = threading.Event()
+
+    def claim(self):
+        """Takes the oldest submitted job, None if there is none"""
+        for file_name in sorted(os.listdir(os.path.join(self.spool.dir_path, "new"))):
+            if not file_name.endswith(".json"):
+                continue
+
+            job_id = file_name[: -len(".json")]
+            try:
+                os.rename(
+                    self.spool.path("new", job_id), self.spool.path("run", job_id)
+                )
+
+            except OSError:
+                # another worker got it
+                continue
+
+            return job_id
+
+        return None
+
+    def run_job(self, job_id):
+        job_dict = self.spool.read_json("run", job_id)
+        exit_status = CANCELLED_STATUS
+        if not os.path.exists(self.spool.path("cancel", job_id)):
+            exit_status = self._run_cmd(job_id, job_dict)
+
+        self.spool.write_json("done", job_id, {"exit_status": exit_status})
+        self.spool.remove("run", job_id)
+        # seen, even if DUI is no longer there to clean it
+        self.spool.remove("cancel", job_id)
+
+    def _run_cmd(self, job_id, job_dict):
+        with open(self.spool.path("out", job_id), "wb") as out_file:
+            try:
+                my_process = subprocess.Popen(
+                    job_dict["run_cmd"],
+                    shell=job_dict["use_shell"],
+                    stdout=out_file,
+                    stderr=subprocess.STDOUT,
+                    cwd=job_dict["cwd_path"],
+                )
+
+            except (IOError, OSError) as e:
+                out_file.write(str(e).encode("utf-8") + b"\n")
+                return 127
+
+            while my_process.poll() is None:
+                if os.path.exists(self.spool.path("cancel", job_id)):
+                    # stop_tree may reap the process, so its status is lost
+                    stop_tree(my_process.pid, self.grace_s)
+                    my_process.wait()
+                    return CANCELLED_STATUS
+
+                time.sleep(SPOOL_POLL)
+
+            return my_process.wait()
+
+    def _job_thread(self, job_id):
+        try:
+            self.run_job(job_id)
+
+        finally:
+            del self._running[job_id]
+
+    def run_once(self):
+        """Starts as many claimed jobs as there are free slots"""
+        while len(self._running) < self.n_jobs:
+            job_id = self.claim()
+            if job_id is None:
+                return
+
+            job_thread = threading.Thread(target=self._job_thread, args=(job_id,))
+            self._running[job_id] = job_thread
+            job_thread.start()
+
+    def serve_forever(self):
+        while not self._stopped.wait(SPOOL_POLL):
+            self.run_once()
+
+        for job_thread in list(self._running.values()):
+            job_thread.join()
+
+    def stop(self):
+        self._stopped.set()
+
+
+_executor_cache = {}
+
+
+def get_executor(name="local", spool_dir=None, n_workers=2, grace_s=GRACE_S):
+    """The executor called << name >>, one of EXECUTOR_NAMES, made once"""
+    key = (name, spool_dir, n_workers, grace_s)
+    if key not in _executor_cache:
+        if name == "local":
+            _executor_cache[key] = LocalExecutor(grace_s)
+
+        elif name == "pool":
+            _executor_cache[key] = PoolExecutor(n_workers, grace_s)
+
+        elif name == "spool":
+            _executor_cache[key] = SpoolExecutor(spool_dir)
+
+        elif name == "warm":
+            _executor_cache[key] = WarmExecutor(n_workers, grace_s)
+
+        else:
+            raise ValueError(
+                "unknown executor {}, use one of {}".format(name, EXECUTOR_NAMES)
+            )
+
+    return _executor_cache[key]
+
+
+def shutdown_all():
+    for executor in _executor_cache.values():
+        executor.shutdown()
+
+
+def worker_main():
+    parser = argparse.ArgumentParser(
+        description="Runs the DIALS steps DUI puts in a spool directory",
+        usage="dui-worker [-h|--help] [-v] spool_dir=DIR [n_jobs=N] [grace_s=S]",
+    )
+    parser.add_argument("positionals", type=str, nargs="*", help=argparse.SUPPRESS)
+    parser.add_argument("--verbose", "-v", action="count", default=0)
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s"
+    )
+
+    spool_dir = None
+    n_jobs = 1
+    grace_s = GRACE_S
+    for arg in args.positionals:
+        if arg.startswith("spool_dir="):
+            spool_dir = os.path.abspath(arg[len("spool_dir=") :])
+
+        elif arg.startswith("n_jobs="):
+            n_jobs = int(arg[len("n_jobs=") :])
+
+        elif arg.startswith("grace_s="):
+            grace_s = float(arg[len("grace_s=") :])
+
+    if spool_dir is None:
+        parser.error("spool_dir=DIR is needed")
+
+    logger.info("running jobs of %s, %s at a time", spool_dir, n_jobs)
+    worker = SpoolWorker(spool_dir, n_jobs, grace_s)
+    try:
+        worker.serve_forever()
+
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    worker_main()
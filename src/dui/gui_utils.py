@@ -27,8 +27,8 @@ from collections import OrderedDict, namedtuple
 import logging
 import os
 import re
-import sys
 import shutil
+import sys
 import subprocess
 import psutil
 import json
@@ -41,7 +41,11 @@ from dxtbx.sweep_filenames import template_regex, template_regex_from_list
 
 try:
     from cli_utils import get_next_step, sys_arg, get_phil_par
+    from line_log import LineIndexedLog
     from m_idials import generate_report
+    from proc_engine import TAIL_LINES
+    from telemetry import telemetry_tip
+    from tracing import traced
     from qt import (
         QDialog,
         QFont,
@@ -57,6 +61,7 @@ try:
         QStyleFactory,
         Qt,
         QT5,
+        QTextCursor,
         QTextEdit,
         QThread,
         QToolButton,
@@ -69,7 +74,11 @@ try:
 
 except ImportError:
     from .cli_utils import get_next_step, sys_arg, get_phil_par
+    from .line_log import LineIndexedLog
     from .m_idials import generate_report
+    from .proc_engine import TAIL_LINES
+    from .telemetry import telemetry_tip
+    from .tracing import traced
     from .qt import (
         QDialog,
         QFont,
@@ -85,6 +94,7 @@ except ImportError:
         QStyleFactory,
         Qt,
         QT5,
+        QTextCursor,
         QTextEdit,
         QThread,
         QToolButton,
@@ -211,6 +221,7 @@ def try_move_last_info(export_node, gui2_log):
 
         gui2_log['pairs_list'].append((prev_step_rept_from, mtz_name_from))
 
+        # real copies, the user may edit or move these deliverables
         shutil.copy(mtz_name_from, mtz_name_to)
         shutil.copy(prev_step_rept_from, prev_step_rept_to)
 
@@ -224,32 +235,30 @@ def try_move_last_info(export_node, gui2_log):
         print("\n ___________________ gui2_log:", gui2_log, "\n")
 
 
-    except IOError:
+    except (IOError, OSError):
         print("ERROR: mtz file not there")
         logger.debug("IOError on try_move_last_info(gui_utils)")
 
     return gui2_log
 
-def try_find_prev_mask_pickle(cur_nod):
+def try_find_prev_mask_pickle(cur_nod, runner):
     pickle_path = None
-    my_node = cur_nod
-    while pickle_path is None:
-        my_node = my_node.prev_step
+    my_node = runner.find_ancestor(cur_nod, "find_spots")
+    while pickle_path is None and my_node is not None:
+        logger.debug("found find_spots")
         try:
-            if my_node.ll_command_lst[0][0] == "find_spots":
-                logger.debug("found find_spots")
-                for command in my_node.ll_command_lst[0]:
-                    if command.startswith("spotfinder.lookup.mask="):
-                        logger.debug("Found mask.pickle")
-                        logger.debug(my_node.ll_command_lst[0])
-                        pickle_path = command[23:]
-                        logger.debug("\n my_path = %s %s", pickle_path, "\n")
-                        if os.path.isfile(pickle_path):
-                            logger.debug("file is still there")
-
-                        else:
-                            logger.debug("file no longer there")
-                            pickle_path = None
+            for command in my_node.ll_command_lst[0]:
+                if command.startswith("spotfinder.lookup.mask="):
+                    logger.debug("Found mask.pickle")
+                    logger.debug(my_node.ll_command_lst[0])
+                    pickle_path = command[23:]
+                    logger.debug("\n my_path = %s %s", pickle_path, "\n")
+                    if os.path.isfile(pickle_path):
+                        logger.debug("file is still there")
+
+                    else:
+                        logger.debug("file no longer there")
+                        pickle_path = None
 
         except BaseException as e:
             # We don't want to catch bare exceptions but don't know
@@ -258,6 +267,8 @@ def try_find_prev_mask_pickle(cur_nod):
             logger.debug("not getting there")
             return None
 
+        my_node = runner.find_ancestor(my_node, "find_spots")
+
     return pickle_path
 
 
@@ -418,13 +429,20 @@ def join_path(file_in):
     return full_path
 
 
+@traced()
 def update_info(main_obj):
 
     main_obj.cli_tree_output(main_obj.idials_runner)
     main_obj.cur_html = main_obj.idials_runner.get_html_report()
 
     if main_obj.view_tab_num == 2:
-        main_obj.web_view.update_page(join_path(main_obj.cur_html))
+        if main_obj.cur_html is None and main_obj.info_jobs.is_pending(
+            main_obj.idials_runner.current_node, "report"
+        ):
+            main_obj.web_view.show_placeholder("Generating report ...")
+
+        else:
+            main_obj.web_view.update_page(join_path(main_obj.cur_html))
 
     new_log = main_obj.idials_runner.get_log_path()
 
@@ -560,6 +578,8 @@ class TreeNavWidget(QTreeView):
         else:
             header_view.setResizeMode(QHeaderView.ResizeToContents)
         header_view.setStretchLastSection(True)
+        # lin_num -> bytes the disk GC could free in the branch from there
+        self.reclaimable = {}
 
     def update_me(self, root_node, lst_path_idx):
         self.lst_idx = lst_path_idx
@@ -588,8 +608,26 @@ class TreeNavWidget(QTreeView):
                 else:
                     child_node_name = " ? None ? "
 
+                run_state = getattr(child_node, "run_state", None)
+                # nodes of a saved session are not loaded just to check
+                stalled = getattr(
+                    vars(child_node).get("dials_command"), "stalled", False
+                )
+                out_of_memory = child_node.success is False and getattr(
+                    vars(child_node).get("dials_command"), "out_of_memory", False
+                )
+                if stalled:
+                    child_node_name += "  [stalled]"
+
+                elif out_of_memory:
+                    child_node_name += "  [out of memory]"
+
+                elif run_state in ("queued", "running"):
+                    child_node_name += "  [" + run_state + "]"
+
                 try:
                     child_node_tip = build_command_tip(child_node.ll_command_lst)
+                    child_node_tip += telemetry_tip(child_node)
 
                 except BaseException as e:
                     # We don't want to catch bare exceptions but don't know
@@ -599,6 +637,11 @@ class TreeNavWidget(QTreeView):
                     )
                     child_node_tip = "None"
 
+                if self.reclaimable.get(child_node.lin_num):
+                    child_node_tip += "\n reclaimable in this branch: {:.1f} MB".format(
+                        self.reclaimable[child_node.lin_num] / 1024 ** 2
+                    )
+
                 new_item = QStandardItem(child_node_name)
                 new_item.setToolTip(child_node_tip)
                 new_item.idials_node = child_node
@@ -621,6 +664,14 @@ class TreeNavWidget(QTreeView):
                     elif child_node.success is False:
                         new_item.setForeground(Qt.red)
 
+                if run_state == "queued":
+                    new_item.setForeground(Qt.gray)
+                elif run_state == "running":
+                    new_item.setForeground(Qt.darkYellow)
+
+                if stalled:
+                    new_item.setForeground(Qt.magenta)
+
                 new_item.setEditable(False)  # not letting the user edit it
 
                 self.recursive_node(child_node, new_item)
@@ -788,10 +839,16 @@ class OuterCaller(QWidget):
 
 
 class CliOutView(QTextEdit):
+    # lines loaded each time the user scrolls to the top of the log
+    page_size = 2000
+
     def __init__(self, app=None):
         super(CliOutView, self).__init__()
         self.setFont(QFont("Monospace", 10, QFont.Bold))
         self.make_green()
+        self.paged_log = None
+        self.first_shown = 0
+        self.verticalScrollBar().valueChanged.connect(self.scrolled)
 
     def add_txt(self, str_to_print):
         try:
@@ -803,6 +860,36 @@ class CliOutView(QTextEdit):
             logger.debug("Caught unknown exception type %s: %s", type(e).__name__, e)
             logger.debug("unwritable char << %s %s", str_to_print, ">>")
 
+    def start_live(self):
+        """Clears the view for the output of a step about to run"""
+        self.clear()
+        self.make_green()
+        self.paged_log = None
+        self.first_shown = 0
+        # the whole output goes to the log file, only its tail is shown
+        self.document().setMaximumBlockCount(TAIL_LINES)
+
+    def scrolled(self, value):
+        if (
+            self.paged_log is not None
+            and self.first_shown > 0
+            and value == self.verticalScrollBar().minimum()
+        ):
+            self.show_previous_page()
+
+    def show_previous_page(self):
+        """Prepends the page of log before the first line shown"""
+        new_first = max(0, self.first_shown - self.page_size)
+        lst_lin = self.paged_log.get_lines(new_first, self.first_shown)
+        self.first_shown = new_first
+
+        scroll_bar = self.verticalScrollBar()
+        old_max = scroll_bar.maximum()
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.Start)
+        cursor.insertText("\n".join(lin.rstrip() for lin in lst_lin) + "\n")
+        scroll_bar.setValue(scroll_bar.maximum() - old_max)
+
     def make_red(self):
         logger.debug("turning log fonts to RED")
         style_orign = "color: rgba(220, 0, 0, 255)"
@@ -818,6 +905,7 @@ class CliOutView(QTextEdit):
         style_orign = "color: rgba(0, 0, 125, 255)"
         self.setStyleSheet(style_orign)
 
+    @traced("CliOutView.refresh_txt")
     def refresh_txt(self, path_to_log, curr_step=None):
         success = curr_step.success
 
@@ -831,22 +919,34 @@ class CliOutView(QTextEdit):
 
         logger.debug(" path_to_log = %s", path_to_log)
 
-        try:
-            fil_obj = open(path_to_log, "r")
-            lst_lin = fil_obj.readlines()
-        except BaseException as e:
-            # We don't want to catch bare exceptions but don't know
-            # what this was supposed to catch. Log it.
-            logger.debug("Caught unknown exception type %s: %s", type(e).__name__, e)
+        # only the last page is read, older ones come when scrolling up
+        scroll_bar = self.verticalScrollBar()
+        scroll_bar.blockSignals(True)
+        self.document().setMaximumBlockCount(0)
+        self.paged_log = LineIndexedLog.open_existing(path_to_log)
+        if getattr(curr_step, "run_state", None) in ("queued", "running"):
+            # running in the background, its log file is still being written
+            self.paged_log = None
+            lst_lin = curr_step.dials_command.live_tail()
+            self.first_shown = 0
+            self.document().setMaximumBlockCount(TAIL_LINES)
+
+        elif self.paged_log is None:
             logger.debug("Failed to read log file")
             lst_lin = ["Ready to Run:"]
+            self.first_shown = 0
             self.make_green()
 
+        else:
+            self.first_shown = max(0, len(self.paged_log) - self.page_size)
+            lst_lin = self.paged_log.get_lines(self.first_shown, len(self.paged_log))
+
         self.clear()
         logger.debug("success = %s %s", success, "refresh_txt")
 
-        for lin in lst_lin:
-            self.add_txt(lin)
+        self.setPlainText("\n".join(lin.rstrip() for lin in lst_lin))
+        scroll_bar.setValue(scroll_bar.maximum())
+        scroll_bar.blockSignals(False)
 
 
 class Text_w_Bar(QProgressBar):
@@ -867,6 +967,8 @@ class Text_w_Bar(QProgressBar):
             logger.debug("Failed to setStyle()")
 
     def setText(self, text):
+        # output of steps comes in batches of lines, the last one is shown
+        text = text.rsplit("\n", 1)[-1]
         if len(text) > 2:
             self._text = text
             self.repaint()
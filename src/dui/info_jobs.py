@@ -0,0 +1,153 @@
+"""
+Background generation of reports and predictions of DUI's nodes
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import heapq
+import itertools
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# kinds of job, with the node attribute each one fills
+JOB_KINDS = {"report": "report_out", "predict": "predict_pickle_out"}
+
+# lower runs first
+URGENT = 0
+PREFETCH = 10
+
+
+class InfoJobQueue(object):
+    """
+    Runs << node.gen_repr_n_pred(kind) >> in worker threads, nodes the user
+    is looking at (urgent) before the ones prefetched after each run
+
+    A (node, kind) pair is only run once, asking again for a queued job
+    just raises its priority. << on_done(lin_num, kind) >> is called from
+    the worker thread when a job ends.
+    """
+
+    def __init__(self, n_workers=1, on_done=None):
+        self.on_done = on_done
+        self._heap = []
+        self._priority = {}
+        self._running = set()
+        self._done = set()
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._workers = []
+        for _ in range(max(1, n_workers)):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    @staticmethod
+    def is_ready(node, kind):
+        return getattr(node, JOB_KINDS[kind], None) is not None
+
+    def is_pending(self, node, kind):
+        with self._cond:
+            key = (node.lin_num, kind)
+            return key in self._priority or key in self._running
+
+    def request(self, node, kind, priority=URGENT):
+        """Queues << kind >> for << node >> unless done, queued or running"""
+        if node.success is not True or self.is_ready(node, kind):
+            return False
+
+        key = (node.lin_num, kind)
+        with self._cond:
+            if key in self._done:
+                return False
+
+            if key in self._running:
+                return True
+
+            if key in self._priority and self._priority[key] <= priority:
+                return True
+
+            # an older entry with lower priority stays in the heap, it
+            # gets skipped when popped
+            self._priority[key] = priority
+            heapq.heappush(self._heap, (priority, next(self._counter), key, node))
+            self._cond.notify()
+
+        return True
+
+    def prefetch(self, node):
+        """Queues every kind of job for a node that just succeeded"""
+        for kind in JOB_KINDS:
+            self.request(node, kind, priority=PREFETCH)
+
+    def _pop(self):
+        """Next job to run or None when stopped, must hold the lock"""
+        while True:
+            while not self._heap and not self._stopped:
+                self._cond.wait()
+
+            if self._stopped:
+                return None
+
+            priority, _, key, node = heapq.heappop(self._heap)
+            if self._priority.get(key) == priority:
+                del self._priority[key]
+                self._running.add(key)
+                return key, node
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._pop()
+
+            if job is None:
+                return
+
+            key, node = job
+            try:
+                if not self.is_ready(node, key[1]):
+                    node.gen_repr_n_pred(to_run=key[1])
+
+            except Exception as e:
+                logger.warning("%s of node %s failed: %s", key[1], key[0], e)
+
+            with self._cond:
+                self._running.discard(key)
+                self._done.add(key)
+
+            if self.on_done is not None:
+                self.on_done(key[0], key[1])
+
+    def forget(self, lin_num, kind):
+        """Lets a job run again, after its output got deleted"""
+        with self._cond:
+            self._done.discard((lin_num, kind))
+
+    def shutdown(self):
+        """Forgets queued jobs, running ones finish in their threads"""
+        with self._cond:
+            self._stopped = True
+            self._heap = []
+            self._priority.clear()
+            self._cond.notify_all()
@@ -0,0 +1,173 @@
+"""
+Text files with a sparse line-offset index, for outputs too big to keep
+in memory (DIALS logs can reach hundreds of thousands of lines)
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+from array import array
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# one offset is kept every << INDEX_STRIDE >> lines
+INDEX_STRIDE = 64
+
+
+class LineIndexedLog(object):
+    """
+    Append-only text file, readable by line number without loading it
+
+    The index (<< path >>.idx) holds the number of lines, the stride and
+    the byte offset of every INDEX_STRIDE-th line. If it is missing or
+    does not match the file, it gets rebuilt by scanning the file once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.idx_path = path + ".idx"
+        self.n_lines = 0
+        self.offsets = array("Q")
+        self._size = 0
+        self._log_out = None
+
+    def __len__(self):
+        return self.n_lines
+
+    def open_new(self):
+        """Starts an empty log, replacing any previous one"""
+        self.close()
+        self._log_out = open(self.path, "wb")
+        self.n_lines = 0
+        self._size = 0
+        del self.offsets[:]
+        if os.path.isfile(self.idx_path):
+            os.remove(self.idx_path)
+
+    def append(self, line):
+        """Appends one line, given as bytes or text without its line end"""
+        if not isinstance(line, bytes):
+            line = line.encode("utf-8", "replace")
+
+        if self.n_lines % INDEX_STRIDE == 0:
+            self.offsets.append(self._size)
+
+        self._log_out.write(line + b"\n")
+        self._size += len(line) + 1
+        self.n_lines += 1
+
+    def flush(self):
+        if self._log_out is not None:
+            self._log_out.flush()
+
+    def close(self):
+        if self._log_out is None:
+            return
+
+        self._log_out.close()
+        self._log_out = None
+        self._write_index()
+
+    def _write_index(self):
+        header = array("Q", [self.n_lines, INDEX_STRIDE, self._size])
+        with open(self.idx_path, "wb") as idx_out:
+            header.tofile(idx_out)
+            self.offsets.tofile(idx_out)
+
+    def _read_index(self):
+        try:
+            with open(self.idx_path, "rb") as idx_in:
+                raw = idx_in.read()
+
+        except (IOError, OSError):
+            return False
+
+        tmp_arr = array("Q")
+        try:
+            tmp_arr.frombytes(raw)
+
+        except ValueError:
+            return False
+
+        if len(tmp_arr) < 3 or tmp_arr[1] != INDEX_STRIDE:
+            return False
+
+        if tmp_arr[2] != os.path.getsize(self.path):
+            # file changed since the index was written
+            return False
+
+        self.n_lines, self._size = tmp_arr[0], tmp_arr[2]
+        self.offsets = tmp_arr[3:]
+        return True
+
+    def _build_index(self):
+        self.n_lines = 0
+        self._size = 0
+        del self.offsets[:]
+        with open(self.path, "rb") as log_in:
+            for line in log_in:
+                if self.n_lines % INDEX_STRIDE == 0:
+                    self.offsets.append(self._size)
+
+                self._size += len(line)
+                self.n_lines += 1
+
+    @classmethod
+    def open_existing(cls, path):
+        """Opens a log for reading, returns None if there is no such file"""
+        if path is None or not os.path.isfile(path):
+            return None
+
+        new_log = cls(path)
+        if not new_log._read_index():
+            logger.debug("indexing %s", path)
+            new_log._build_index()
+            try:
+                new_log._write_index()
+
+            except (IOError, OSError):
+                logger.debug("could not save index of %s", path)
+
+        return new_log
+
+    def get_lines(self, start, stop):
+        """Lines [start, stop) as text, without line ends"""
+        start = max(0, start)
+        stop = min(stop, self.n_lines)
+        if start >= stop:
+            return []
+
+        self.flush()
+        lst_lin = []
+        with open(self.path, "rb") as log_in:
+            log_in.seek(self.offsets[start // INDEX_STRIDE])
+            for _ in range(start % INDEX_STRIDE):
+                log_in.readline()
+
+            for _ in range(stop - start):
+                line = log_in.readline()
+                lst_lin.append(line.rstrip(b"\r\n").decode("utf-8", "replace"))
+
+        return lst_lin
+
+    def tail(self, n_lines):
+        return self.get_lines(self.n_lines - n_lines, self.n_lines)
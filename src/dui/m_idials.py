@@ -26,9 +26,9 @@ from __future__ import absolute_import, division, print_function
 
 import logging
 import os
-import pickle
 import shutil
 import sys
+import threading
 
 from six.moves import input
 
@@ -47,6 +47,7 @@ try:
         get_next_step,
         generate_predict,
     )
+    from tracing import traced
 
 except ImportError:
     #else:
@@ -59,9 +60,14 @@ except ImportError:
         get_next_step,
         generate_predict,
     )
+    from .tracing import traced
 
 logger = logging.getLogger(__name__)
 
+# one node of a saved session loads its details at a time, the GUI and the
+# threads running branches may touch the same lazy node together
+_details_lock = threading.RLock()
+
 
 class CommandNode(object):
     dials_com_lst = [
@@ -95,11 +101,52 @@ class CommandNode(object):
         self.json_sym_out = None
         self.info_generating = None
         self.cmd_lst_to_run = [[None]]
+        self.run_state = None
+        self.telemetry = None
 
         self.dials_command = DialsCommand()
         # self.work_dir = os.getcwd()
 
-    def __call__(self, cmd_lst, ref_to_class):
+    @classmethod
+    def lazy(cls, prev_step, lin_num, ll_command_lst, success, details_loader):
+        """
+        Node from a saved session holding only its place in the tree,
+        << details_loader(node) >> sets everything else on first access
+        """
+        node = cls.__new__(cls)
+        node.lin_num = lin_num
+        node.next_step_list = []
+        node.prev_step = prev_step
+        node.ll_command_lst = ll_command_lst
+        node.success = success
+        node.info_generating = False
+        node.run_state = None
+        node.details_loader = details_loader
+        return node
+
+    def __getattr__(self, name):
+        # only called for attributes not (yet) in the instance
+        if name.startswith("__") or "details_loader" not in self.__dict__:
+            raise AttributeError(name)
+
+        with _details_lock:
+            # None once loaded, or while this same thread is loading
+            loader = self.__dict__.get("details_loader")
+            if loader is not None:
+                self.details_loader = None
+                loader(self)
+
+        return object.__getattribute__(self, name)
+
+    def __getstate__(self):
+        if self.__dict__.get("details_loader") is not None:
+            self.__getattr__("dials_command")
+
+        state = self.__dict__.copy()
+        state.pop("details_loader", None)
+        return state
+
+    def __call__(self, cmd_lst, ref_to_class, step_cache=None):
         #print("\n cmd_lst in =", cmd_lst)
         self.ll_command_lst = list(cmd_lst)
         if cmd_lst == ["fail"]:
@@ -111,31 +158,38 @@ class CommandNode(object):
             if cmd_lst[0][0] in self.dials_com_lst:
                 self.build_command(cmd_lst)
                 #print("Running:", self.cmd_lst_to_run)
-                self.success = self.dials_command(
-                    lst_cmd_to_run=self.cmd_lst_to_run, ref_to_class=ref_to_class
+                cwd_path = os.path.join(sys_arg.directory, "dui_files")
+                out_path = os.path.join(
+                    cwd_path,
+                    str(self.lin_num) + "_" + self.cmd_lst_to_run[0][0] + "_out.log",
                 )
-                if self.log_file_out is None:
-                    print("\n *** time to write ...log_file_out manually *** \n")
-
-                    self.log_file_out = (
-                        str(self.lin_num) + "_" + self.cmd_lst_to_run[0][0] + ".log"
+                if step_cache is not None and step_cache.fetch(
+                    self, cwd_path, out_path
+                ):
+                    self.dials_command.full_cmd_lst = list(self.cmd_lst_to_run)
+                    self.success = True
+                    try:
+                        ref_to_class.emit_print_signal(
+                            "reused results of an identical previous run"
+                        )
+
+                    except AttributeError:
+                        print("\n reused results of an identical previous run")
+
+                else:
+                    self.success = self.dials_command(
+                        lst_cmd_to_run=self.cmd_lst_to_run,
+                        ref_to_class=ref_to_class,
+                        out_path=out_path,
                     )
+                    self.telemetry = self.dials_command.telemetry
+                    if self.success is True and step_cache is not None:
+                        step_cache.store(self, cwd_path, out_path)
 
-                    cwd_path = os.path.join(sys_arg.directory, "dui_files")
-                    file_path = os.path.join(cwd_path, self.log_file_out)
-
-                    print("..log_file_out =", file_path, "\n")
-                    print(
-                        "self.dials_command.tmp_std_all:",
-                        self.dials_command.tmp_std_all,
-                    )
-
-                    fil_obj = open(file_path, "w")
-                    for line_out in self.dials_command.tmp_std_all:
-                        fil_obj.write(line_out)
-                        fil_obj.write("\n")
-
-                    fil_obj.close()
+                if self.log_file_out is None:
+                    # the captured output is the only log of this step
+                    self.log_file_out = os.path.basename(out_path)
+                    print("..log_file_out =", out_path, "\n")
 
                 print("\n Done \n")
                 #self.gen_repr_n_pred()
@@ -147,6 +201,7 @@ class CommandNode(object):
 
         self.info_generating = False
 
+    @traced()
     def gen_repr_n_pred(self, to_run = None):
         if (
             self.success is True
@@ -189,6 +244,11 @@ class Runner(object):
         root_node.success = True
         root_node.ll_command_lst = [["Root"]]
         self.step_list = [root_node]
+        self.node_dict = {root_node.lin_num: root_node}
+        self.journal = None
+        self.step_cache = None
+        self.lock = threading.RLock()
+        self._reset_lookup_cache()
         self.bigger_lin = 0
         self.current_line = self.bigger_lin
         self.create_step(root_node)
@@ -196,6 +256,25 @@ class Runner(object):
         print("root_node.lin_num = %s", root_node.lin_num)
         # self.current_node = root_node
 
+    @classmethod
+    def from_nodes(cls, step_list, current_line, bigger_lin):
+        """Rebuilds a Runner around already linked nodes, Root first"""
+        runner = cls.__new__(cls)
+        runner.step_list = list(step_list)
+        runner.node_dict = {node.lin_num: node for node in runner.step_list}
+        runner.journal = None
+        runner.step_cache = None
+        runner.lock = threading.RLock()
+        runner._reset_lookup_cache()
+        runner.bigger_lin = bigger_lin
+        runner.current_node = runner.step_list[-1]
+        runner.goto(current_line)
+        return runner
+
+    def _journal(self, op, node=None, **extra):
+        if self.journal is not None:
+            self.journal.log(op, node, **extra)
+
     def run(self, command, ref_to_class):
         if type(command) is str:
             cmd_lst = command.split()
@@ -206,12 +285,14 @@ class Runner(object):
         if cmd_lst[0] == "goto":
             print("doing << goto >>")
             self.goto(int(cmd_lst[1]))
+            self._journal("goto")
 
         elif cmd_lst == ["clean"]:
             self.clean()
 
         elif cmd_lst == ["mkchi"]:
             self.create_step(self.current_node)
+            self._journal("mkchi", self.current_node)
 
         elif cmd_lst == ["mksib"]:
             old_command_lst = list(self.current_node.ll_command_lst)
@@ -219,45 +300,124 @@ class Runner(object):
             print("forking")
             self.create_step(self.current_node)
             self.current_node.edit_list(old_command_lst)
+            self._journal("mksib", self.current_node)
 
         else:
             if self.current_node.success is True:
                 self.goto_prev()
                 print("forking")
                 self.create_step(self.current_node)
+                self._journal("mkchi", self.current_node)
 
-            self.current_node(cmd_lst, ref_to_class)
+            self.run_node(self.current_node, cmd_lst, ref_to_class)
             if self.current_node.success is not True:
                 print("failed step")
 
+    def run_node(self, node, cmd_lst, ref_to_class):
+        """
+        Runs << cmd_lst >> on any node of the tree, not only the current
+        one, several nodes can run at the same time from different threads
+        """
+        node(cmd_lst, ref_to_class, self.step_cache)
+        with self.lock:
+            self.tree_changed()
+            self._journal("run", node)
+
+    def __getstate__(self):
+        # the lookup caches are cheap to rebuild, no need to pickle them
+        state = self.__dict__.copy()
+        state.pop("_path_cache", None)
+        state.pop("_ancestor_cache", None)
+        state.pop("journal", None)
+        state.pop("step_cache", None)
+        state.pop("lock", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "node_dict" not in state:
+            # bkp.pickle written before the node index existed
+            self.node_dict = {node.lin_num: node for node in self.step_list}
+
+        self.journal = None
+        self.step_cache = None
+        self.lock = threading.RLock()
+        self._reset_lookup_cache()
+
+    def _reset_lookup_cache(self):
+        self._path_cache = {}
+        self._ancestor_cache = {}
+
+    def tree_changed(self):
+        """
+        Invalidates memoized paths and ancestor lookups, must be called
+        whenever nodes are added, removed or re-labelled
+        """
+        with self.lock:
+            self._reset_lookup_cache()
+
     def clean(self):
         logger.debug("\n Cleaning")
         logger.debug("self.current_line = %s", self.current_line)
 
         lst_to_rm = []
 
-        for node in self.step_list:
-            if (
-                node != self.current_node
-                and node.success is None
-                # TODO test further if the next line needs removing
-                # and len(node.prev_step.next_step_list) > 1
-            ):
-                lst_to_rm.append(node)
-
-        for node in lst_to_rm:
-            node.prev_step.next_step_list.remove(node)
-            self.step_list.remove(node)
+        with self.lock:
+            for node in self.step_list:
+                if (
+                    node != self.current_node
+                    and node.success is None
+                    and getattr(node, "run_state", None) is None
+                    # TODO test further if the next line needs removing
+                    # and len(node.prev_step.next_step_list) > 1
+                ):
+                    lst_to_rm.append(node)
+
+            # one pass over the tree, not a list.remove per removed node
+            set_rm = set(node.lin_num for node in lst_to_rm)
+            for parent in set(node.prev_step for node in lst_to_rm):
+                parent.next_step_list = [
+                    child
+                    for child in parent.next_step_list
+                    if child.lin_num not in set_rm
+                ]
+
+            self.step_list = [
+                node for node in self.step_list if node.lin_num not in set_rm
+            ]
+            for lin_num in set_rm:
+                del self.node_dict[lin_num]
+
+            if lst_to_rm:
+                self.tree_changed()
+
+            self._journal("clean", removed=[node.lin_num for node in lst_to_rm])
 
         logger.debug("self.current_line = %s %s", self.current_line, "\n")
 
     def create_step(self, prev_step):
         new_step = CommandNode(prev_step=prev_step)
-        self.bigger_lin += 1
-        new_step.lin_num = self.bigger_lin
-        prev_step.next_step_list.append(new_step)
-        self.step_list.append(new_step)
-        self.goto(self.bigger_lin)
+        with self.lock:
+            self.bigger_lin += 1
+            new_step.lin_num = self.bigger_lin
+            prev_step.next_step_list.append(new_step)
+            self.step_list.append(new_step)
+            self.node_dict[new_step.lin_num] = new_step
+            self.goto(self.bigger_lin)
+
+    def add_branch(self, prev_step):
+        """
+        Creates a new empty child of << prev_step >> without moving the
+        current node, returns the new node
+        """
+        with self.lock:
+            old_lin = self.current_line
+            self.create_step(prev_step)
+            new_step = self.current_node
+            self.goto(old_lin)
+            self._journal("mkchi", new_step)
+
+        return new_step
 
     def goto_prev(self):
         try:
@@ -271,14 +431,79 @@ class Runner(object):
 
     def goto(self, new_lin):
         self.current_line = new_lin
+        try:
+            self.current_node = self.node_dict[new_lin]
 
-        for node in self.step_list:
-            if node.lin_num == self.current_line:
-                self.current_node = node
+        except KeyError:
+            logger.debug("no node with lin_num = %s", new_lin)
 
     def get_current_node(self):
         return self.current_node
 
+    def get_node(self, lin_num):
+        return self.node_dict.get(lin_num)
+
+    def get_ancestor_path(self, node=None):
+        """
+        List of nodes going from Root down to << node >> (included),
+        memoized until the next tree_changed()
+        """
+        with self.lock:
+            if node is None:
+                node = self.current_node
+
+            try:
+                return self._path_cache[node.lin_num]
+
+            except KeyError:
+                pass
+
+            lst_path = []
+            tmp_cur = node
+            while tmp_cur is not None:
+                lst_path.append(tmp_cur)
+                tmp_cur = tmp_cur.prev_step
+
+            lst_path.reverse()
+            self._path_cache[node.lin_num] = lst_path
+            return lst_path
+
+    def find_ancestor(self, node, command):
+        """
+        Nearest node above << node >> (excluded) running << command >>,
+        memoized until the next tree_changed()
+        """
+        with self.lock:
+            key = (node.lin_num, command)
+            try:
+                return self._ancestor_cache[key]
+
+            except KeyError:
+                pass
+
+            lst_visited = [key]
+            found = None
+            tmp_cur = node.prev_step
+            while tmp_cur is not None:
+                if tmp_cur.ll_command_lst[0][0] == command:
+                    found = tmp_cur
+                    break
+
+                # a node not running << command >> shares the answer of
+                # every node below it on the way up
+                tmp_key = (tmp_cur.lin_num, command)
+                if tmp_key in self._ancestor_cache:
+                    found = self._ancestor_cache[tmp_key]
+                    break
+
+                lst_visited.append(tmp_key)
+                tmp_cur = tmp_cur.prev_step
+
+            for tmp_key in lst_visited:
+                self._ancestor_cache[tmp_key] = found
+
+            return found
+
     def get_html_report(self):
 
         try:
@@ -293,25 +518,50 @@ class Runner(object):
         return html_rep
 
     def get_datablock_path(self):
+        with self.lock:
+            # the current node can still be edited, so only the answers
+            # of the nodes above it are taken from the cache
+            tmp_cur = self.current_node
+            found, path_to_json = self._datablock_step(tmp_cur)
+            if found:
+                return path_to_json
+
+            lst_visited = []
+            tmp_cur = tmp_cur.prev_step
+            while tmp_cur is not None:
+                key = (tmp_cur.lin_num, "<datablock>")
+                if key in self._ancestor_cache:
+                    path_to_json = self._ancestor_cache[key]
+                    break
 
-        tmp_cur = self.current_node
-        path_to_json = None
+                lst_visited.append(key)
+                found, path_to_json = self._datablock_step(tmp_cur)
+                if found:
+                    break
 
-        while True:
-            if tmp_cur.ll_command_lst[0] == [None]:
                 tmp_cur = tmp_cur.prev_step
 
-            elif tmp_cur.success is True and tmp_cur.ll_command_lst[0][0] == "import":
-                path_to_json = tmp_cur.json_file_out
-                break
+            for key in lst_visited:
+                self._ancestor_cache[key] = path_to_json
 
-            elif tmp_cur.ll_command_lst[0][0] == "Root" or tmp_cur.success is False:
-                break
+            return path_to_json
 
-            else:
-                tmp_cur = tmp_cur.prev_step
+    @staticmethod
+    def _datablock_step(tmp_cur):
+        """
+        One step of the walk up looking for the imported experiments,
+        returns (stop_here, path_to_json)
+        """
+        if tmp_cur.ll_command_lst[0] == [None]:
+            return False, None
 
-        return path_to_json
+        elif tmp_cur.success is True and tmp_cur.ll_command_lst[0][0] == "import":
+            return True, tmp_cur.json_file_out
+
+        elif tmp_cur.ll_command_lst[0][0] == "Root" or tmp_cur.success is False:
+            return True, None
+
+        return False, None
 
     def get_log_path(self):
 
@@ -387,16 +637,23 @@ class Runner(object):
 
 if __name__ == "__main__" and __package__ is None:
 
+    from session_journal import SessionJournal
+    from session_format import load_legacy_pickle
+
     tree_output = TreeShow()
     storage_path = sys_arg.directory
+    session_journal = SessionJournal(storage_path + "/dui_files")
 
     try:
-        with open(storage_path + "/dui_files/bkp.pickle", "rb") as bkp_in:
-            idials_runner = pickle.load(bkp_in)
+        if SessionJournal.exists(storage_path + "/dui_files"):
+            idials_runner = session_journal.load()
+            fresh_session = False
 
-        # TODO sometimes the following error appears
-        # Attribute not found
-        # 'module' object has no attribute 'CommandNode'
+        else:
+            idials_runner = load_legacy_pickle(
+                storage_path + "/dui_files/bkp.pickle"
+            )
+            fresh_session = True
 
     except Exception as e:
         print("str(e) = %s", str(e))
@@ -410,7 +667,9 @@ if __name__ == "__main__" and __package__ is None:
             print('failed to do "shutil.rmtree("/dui_files")"')
 
         os.mkdir(storage_path + "/dui_files")
+        fresh_session = True
 
+    session_journal.attach(idials_runner, fresh=fresh_session)
     tree_output(idials_runner)
 
     command = ""
@@ -422,6 +681,7 @@ if __name__ == "__main__" and __package__ is None:
         except EOFError:
             print("Caught << EOFError >>")
             print(" ... interrupting")
+            session_journal.close()
             sys.exit(0)
 
         except:
@@ -441,5 +701,4 @@ if __name__ == "__main__" and __package__ is None:
             idials_runner.run(["mkchi"], None)
             tree_output(idials_runner)
 
-        with open(storage_path + "/dui_files/bkp.pickle", "wb") as bkp_out:
-            pickle.dump(idials_runner, bkp_out)
+    session_journal.close()
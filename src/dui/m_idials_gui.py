@@ -24,7 +24,6 @@ from __future__ import absolute_import, division, print_function
 
 import logging
 import os
-import pickle
 import traceback
 import time
 
@@ -42,7 +41,6 @@ try:
         OuterCaller,
         update_info,
         update_pbar_msg,
-        kill_w_child,
         TreeNavWidget,
         ACTIONS,
         MyActionButton,
@@ -51,6 +49,17 @@ try:
         get_main_path,
     )
     from m_idials import Runner
+    from branch_scheduler import BranchScheduler, DONE, FAILED
+    from param_sweep import ParamSweep
+    from sweep_gui import SweepDialog
+    from step_cache import cache_for_session
+    from info_jobs import InfoJobQueue
+    from disk_gc import DiskGC
+    from dedupe import Deduper
+    from tracing import tracer
+    from executors import shutdown_all as shutdown_executors
+    from session_journal import SessionJournal
+    from session_format import load_legacy_pickle
     from outputs_n_viewers.web_page_view import WebTab
     from outputs_n_viewers.img_view_tools import ProgBarBox
     from outputs_n_viewers.img_viewer import MyImgWin
@@ -60,6 +69,7 @@ try:
         QIcon,
         QMainWindow,
         QModelIndex,
+        QObject,
         QPushButton,
         QScrollArea,
         QSize,
@@ -86,7 +96,6 @@ except ImportError:
         OuterCaller,
         update_info,
         update_pbar_msg,
-        kill_w_child,
         TreeNavWidget,
         ACTIONS,
         MyActionButton,
@@ -95,6 +104,17 @@ except ImportError:
         get_main_path,
     )
     from .m_idials import Runner
+    from .branch_scheduler import BranchScheduler, DONE, FAILED
+    from .param_sweep import ParamSweep
+    from .sweep_gui import SweepDialog
+    from .step_cache import cache_for_session
+    from .info_jobs import InfoJobQueue
+    from .disk_gc import DiskGC
+    from .dedupe import Deduper
+    from .tracing import tracer
+    from .executors import shutdown_all as shutdown_executors
+    from .session_journal import SessionJournal
+    from .session_format import load_legacy_pickle
     from .outputs_n_viewers.web_page_view import WebTab
     from .outputs_n_viewers.img_view_tools import ProgBarBox
     from .outputs_n_viewers.img_viewer import MyImgWin
@@ -104,6 +124,7 @@ except ImportError:
         QIcon,
         QMainWindow,
         QModelIndex,
+        QObject,
         QPushButton,
         QScrollArea,
         QSize,
@@ -155,6 +176,7 @@ class CommandThread(QThread):
 
     str_print_signal = Signal(str)
     str_fail_signal = Signal()
+    stall_signal = Signal(bool)
     busy_box_on = Signal(str)
     busy_box_off = Signal()
 
@@ -182,6 +204,9 @@ class CommandThread(QThread):
     def emit_fail_signal(self):
         self.str_fail_signal.emit()
 
+    def emit_stall_signal(self, stalled):
+        self.stall_signal.emit(stalled)
+
     def pop_busy_box(self):
         logger.debug("emiting pop busy box signal")
         self.busy_box_on.emit("Getting Predictions or Report")
@@ -191,6 +216,30 @@ class CommandThread(QThread):
         self.busy_box_off.emit()
 
 
+class BranchSignals(QObject):
+    """
+    Brings the callbacks of the BranchScheduler, called from its worker
+    threads, into the GUI thread
+    """
+
+    state_changed = Signal(int)
+    output = Signal(int, str)
+    info_done = Signal(int, str)
+    gc_done = Signal(object)
+
+    def emit_state_changed(self, lin_num):
+        self.state_changed.emit(lin_num)
+
+    def emit_output(self, lin_num, str_lin):
+        self.output.emit(lin_num, str_lin)
+
+    def emit_info_done(self, lin_num, kind):
+        self.info_done.emit(lin_num, kind)
+
+    def emit_gc_done(self, summary):
+        self.gc_done.emit(summary)
+
+
 class ControlWidget(QWidget):
     """Primarily, the action button widget.
 
@@ -430,6 +479,22 @@ class StopRunRetry(QWidget):
         self.run_btn.setIconSize(QSize(50, 38))
         ctrl_box.addWidget(self.run_btn)
 
+        self.queue_btn = QPushButton("\n Queue \n", self)
+        self.queue_btn.setToolTip(
+            "Run in the background, the tree stays usable meanwhile"
+        )
+        self.queue_btn.setIcon(tmp_ico)
+        self.queue_btn.setIconSize(QSize(50, 38))
+        ctrl_box.addWidget(self.queue_btn)
+
+        self.sweep_btn = QPushButton("\n Sweep \n", self)
+        self.sweep_btn.setToolTip(
+            "Run this step once per combination of a grid of parameters"
+        )
+        self.sweep_btn.setIcon(tmp_ico)
+        self.sweep_btn.setIconSize(QSize(50, 38))
+        ctrl_box.addWidget(self.sweep_btn)
+
         self.stop_btn = QPushButton("\n  Stop  \n", self)
         stop_logo_path = str(main_path + "/resources/stop.png")
         stop_grayed_path = str(main_path + "/resources/stop_grayed.png")
@@ -449,9 +514,13 @@ class DUIDataLoadingError(Exception):
         self.original_traceback = original
 
 
-def load_previous_state(dui_files_path):
-    with open(os.path.join(dui_files_path, "bkp.pickle"), "rb") as bkp_in:
-        return pickle.load(bkp_in)
+def load_previous_state(dui_files_path, session_journal):
+    if SessionJournal.exists(dui_files_path):
+        return session_journal.load()
+
+    # sessions saved before the journal existed, once loaded they get
+    # migrated to the new format by SessionJournal.attach
+    return load_legacy_pickle(os.path.join(dui_files_path, "bkp.pickle"))
 
 
 class MainWidget(QMainWindow):
@@ -465,10 +534,14 @@ class MainWidget(QMainWindow):
 
         # Load the previous state of DUI, if present
         dui_files_path = os.path.join(self.storage_path, "dui_files")
+        self.session_journal = SessionJournal(dui_files_path)
+        from_journal = SessionJournal.exists(dui_files_path)
 
-        if os.path.isfile(os.path.join(dui_files_path, "bkp.pickle")):
+        if from_journal or os.path.isfile(os.path.join(dui_files_path, "bkp.pickle")):
             try:
-                self.idials_runner = load_previous_state(dui_files_path)
+                self.idials_runner = load_previous_state(
+                    dui_files_path, self.session_journal
+                )
 
             except Exception as e:
                 # Something went wrong - tell the user then close
@@ -484,6 +557,9 @@ class MainWidget(QMainWindow):
 
             self.idials_runner = Runner()
 
+        self.session_journal.attach(self.idials_runner, fresh=not from_journal)
+        self.idials_runner.step_cache = cache_for_session(dui_files_path)
+
         self.gui2_log = {'pairs_list':[]}
 
         self.cli_tree_output = TreeShow()
@@ -578,10 +654,40 @@ class MainWidget(QMainWindow):
         self.custom_thread.str_fail_signal.connect(self.after_failed)
         self.custom_thread.str_print_signal.connect(self.cli_out.add_txt)
         self.custom_thread.str_print_signal.connect(self.txt_bar.setText)
+        self.custom_thread.stall_signal.connect(self.step_stalled)
 
         self.custom_thread.busy_box_on.connect(self.pop_busy_box)
         self.custom_thread.busy_box_off.connect(self.close_busy_box)
 
+        self.branch_signals = BranchSignals()
+        self.branch_signals.state_changed.connect(self.branch_state_changed)
+        self.branch_signals.output.connect(self.branch_output)
+        self.branch_scheduler = BranchScheduler(
+            self.idials_runner,
+            max_running=sys_arg.max_branches,
+            on_state_changed=self.branch_signals.emit_state_changed,
+            on_output=self.branch_signals.emit_output,
+        )
+        self.param_sweep = ParamSweep(self.idials_runner, self.branch_scheduler)
+        self.branch_signals.info_done.connect(self.info_job_done)
+        self.info_jobs = InfoJobQueue(on_done=self.branch_signals.emit_info_done)
+        self.branch_signals.gc_done.connect(self.disk_gc_done)
+        if sys_arg.disk_quota_mb > 0:
+            quota_bytes = sys_arg.disk_quota_mb * 1024 ** 2
+
+        else:
+            quota_bytes = None
+
+        self.disk_gc = DiskGC(
+            self.idials_runner,
+            dui_files_path,
+            quota_bytes=quota_bytes,
+            on_done=self.branch_signals.emit_gc_done,
+            deduper=Deduper(dui_files_path),
+        )
+        self.disk_gc.start()
+        self.sweep_dialog = None
+
 
         self.main_widget = QWidget()
         self.main_widget.setLayout(main_box)
@@ -622,6 +728,8 @@ class MainWidget(QMainWindow):
 
         self.stop_run_retry.repeat_btn.clicked.connect(self.rep_clicked)
         self.stop_run_retry.run_btn.clicked.connect(self.run_clicked)
+        self.stop_run_retry.queue_btn.clicked.connect(self.queue_clicked)
+        self.stop_run_retry.sweep_btn.clicked.connect(self.sweep_clicked)
         self.stop_run_retry.stop_btn.clicked.connect(self.stop_clicked)
 
         self.centre_par_widget.user_changed.connect(self.cmd_changed_by_user)
@@ -640,6 +748,8 @@ class MainWidget(QMainWindow):
 
         self.stop_run_retry.repeat_btn.setEnabled(False)
         self.stop_run_retry.run_btn.setEnabled(False)
+        self.stop_run_retry.queue_btn.setEnabled(False)
+        self.stop_run_retry.sweep_btn.setEnabled(False)
         self.stop_run_retry.stop_btn.setEnabled(True)
         self.centre_par_widget.gray_outs_all()
         self.centre_par_widget.step_param_widg.currentWidget().my_widget.gray_me_out()
@@ -654,13 +764,24 @@ class MainWidget(QMainWindow):
         self.stop_run_retry.repeat_btn.setEnabled(False)
         self.stop_run_retry.stop_btn.setEnabled(False)
         self.stop_run_retry.run_btn.setEnabled(False)
+        self.stop_run_retry.queue_btn.setEnabled(False)
+        self.stop_run_retry.sweep_btn.setEnabled(False)
 
         if self.user_stoped:
             self.idials_runner.current_node.success = None
+            self.idials_runner.tree_changed()
 
         my_widget = self.centre_par_widget.step_param_widg.currentWidget().my_widget
-        if self.idials_runner.current_node.success is None:
+        if self.branch_scheduler.is_busy(self.idials_runner.current_node):
+            # queued or running in the background, it can still be forked
+            self.stop_run_retry.repeat_btn.setEnabled(True)
+            self.stop_run_retry.stop_btn.setEnabled(True)
+            my_widget.gray_me_out()
+
+        elif self.idials_runner.current_node.success is None:
             self.stop_run_retry.run_btn.setEnabled(True)
+            self.stop_run_retry.queue_btn.setEnabled(True)
+            self.stop_run_retry.sweep_btn.setEnabled(True)
             my_widget.activate_me(cur_nod=self.idials_runner.current_node)
 
         else:
@@ -671,8 +792,20 @@ class MainWidget(QMainWindow):
 
         if self.idials_runner.current_node.ll_command_lst[0][0] == "reindex":
             self.stop_run_retry.run_btn.setEnabled(False)
+            self.stop_run_retry.queue_btn.setEnabled(False)
+            self.stop_run_retry.sweep_btn.setEnabled(False)
             self.stop_run_retry.repeat_btn.setEnabled(False)
 
+        if self.idials_runner.step_cache is not None:
+            cache_stats = self.idials_runner.step_cache.stats()
+            self.stop_run_retry.run_btn.setToolTip(
+                "step cache: {} hits, {} misses, {:.1f} MB reused".format(
+                    cache_stats["hits"],
+                    cache_stats["misses"],
+                    cache_stats["bytes_reused"] / 1024 ** 2,
+                )
+            )
+
         self.check_gray_outs()
         self.user_stoped = False
         self.update_nav_tree()
@@ -681,28 +814,43 @@ class MainWidget(QMainWindow):
         if(
             self.idials_runner.current_node.ll_command_lst[0][0] != "refine_bravais_settings"
         ):
+            # generated in the background, << info_job_done >> shows them
             if (
                 self.view_tab_num == 0 and
                 self.img_view.rad_but_pre_hkl.checkState()
             ):
-                self.pop_busy_box(text_in_bar = "Generating Predictions")
-                self.idials_runner.current_node.gen_repr_n_pred(to_run = "predict")
-                self.close_busy_box()
+                if self.info_jobs.request(self.idials_runner.current_node, "predict"):
+                    self.txt_bar.setText("Generating Predictions")
 
             elif self.view_tab_num == 2:
-                '''
-                ##########################################################################
-                tmp_bar = ProgBarBox(min_val=0, max_val=10, text=text_in_bar)
-                tmp_bar(5)
-                tmp_bar.ended()
-                ################################################################################
-                '''
+                self.info_jobs.request(self.idials_runner.current_node, "report")
 
+    def disk_gc_done(self, summary):
+        for lin_num, kind in summary["evicted"]:
+            self.info_jobs.forget(lin_num, kind)
+            node = self.idials_runner.get_node(lin_num)
+            if node is not None:
+                self.session_journal.log_node(node)
 
-                tmp_bar = ProgBarBox(min_val=0, max_val=10, text="Generating Report")
-                tmp_bar(5)
-                self.idials_runner.current_node.gen_repr_n_pred(to_run = "report")
-                tmp_bar.ended()
+        self.tree_out.reclaimable = summary["reclaimable"]
+        self.update_nav_tree()
+
+    def info_job_done(self, lin_num, kind):
+        node = self.idials_runner.get_node(lin_num)
+        if node is None:
+            return
+
+        self.session_journal.log_node(node)
+        if (
+            node is self.idials_runner.current_node
+            and not self.custom_thread.isRunning()
+        ):
+            if (
+                (kind == "report" and self.view_tab_num == 2)
+                or (kind == "predict" and self.view_tab_num == 0)
+            ):
+                update_info(self)
+                update_pbar_msg(self)
 
     def tab_changed(self, num = 0):
         self.view_tab_num = num
@@ -762,6 +910,7 @@ class MainWidget(QMainWindow):
 
     def update_low_level_command_lst(self, command_lst):
         self.idials_runner.current_node.ll_command_lst = command_lst
+        self.idials_runner.tree_changed()
         self.reconnect_when_ready()
 
     def cmd_changed_by_user(self, my_label):
@@ -770,13 +919,14 @@ class MainWidget(QMainWindow):
         if tmp_curr.success is True:
             self.cmd_exe(["mkchi"])
             self.idials_runner.current_node.ll_command_lst = [[str(my_label)]]
+            self.idials_runner.tree_changed()
             self.centre_par_widget.step_param_widg.currentWidget().my_widget.reset_par()
 
             path_to_mask_pickle = None
             if self.idials_runner.current_node.ll_command_lst[0][0] == "integrate":
                 logger.debug("Running: try_find_prev_mask_pickle")
                 path_to_mask_pickle = try_find_prev_mask_pickle(
-                    self.idials_runner.current_node
+                    self.idials_runner.current_node, self.idials_runner
                 )
                 if path_to_mask_pickle is not None:
                     self.pass_parmams(["lookup.mask=" + path_to_mask_pickle])
@@ -785,6 +935,7 @@ class MainWidget(QMainWindow):
 
         elif tmp_curr.success is None:
             self.idials_runner.current_node.ll_command_lst[0] = [str(my_label)]
+            self.idials_runner.tree_changed()
             self.reconnect_when_ready()
 
     def cmd_changed_by_any(self):
@@ -797,16 +948,17 @@ class MainWidget(QMainWindow):
         self.cmd_exe(["mksib"])
         self.cmd_exe(["clean"])
         self.check_gray_outs()
+        self.disk_gc.start()
 
     def stop_clicked(self):
         logger.debug("\n\n <<< Stop clicked >>> \n\n")
-        # TODO fix spelling on << dials_command >>
-        pr_to_kill = self.idials_runner.current_node.dials_command.my_pid
-        logger.debug(
-            "self.idials_runner.current_node.dials_command.my_pid = %s", pr_to_kill
-        )
+        if self.branch_scheduler.is_busy(self.idials_runner.current_node):
+            self.branch_scheduler.cancel(self.idials_runner.current_node)
+            return
+
         self.user_stoped = True
-        kill_w_child(pr_to_kill)
+        # whichever executor runs it, local, pool or spool
+        self.idials_runner.current_node.dials_command.cancel()
 
     def run_clicked(self):
         logger.debug("run_clicked")
@@ -822,23 +974,88 @@ class MainWidget(QMainWindow):
         )
         self.cmd_launch(cmd_tmp)
 
+    def queue_clicked(self):
+        logger.debug("queue_clicked")
+        cmd_tmp = (
+            self.centre_par_widget.step_param_widg.currentWidget().my_widget.command_lst
+        )
+        self.branch_scheduler.submit(self.idials_runner.current_node, cmd_tmp)
+        self.reconnect_when_ready()
+
+    def sweep_clicked(self):
+        logger.debug("sweep_clicked")
+        if self.sweep_dialog is None:
+            self.sweep_dialog = SweepDialog(self.param_sweep, parent=self)
+            self.sweep_dialog.node_selected.connect(self.sweep_node_selected)
+
+        cmd_tmp = (
+            self.centre_par_widget.step_param_widg.currentWidget().my_widget.command_lst
+        )
+        self.sweep_dialog.set_base(self.idials_runner.current_node, cmd_tmp)
+        self.sweep_dialog.show()
+        self.sweep_dialog.raise_()
+
+    def sweep_node_selected(self, lin_num):
+        if self.tree_clickable and self.idials_runner.get_node(lin_num) is not None:
+            self.cmd_exe("goto " + str(lin_num))
+            self.refresh_my_gui()
+
+    def branch_state_changed(self, lin_num):
+        if self.sweep_dialog is not None:
+            self.sweep_dialog.update_results()
+
+        node = self.idials_runner.get_node(lin_num)
+        if node is not None and node.run_state == DONE:
+            self.info_jobs.prefetch(node)
+
+        if self.custom_thread.isRunning() or node is None:
+            # a foreground run owns the GUI, only show the new state
+            self.update_nav_tree()
+
+        elif (
+            node is self.idials_runner.current_node
+            and node.run_state in (DONE, FAILED)
+        ):
+            if node.run_state == FAILED:
+                self.after_failed()
+
+            self.update_after_finished()
+
+        else:
+            self.reconnect_when_ready()
+
+    def step_stalled(self, stalled):
+        self.update_nav_tree()
+
+    def branch_output(self, lin_num, str_lin):
+        if (
+            lin_num == self.idials_runner.current_line
+            and not self.custom_thread.isRunning()
+        ):
+            self.cli_out.add_txt(str_lin)
+
     def cmd_exe(self, new_cmd):
         # Running NOT in parallel
-        update_info(self)
-        self.idials_runner.run(command=new_cmd, ref_to_class=None)
-        self.check_reindex_pop()
-        self.reconnect_when_ready()
+        with tracer.span("cmd_exe", command=str(new_cmd)):
+            update_info(self)
+            self.idials_runner.run(command=new_cmd, ref_to_class=None)
+            self.check_reindex_pop()
+            self.reconnect_when_ready()
 
     def cmd_launch(self, new_cmd):
         # Running WITH threading
-        self.cli_out.clear()
-        self.cli_out.make_green()
+        self.cli_out.start_live()
         self.txt_bar.start_motion()
         self.txt_bar.setText("Running")
         self.disconnect_while_running()
         self.custom_thread(new_cmd, self.idials_runner)
 
     def update_after_finished(self):
+        if self.idials_runner.current_node.success is True:
+            self.info_jobs.prefetch(self.idials_runner.current_node)
+
+        self.disk_gc.start()
+
         self.chouse_if_predict_or_report()
         update_info(self)
 
@@ -847,7 +1064,7 @@ class MainWidget(QMainWindow):
 
         tmp_curr = self.idials_runner.current_node
 
-        prn_lst_lst_cmd(tmp_curr)
+        prn_lst_lst_cmd(self.idials_runner.get_ancestor_path(tmp_curr))
 
         if (
             tmp_curr.ll_command_lst[0][0] == "refine_bravais_settings"
@@ -855,6 +1072,7 @@ class MainWidget(QMainWindow):
         ):
             self.idials_runner.run(command=["mkchi"], ref_to_class=None)
             self.idials_runner.current_node.ll_command_lst = [["reindex"]]
+            self.idials_runner.tree_changed()
 
         elif tmp_curr.ll_command_lst[0][0] == "reindex" and tmp_curr.success is True:
 
@@ -889,10 +1107,9 @@ class MainWidget(QMainWindow):
             self.img_view.my_painter.reset_bc_tool(None)
 
 
-
-
-        with open(self.storage_path + "/dui_files/bkp.pickle", "wb") as bkp_out:
-            pickle.dump(self.idials_runner, bkp_out)
+        self.session_journal.log_node(tmp_curr)
+        if self.idials_runner.current_node is not tmp_curr:
+            self.session_journal.log_node(self.idials_runner.current_node)
 
     def pop_busy_box(self, text_in_bar):
         print("OPENING busy pop bar with the text: ", text_in_bar)
@@ -1004,25 +1221,16 @@ class MainWidget(QMainWindow):
 
         curr_step = self.idials_runner.current_node
 
-        for err_lin in curr_step.dials_command.tmp_std_all:
-            logger.debug(err_lin)
+        # the whole output was already streamed to disk while running, out_log
+        # is missing when the step failed before running or was reloaded
+        out_log = getattr(curr_step.dials_command, "out_log", None)
+        if out_log is not None:
+            err_log_file_out = out_log.path
 
-        err_log_file_out = (
-            self.storage_path
-            + "/dui_files"
-            + os.sep
-            + str(curr_step.lin_num)
-            + "_err_out.log"
-        )
+        else:
+            err_log_file_out = curr_step.log_file_out
 
         print("\n ERROR \n err_log_file_out = %s %s", err_log_file_out, "\n")
-
-        fil_obj = open(err_log_file_out, "w")
-        for err_lin in curr_step.dials_command.tmp_std_all:
-            fil_obj.write(err_lin)
-            fil_obj.write("\n")
-
-        fil_obj.close()
         self.idials_runner.current_node.err_file_out = err_log_file_out
 
     def opt_dobl_clicked(self, row):
@@ -1049,23 +1257,24 @@ class MainWidget(QMainWindow):
                 print("\n Tst A1 \n")
 
             item = self.tree_out.std_mod.itemFromIndex(it_index)
-            prn_lst_lst_cmd(item.idials_node)
             lin_num = item.idials_node.lin_num
-            cmd_ovr = "goto " + str(lin_num)
-            self.cmd_exe(cmd_ovr)
-
-            self.centre_par_widget.set_widget(
-                nxt_cmd=item.idials_node.ll_command_lst[0][0],
-                curr_step=self.idials_runner.current_node,
-            )
+            with tracer.span("node_clicked", lin_num=lin_num):
+                prn_lst_lst_cmd(self.idials_runner.get_ancestor_path(item.idials_node))
+                cmd_ovr = "goto " + str(lin_num)
+                self.cmd_exe(cmd_ovr)
+
+                self.centre_par_widget.set_widget(
+                    nxt_cmd=item.idials_node.ll_command_lst[0][0],
+                    curr_step=self.idials_runner.current_node,
+                )
 
-            self.check_reindex_pop()
+                self.check_reindex_pop()
 
-            self.chouse_if_predict_or_report()
-            update_info(self)
+                self.chouse_if_predict_or_report()
+                update_info(self)
 
-            self.check_gray_outs()
-            self.reconnect_when_ready()
+                self.check_gray_outs()
+                self.reconnect_when_ready()
 
             self.centre_par_widget.update_command_lst_high_level.connect(
                 self.update_low_level_command_lst
@@ -1093,3 +1302,11 @@ class MainWidget(QMainWindow):
     def closeEvent(self, event):
         if self.my_pop:
             self.my_pop.close()
+
+        self.branch_scheduler.shutdown()
+        self.info_jobs.shutdown()
+        self.disk_gc.join()
+        shutdown_executors()
+
+        self.session_journal.close()
+        tracer.save()
@@ -29,10 +29,12 @@ import os
 import sys
 
 try:
-    from cli_utils import sys_arg
+    from cli_utils import executor_for_session, sys_arg
+    from tracing import tracer
 
 except ImportError:
-    from .cli_utils import sys_arg
+    from .cli_utils import executor_for_session, sys_arg
+    from .tracing import tracer
 
 logger = logging.getLogger(__name__)
 
@@ -41,10 +43,25 @@ def main():
     # Process any command arguments
     parser = argparse.ArgumentParser(
         description="DUI, the dials GUI",
-        usage="dui [-h|--help] [-v[v]][template=TEMPLATE] [directory=DIRECTORY]",
+        usage=(
+            "dui [-h|--help] [-v[v]] [--trace OUT.json]"
+            " [template=TEMPLATE] [directory=DIRECTORY]"
+            " [max_branches=N] [cache_size_mb=N] [disk_quota_mb=N]"
+            " [executor=local|pool|spool|warm] [spool_dir=DIR]"
+            " [cancel_grace_s=S] [integrate_blocks=N] [cpu_budget=N]"
+            " [stall_s=S] [stall_action=flag|cancel|requeue]"
+            " [step_nice=N] [gui_cores=N] [mem_limit_mb=N] [vmem_limit_mb=N]"
+            " [frame_cache_mb=N] [read_ahead=N]"
+            " [play_fps=N] [play_decoders=N]"
+        ),
     )
     parser.add_argument("positionals", type=str, nargs="*", help=argparse.SUPPRESS)
     parser.add_argument("--verbose", "-v", action="count", default=0)
+    parser.add_argument(
+        "--trace",
+        metavar="OUT.json",
+        help="record a timeline of what DUI does, in Chrome trace format",
+    )
     args = parser.parse_args()
 
     # Set up the logger to only show warnings unless -v (info) or -vv (debug)
@@ -73,6 +90,67 @@ def main():
         elif arg.startswith("directory="):
             sys_arg.directory = os.path.abspath(arg[len("directory=") :])
             args.positionals.remove(arg)
+        elif arg.startswith("max_branches="):
+            sys_arg.max_branches = int(arg[len("max_branches=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("cache_size_mb="):
+            sys_arg.cache_size_mb = int(arg[len("cache_size_mb=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("disk_quota_mb="):
+            sys_arg.disk_quota_mb = int(arg[len("disk_quota_mb=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("executor="):
+            sys_arg.executor = arg[len("executor=") :]
+            args.positionals.remove(arg)
+        elif arg.startswith("spool_dir="):
+            sys_arg.spool_dir = os.path.abspath(arg[len("spool_dir=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("cancel_grace_s="):
+            sys_arg.cancel_grace_s = float(arg[len("cancel_grace_s=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("integrate_blocks="):
+            sys_arg.integrate_blocks = int(arg[len("integrate_blocks=") :])
+            args.positionals.remove(arg)
+            if sys_arg.integrate_blocks > 1:
+                logger.warning(
+                    "integrate_blocks=%d: each block is integrated and "
+                    "combined as a separate experiment, results differ "
+                    "from integrating in one go",
+                    sys_arg.integrate_blocks,
+                )
+        elif arg.startswith("cpu_budget="):
+            sys_arg.cpu_budget = int(arg[len("cpu_budget=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("stall_s="):
+            sys_arg.stall_s = float(arg[len("stall_s=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("stall_action="):
+            sys_arg.stall_action = arg[len("stall_action=") :]
+            args.positionals.remove(arg)
+        elif arg.startswith("step_nice="):
+            sys_arg.step_nice = int(arg[len("step_nice=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("gui_cores="):
+            sys_arg.gui_cores = int(arg[len("gui_cores=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("mem_limit_mb="):
+            sys_arg.mem_limit_mb = int(arg[len("mem_limit_mb=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("vmem_limit_mb="):
+            sys_arg.vmem_limit_mb = int(arg[len("vmem_limit_mb=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("frame_cache_mb="):
+            sys_arg.frame_cache_mb = int(arg[len("frame_cache_mb=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("read_ahead="):
+            sys_arg.read_ahead = int(arg[len("read_ahead=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("play_fps="):
+            sys_arg.play_fps = int(arg[len("play_fps=") :])
+            args.positionals.remove(arg)
+        elif arg.startswith("play_decoders="):
+            sys_arg.play_decoders = int(arg[len("play_decoders=") :])
+            args.positionals.remove(arg)
 
     # Warn if any remaining (unknown) parameters given
     if args.positionals:
@@ -85,6 +163,27 @@ def main():
 
     logger.info("sys_arg.template =%s", sys_arg.template)
     logger.info("sys_arg.directory=%s", sys_arg.directory)
+    logger.info("sys_arg.max_branches=%s", sys_arg.max_branches)
+    logger.info("sys_arg.cache_size_mb=%s", sys_arg.cache_size_mb)
+    logger.info("sys_arg.disk_quota_mb=%s", sys_arg.disk_quota_mb)
+    logger.info("sys_arg.executor=%s", sys_arg.executor)
+    logger.info("sys_arg.cpu_budget=%s", sys_arg.cpu_budget)
+    logger.info("sys_arg.stall_s=%s %s", sys_arg.stall_s, sys_arg.stall_action)
+    logger.info(
+        "steps at nice %s, %s cores left to the GUI, memory limits %s/%s MB",
+        sys_arg.step_nice,
+        sys_arg.gui_cores,
+        sys_arg.mem_limit_mb,
+        sys_arg.vmem_limit_mb,
+    )
+
+    if args.trace:
+        tracer.enable(args.trace)
+        logger.info("tracing to %s", tracer.path)
+
+    if sys_arg.executor == "warm":
+        # workers import DIALS while the GUI starts
+        executor_for_session()
 
     # Inline import so that we can load this after logging setup
 
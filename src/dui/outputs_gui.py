@@ -29,6 +29,7 @@ from dxtbx.model.experiment_list import InvalidExperimentListError
 
 try:
     from outputs_n_viewers.info_handler import update_all_data
+    from tracing import traced
     from qt import (
         QApplication,
         QGroupBox,
@@ -41,6 +42,7 @@ try:
 
 except ImportError:
     from .outputs_n_viewers.info_handler import update_all_data
+    from .tracing import traced
     from .qt import (
         QApplication,
         QGroupBox,
@@ -392,6 +394,7 @@ class InfoWidget(QWidget):
         self.setLayout(main_v_box)
 
 
+    @traced("InfoWidget.update_data")
     def update_data(self, exp_json_path=None, refl_pikl_path=None):
         # TODO: Change interface of function to not recieve list including
         #       predicted reflections, as long as it doesn't need it
@@ -0,0 +1,215 @@
+"""
+Decoded images kept in memory for the image viewer
+
+Reading a frame of a sweep means decompressing a CBF or HDF5 image, the
+slowest part of browsing. Every code path of the viewer asks << frame_cache >>
+instead, which decodes each (imageset, index) once, keeps the most recently
+used frames up to a number of bytes, and reads ahead in a background
+thread the frames the user is likely to ask for next.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# memory for decoded frames
+CACHE_BYTES = 1024 * 1024 ** 2
+
+# positions read ahead in the direction the user is moving
+READ_AHEAD = 4
+
+
+def imageset_key(imageset):
+    """
+    Same key for two imagesets reading the same images, the first index
+    tells apart slices of one HDF5 file (the same path for every image)
+    """
+    try:
+        indices = imageset.indices()
+        first = indices[0] if len(indices) else 0
+        return (imageset.get_path(0), first, len(imageset))
+
+    except Exception:
+        return id(imageset)
+
+
+def frame_bytes(lst_panel):
+    n_bytes = 0
+    for panel in lst_panel:
+        if hasattr(panel, "nbytes"):
+            n_bytes += panel.nbytes
+
+        else:
+            # flex arrays, int or double
+            item_size = 8 if "double" in type(panel).__name__ else 4
+            n_bytes += panel.size() * item_size
+
+    return n_bytes
+
+
+class FrameCache(object):
+    """
+    Least recently used frames, as returned by << imageset.get_raw_data >>,
+    up to << max_bytes >> in total
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_read_ahead = 0
+        self.decode_s = 0.0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        # decoders of dxtbx are not meant for several threads
+        self._decode_lock = threading.Lock()
+        self._wanted = deque()
+        self._wanted_cond = threading.Condition(self._lock)
+        self._reader = None
+
+    def _lookup(self, key):
+        with self._lock:
+            lst_panel = self._frames.get(key)
+            if lst_panel is not None:
+                self._frames.move_to_end(key)
+
+            return lst_panel
+
+    def _store(self, key, lst_panel):
+        n_bytes = frame_bytes(lst_panel)
+        with self._lock:
+            if key in self._frames:
+                return
+
+            self._frames[key] = lst_panel
+            self.n_bytes += n_bytes
+            while self.n_bytes > self.max_bytes and len(self._frames) > 1:
+                _, old_panels = self._frames.popitem(last=False)
+                self.n_bytes -= frame_bytes(old_panels)
+
+    def _decode(self, imageset, index, keep=True):
+        key = (imageset_key(imageset), index)
+        with self._decode_lock:
+            # may have been read ahead while waiting
+            lst_panel = self._lookup(key)
+            if lst_panel is not None:
+                return lst_panel, False
+
+            start_time = time.time()
+            lst_panel = imageset.get_raw_data(index)
+            self.decode_s += time.time() - start_time
+
+        if keep:
+            self._store(key, lst_panel)
+
+        return lst_panel, True
+
+    def get(self, imageset, index, keep=True):
+        """
+        Panels of the frame << index >> of << imageset >>, not kept when
+        << keep >> is False (reading a whole scan must not push out what
+        the user is looking at)
+        """
+        lst_panel = self._lookup((imageset_key(imageset), index))
+        if lst_panel is not None:
+            self.n_hits += 1
+            return lst_panel
+
+        lst_panel, decoded = self._decode(imageset, index, keep)
+        if decoded:
+            self.n_misses += 1
+
+        else:
+            self.n_hits += 1
+
+        return lst_panel
+
+    def read_ahead(self, imageset, img_pos, step, n_stack=1, n_ahead=READ_AHEAD):
+        """
+        Decodes in the background the frames of the << n_ahead >> next
+        positions << img_pos + step * k >>, << n_stack >> frames each,
+        forgetting what was asked before
+        """
+        n_img = len(imageset)
+        lst_index = []
+        for num in range(1, n_ahead + 1):
+            pos = img_pos + step * num
+            for index in range(pos, pos + n_stack):
+                if 0 <= index < n_img and index not in lst_index:
+                    lst_index.append(index)
+
+        with self._wanted_cond:
+            self._wanted.clear()
+            self._wanted.extend((imageset, index) for index in lst_index)
+            self._wanted_cond.notify()
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._read_forever)
+                self._reader.daemon = True
+                self._reader.start()
+
+    def _read_forever(self):
+        while True:
+            with self._wanted_cond:
+                while not self._wanted:
+                    self._wanted_cond.wait()
+
+                imageset, index = self._wanted.popleft()
+
+            try:
+                _, decoded = self._decode(imageset, index)
+                if decoded:
+                    self.n_read_ahead += 1
+
+            except Exception as e:
+                logger.debug("could not read ahead image %s: %s", index, e)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._wanted.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        """Numbers to tune << max_bytes >> and the read ahead with"""
+        n_asked = self.n_hits + self.n_misses
+        n_decoded = self.n_misses + self.n_read_ahead
+        return {
+            "hit_rate": self.n_hits / n_asked if n_asked else 0.0,
+            "decode_ms": 1000.0 * self.decode_s / n_decoded if n_decoded else 0.0,
+            "n_frames": len(self._frames),
+            "mb": self.n_bytes / 1024 ** 2,
+        }
+
+    def stats_txt(self):
+        return (
+            "cached frames: {n_frames} ({mb:.0f} MB), hit rate {hit_rate:.0%},"
+            " {decode_ms:.0f} ms per decode".format(**self.stats())
+        )
+
+
+# one for every viewer, so the same frames are not decoded twice
+frame_cache = FrameCache()
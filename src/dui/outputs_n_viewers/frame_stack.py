@@ -0,0 +1,249 @@
+"""
+Stacked images of the viewer, << Number of Images to Add >> above 1
+
+FrameStack keeps what it needs of the last window of frames shown, so
+moving the window by one image reads two frames (the one leaving and the
+one entering) instead of all of them:
+
+    sum    running sum, the leaving frame subtracted, the entering added
+    mean   the same sum divided by the number of frames
+    max    maximum of each pixel, through a queue made of two stacks of
+           partial maxima, amortized O(1) np.maximum per step
+
+The counts are integers, so adding and subtracting them as doubles is
+exact and the running sum does not drift.
+
+ScanProjector computes the same projections over the whole scan in a
+background thread, a chunk of frames at a time.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STACK_MODES = ["mean", "sum", "max"]
+
+# frames between checks of cancel and updates of the progress
+CHUNK = 32
+
+
+class FrameStack(object):
+    """
+    Sum, mean or max of the frames << first >> to << first + n_stack - 1 >>,
+    each one given as a 2D array by << frame_fun(index) >>
+    """
+
+    def __init__(self, frame_fun, mode="mean"):
+        if mode not in STACK_MODES:
+            raise ValueError("unknown stack mode {}".format(mode))
+
+        self.frame_fun = frame_fun
+        self.mode = mode
+        self.n_read = 0
+        self.reset()
+
+    def reset(self):
+        self._window = None
+        self._sum = None
+        # frames of the newest half of the window and their running max
+        self._back = []
+        self._back_max = None
+        # maxima of the oldest half, the oldest frame's on top
+        self._front = []
+
+    def _frame(self, index):
+        self.n_read += 1
+        return np.asarray(self.frame_fun(index), dtype=np.double)
+
+    def get(self, first, n_stack):
+        """
+        The stack of the window, read only, valid until the next call
+        """
+        n_stack = max(1, n_stack)
+        if self._window is None or self._window[1] != n_stack:
+            shift = None
+
+        else:
+            shift = first - self._window[0]
+
+        if self.mode == "max":
+            self._move_max(first, n_stack, shift)
+            stacked = self._max()
+
+        else:
+            self._move_sum(first, n_stack, shift)
+            if self.mode == "mean":
+                stacked = self._sum / n_stack
+
+            else:
+                stacked = self._sum
+
+        self._window = (first, n_stack)
+        return stacked
+
+    def _move_sum(self, first, n_stack, shift):
+        if shift is None or abs(shift) >= n_stack:
+            self._sum = self._frame(first).copy()
+            for index in range(first + 1, first + n_stack):
+                self._sum += self._frame(index)
+
+            return
+
+        old_first = self._window[0]
+        if shift > 0:
+            lst_out = range(old_first, first)
+            lst_in = range(old_first + n_stack, first + n_stack)
+
+        else:
+            lst_out = range(first + n_stack, old_first + n_stack)
+            lst_in = range(first, old_first)
+
+        for index in lst_out:
+            self._sum -= self._frame(index)
+
+        for index in lst_in:
+            self._sum += self._frame(index)
+
+    def _move_max(self, first, n_stack, shift):
+        if shift is None or shift < 0 or shift >= n_stack:
+            # moving back is rare enough to start again
+            self._back = []
+            self._back_max = None
+            self._front = []
+            lst_in = range(first, first + n_stack)
+
+        else:
+            for _ in range(shift):
+                self._pop_oldest()
+
+            lst_in = range(self._window[0] + n_stack, first + n_stack)
+
+        for index in lst_in:
+            self._push_newest(self._frame(index))
+
+    def _push_newest(self, frame):
+        self._back.append(frame)
+        if self._back_max is None:
+            self._back_max = frame.copy()
+
+        else:
+            np.maximum(self._back_max, frame, out=self._back_max)
+
+    def _pop_oldest(self):
+        if not self._front:
+            # the newest half becomes the oldest, with its suffix maxima
+            part_max = None
+            while self._back:
+                frame = self._back.pop()
+                if part_max is None:
+                    part_max = frame
+
+                else:
+                    part_max = np.maximum(part_max, frame)
+
+                self._front.append(part_max)
+
+            self._back_max = None
+
+        self._front.pop()
+
+    def _max(self):
+        if not self._front:
+            return self._back_max
+
+        if self._back_max is None:
+            return self._front[-1]
+
+        return np.maximum(self._front[-1], self._back_max)
+
+
+class ScanProjector(object):
+    """
+    Sum, mean or max of the << n_img >> frames of a scan, computed in a
+    background thread. << frame_fun >> is called from that thread.
+    """
+
+    def __init__(self, frame_fun, n_img, mode="max", chunk=CHUNK):
+        if mode not in STACK_MODES:
+            raise ValueError("unknown stack mode {}".format(mode))
+
+        self.frame_fun = frame_fun
+        self.n_img = n_img
+        self.mode = mode
+        self.chunk = chunk
+        self.n_done = 0
+        self.result = None
+        self.error = None
+        self._cancelled = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def done(self):
+        return self.result is not None or self.error is not None
+
+    def progress(self):
+        return self.n_done / self.n_img if self.n_img else 1.0
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            projection = None
+            for chunk_first in range(0, self.n_img, self.chunk):
+                if self._cancelled.is_set():
+                    return
+
+                chunk_last = min(chunk_first + self.chunk, self.n_img)
+                for index in range(chunk_first, chunk_last):
+                    frame = np.asarray(self.frame_fun(index), dtype=np.double)
+                    if projection is None:
+                        projection = frame.copy()
+
+                    elif self.mode == "max":
+                        np.maximum(projection, frame, out=projection)
+
+                    else:
+                        projection += frame
+
+                self.n_done = chunk_last
+
+            if self.mode == "mean" and self.n_img:
+                projection /= self.n_img
+
+            self.result = projection
+
+        except Exception as e:
+            logger.info("could not project the scan: %s", e)
+            self.error = e
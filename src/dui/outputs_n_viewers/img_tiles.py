@@ -0,0 +1,158 @@
+"""
+Painting big images at any zoom by tiles of a pyramid of resolutions
+
+Level 0 of a TilePyramid is the BGRX image shown, level k the same image
+binned 2^k times (each pixel the mean colour of a 2 x 2 block of level
+k - 1). Levels are built once per image, the first time a zoom needs
+them. Painting at << scale >> uses the level with pixels just smaller
+than a pixel of the screen and only its tiles inside the exposed part of
+the widget, turned into pixmaps once and kept until the image changes.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import math
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# side of a tile, in pixels of its level
+TILE = 256
+
+# tile pixmaps kept, 64 MB of 256 x 256 BGRX tiles
+N_TILES = 256
+
+
+def bin2(img_arr):
+    """
+    Mean colour of each 2 x 2 block of the BGRX image << img_arr >>, the
+    last row and column repeated when the size is odd
+    """
+    height, width = img_arr.shape[:2]
+    if height % 2 or width % 2:
+        img_arr = np.pad(img_arr, ((0, height % 2), (0, width % 2), (0, 0)), "edge")
+
+    blocks = img_arr.reshape(
+        img_arr.shape[0] // 2, 2, img_arr.shape[1] // 2, 2, img_arr.shape[2]
+    )
+    # adding the four corners is much faster than blocks.sum(axis=(1, 3))
+    sum_arr = blocks[:, 0, :, 0].astype(np.uint16)
+    sum_arr += blocks[:, 0, :, 1]
+    sum_arr += blocks[:, 1, :, 0]
+    sum_arr += blocks[:, 1, :, 1]
+    sum_arr += 2
+    sum_arr >>= 2
+    return sum_arr.astype(np.uint8)
+
+
+class TilePyramid(object):
+    """
+    Tiles of << img_arr >> (height x width x 4, uint8) at every level,
+    turned into whatever the painter draws by << make_tile(tile_arr) >>
+    """
+
+    def __init__(self, img_arr, make_tile, tile=TILE, n_tiles=N_TILES):
+        self.levels = [img_arr]
+        self.make_tile = make_tile
+        self.tile = tile
+        self.n_tiles = n_tiles
+        self.n_made = 0
+        self._tiles = OrderedDict()
+
+        longest = max(img_arr.shape[:2])
+        self.top_level = max(0, int(math.ceil(math.log(max(1, longest / tile), 2))))
+
+    def level_for_scale(self, scale):
+        """Level of the biggest pixels still smaller than the ones shown"""
+        if scale >= 1.0:
+            return 0
+
+        return min(self.top_level, int(math.floor(math.log(1.0 / scale, 2))))
+
+    def level(self, num):
+        while len(self.levels) <= num:
+            self.levels.append(bin2(self.levels[-1]))
+
+        return self.levels[num]
+
+    def get_tile(self, num, tile_row, tile_col):
+        key = (num, tile_row, tile_col)
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+
+        lev_arr = self.level(num)
+        tile_arr = np.ascontiguousarray(
+            lev_arr[
+                tile_row * self.tile : (tile_row + 1) * self.tile,
+                tile_col * self.tile : (tile_col + 1) * self.tile,
+            ]
+        )
+        tile_obj = self.make_tile(tile_arr)
+        self.n_made += 1
+        self._tiles[key] = tile_obj
+        while len(self._tiles) > self.n_tiles:
+            self._tiles.popitem(last=False)
+
+        return tile_obj
+
+    def visible_tiles(self, scale, x_ini, y_ini, x_end, y_end):
+        """
+        Tiles to paint the area from (x_ini, y_ini) to (x_end, y_end) of
+        the widget showing the image at << scale >>
+
+        Returns:
+            (list): (tile, (x, y, width, height)) where the tile goes
+        """
+        num = self.level_for_scale(scale)
+        lev_height, lev_width = self.level(num).shape[:2]
+        # widget pixels per pixel of the level and per side of a tile
+        lev_px = scale * 2 ** num
+        tile_px = self.tile * lev_px
+
+        n_rows = int(math.ceil(lev_height / self.tile))
+        n_cols = int(math.ceil(lev_width / self.tile))
+        row_ini = max(0, int(y_ini // tile_px))
+        row_end = min(n_rows, int(math.ceil(y_end / tile_px)))
+        col_ini = max(0, int(x_ini // tile_px))
+        col_end = min(n_cols, int(math.ceil(x_end / tile_px)))
+
+        lst_tile = []
+        for tile_row in range(row_ini, row_end):
+            for tile_col in range(col_ini, col_end):
+                lev_y = tile_row * self.tile
+                lev_x = tile_col * self.tile
+                # rounding the edges, not the sizes, so no gaps between tiles
+                x_left = int(round(lev_x * lev_px))
+                y_top = int(round(lev_y * lev_px))
+                x_right = int(round(min(lev_x + self.tile, lev_width) * lev_px))
+                y_bottom = int(round(min(lev_y + self.tile, lev_height) * lev_px))
+                lst_tile.append(
+                    (
+                        self.get_tile(num, tile_row, tile_col),
+                        (x_left, y_top, x_right - x_left, y_bottom - y_top),
+                    )
+                )
+
+        return lst_tile
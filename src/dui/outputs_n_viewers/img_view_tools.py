@@ -33,9 +33,11 @@ from dials.array_family import flex
 try:
     sys.path.append('../')
     from qt import QImage, QProgressDialog, Qt
+    from frame_cache import frame_cache
 
 except ImportError:
     from ..qt import QImage, QProgressDialog, Qt
+    from .frame_cache import frame_cache
 
 from six.moves import range
 
@@ -70,12 +72,14 @@ class ProgBarBox(QProgressDialog):
         self.close()
 
 
-def panel_data_as_double(my_sweep, img_pos, pan_num):
+def panel_data_as_double(my_sweep, img_pos, pan_num, keep=True):
+    # decoded once, whatever the number of panels
+    raw_data = frame_cache.get(my_sweep, img_pos, keep)
     if type(pan_num) is int:
-        return my_sweep.get_raw_data(img_pos)[pan_num].as_double()
+        return raw_data[pan_num].as_double()
 
     elif type(pan_num) is tuple:
-        top_pan = my_sweep.get_raw_data(img_pos)[pan_num[0]].as_numpy_array()
+        top_pan = raw_data[pan_num[0]].as_numpy_array()
 
         p_siz0 = np.size(top_pan[:, 0:1])
         p_siz1 = np.size(top_pan[0:1, :])
@@ -89,7 +93,7 @@ def panel_data_as_double(my_sweep, img_pos, pan_num):
         np_img[0:p_siz0, 0:p_siz1] = top_pan[:, :]
 
         for s_num in pan_num[1:]:
-            pan_dat = my_sweep.get_raw_data(img_pos)[pan_num[s_num]].as_numpy_array()
+            pan_dat = raw_data[pan_num[s_num]].as_numpy_array()
             np_img[s_num * p_siz_bg : s_num * p_siz_bg + p_siz0, 0:p_siz1] = pan_dat[
                 :, :
             ]
@@ -315,6 +319,21 @@ class img_w_cpp(object):
         return img_array
 
 
+def qimg_as_array(q_img):
+    """
+    BGRX pixels of << q_img >> as a (height, width, 4) uint8 array, sharing
+    the memory of the returned QImage, which must outlive the array
+    """
+    q_img = q_img.convertToFormat(QImage.Format_RGB32)
+    bits_ptr = q_img.constBits()
+    bits_ptr.setsize(q_img.byteCount())
+    np_img = np.frombuffer(bits_ptr, dtype=np.uint8).reshape(
+        q_img.height(), q_img.bytesPerLine()
+    )
+    np_img = np_img[:, : q_img.width() * 4].reshape(q_img.height(), q_img.width(), 4)
+    return np_img, q_img
+
+
 class build_qimg(object):
     def __init__(self):
         self.arr_img = img_w_cpp()
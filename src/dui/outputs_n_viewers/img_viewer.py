@@ -43,9 +43,24 @@ try:
     sys.path.append('../')
     from dui.cli_utils import sys_arg
     from dui.gui_utils import get_main_path
+    from dui.tracing import traced
+    from dui.outputs_n_viewers.frame_cache import frame_cache
+    from dui.outputs_n_viewers.frame_stack import (
+        STACK_MODES,
+        FrameStack,
+        ScanProjector,
+    )
+    from dui.outputs_n_viewers.img_tiles import TilePyramid
+    from dui.outputs_n_viewers.mask_overlay import (
+        mask_overlays,
+        overlay_bgra,
+        stacked_mask,
+    )
+    from dui.outputs_n_viewers.playback import PlaybackEngine, shared_memory
     from dui.outputs_n_viewers.img_view_tools import (
         panel_data_as_double,
         build_qimg,
+        qimg_as_array,
         draw_palette_label,
         find_hkl_near,
         list_arrange,
@@ -88,9 +103,16 @@ try:
 except ImportError:
     from ..cli_utils import sys_arg
     from ..gui_utils import get_main_path
+    from ..tracing import traced
+    from .frame_cache import frame_cache
+    from .frame_stack import STACK_MODES, FrameStack, ScanProjector
+    from .img_tiles import TilePyramid
+    from .mask_overlay import mask_overlays, overlay_bgra, stacked_mask
+    from .playback import PlaybackEngine, shared_memory
     from .img_view_tools import (
         panel_data_as_double,
         build_qimg,
+        qimg_as_array,
         draw_palette_label,
         find_hkl_near,
         list_arrange,
@@ -236,6 +258,14 @@ def build_mask_item(img_paint_obj):
         return False, None, False
 
 
+def tile_pixmap(tile_arr):
+    """QPixmap of a tile of a TilePyramid"""
+    q_img = QImage(
+        tile_arr.data, tile_arr.shape[1], tile_arr.shape[0], QImage.Format_RGB32
+    )
+    return QPixmap.fromImage(q_img)
+
+
 class ImgPainter(QWidget):
 
     ll_mask_applied = Signal(list)
@@ -246,11 +276,16 @@ class ImgPainter(QWidget):
         self.my_parent = parent
 
         self.img = None
+        # the image at every zoom, in tiles
+        self.img_tiles = None
         self.setMouseTracking(True)
         self.xb = None
         self.yb = None
         self.np_mask = None
         self.mask_flex = None
+        self.mask_pixmap = None
+        # mask overlay at the current zoom, when zoomed out
+        self.scaled_mask = None
 
         self.closer_ref = None
         self.my_scale = 0.333
@@ -346,6 +381,7 @@ class ImgPainter(QWidget):
         if scale_factor is not None:
 
             self.my_scale *= scale_factor
+            self.fit_to_scale()
 
             h_scr_bar = float(self.p_h_svar().value())
             v_scr_bar = float(self.p_v_svar().value())
@@ -375,6 +411,7 @@ class ImgPainter(QWidget):
 
         try:
             scale_factor = self.my_scale / old_scale
+            self.fit_to_scale()
             self.update()
 
             h_scr_bar = float(self.p_h_svar().value())
@@ -438,33 +475,53 @@ class ImgPainter(QWidget):
         self.pre_flat_data = pre_flat_data_in
         self.user_choice = user_choice_in
 
+        img_arr, img_owner = qimg_as_array(q_img)
+        self.img_tiles = TilePyramid(img_arr, tile_pixmap)
+        # the pixels of the tiles live in this QImage
+        self.img_tiles.img_owner = img_owner
+
         self.img_width = q_img.width()
         self.img_height = q_img.height()
+        self.fit_to_scale()
         self.update()
 
-    def update_my_mask(self, np_mask, mask_flex):
-        # print("\n np_mask =", np_mask, "\n")
+    def fit_to_scale(self):
+        """Size of the widget, for the image at the current zoom"""
+        if self.my_scale == 0:
+            self.my_scale = 1
+
+        scaled_width = int(self.img_width * self.my_scale)
+        scaled_height = int(self.img_height * self.my_scale)
+        if self.width() != scaled_width or self.height() != scaled_height:
+            self.resize(scaled_width, scaled_height)
+
+    def update_my_mask(self, np_mask, mask_flex, mask_tup=None, mask_key=None):
         self.np_mask = np_mask
         self.mask_flex = mask_flex
 
         if np_mask is not None:
-            # print("self.np_mask.shape =", self.np_mask.shape)
-
-            width = self.np_mask.shape[0]
-            height = self.np_mask.shape[1]
 
-            img_array = np.zeros([width, height, 4], dtype=np.uint8)
+            def build_pixmap():
+                if mask_tup is None:
+                    lst_np_mask = [np_mask]
 
-            for row_pow, ent_row in enumerate(self.np_mask):
-                for col_pos, elem in enumerate(ent_row):
-                    if not elem:
-                        # img_array[row_pow, col_pos, 0] = 155 # Blue
-                        # img_array[row_pow, col_pos, 1] = 155 # Green
-                        img_array[row_pow, col_pos, 2] = 255  # Red
-                        img_array[row_pow, col_pos, 3] = 175  # Transp
+                else:
+                    lst_np_mask = [pan_mask.as_numpy_array() for pan_mask in mask_tup]
+
+                img_array = overlay_bgra(stacked_mask(lst_np_mask))
+                q_img = QImage(
+                    img_array.data,
+                    img_array.shape[1],
+                    img_array.shape[0],
+                    QImage.Format_ARGB32,
+                )
+                return QPixmap(q_img)
 
-            q_img = QImage(img_array.data, height, width, QImage.Format_ARGB32)
-            self.mask_pixmap = QPixmap(q_img)
+            # built again only when the mask file changed
+            mask_pixmap = mask_overlays.get(mask_key, build_pixmap)
+            if mask_pixmap is not self.mask_pixmap:
+                self.mask_pixmap = mask_pixmap
+                self.scaled_mask = None
 
     def update_my_beam_centre(self, xb, yb, n_pan_xb_yb):
         self.xb = xb
@@ -526,10 +583,7 @@ class ImgPainter(QWidget):
         scaled_width = int(self.img_width * self.my_scale)
         scaled_height = int(self.img_height * self.my_scale)
 
-        self.resize(scaled_width, scaled_height)
-
         rect = QRect(0, 0, scaled_width, scaled_height)
-        pixmap = QPixmap(self.img)
         painter = QPainter(self)
 
         indexed_pen = QPen()  # creates a default indexed_pen
@@ -582,14 +636,30 @@ class ImgPainter(QWidget):
             non_indexed_pen.setStyle(Qt.SolidLine)
 
 
-        painter.drawPixmap(rect, pixmap)
+        # only the tiles of the part of the image exposed
+        exposed = event.rect()
+        for tile_pix, (x_tile, y_tile, w_tile, h_tile) in self.img_tiles.visible_tiles(
+            self.my_scale,
+            exposed.x(),
+            exposed.y(),
+            exposed.x() + exposed.width(),
+            exposed.y() + exposed.height(),
+        ):
+            painter.drawPixmap(QRect(x_tile, y_tile, w_tile, h_tile), tile_pix)
         # painter.setFont(QFont("Monospace", 22))
         # painter.setFont(QFont("FreeMono", 22))
 
         if self.np_mask is not None:
-            # print("Drawing Mask start   ...", end="")
-            painter.drawPixmap(rect, self.mask_pixmap)
-            # print(" .Drawing Mask end")
+            if self.my_scale > 1.0:
+                # only the visible part gets scaled
+                painter.drawPixmap(rect, self.mask_pixmap)
+
+            else:
+                # shrinking the whole overlay once per zoom, not per paint
+                if self.scaled_mask is None or self.scaled_mask.size() != rect.size():
+                    self.scaled_mask = self.mask_pixmap.scaled(rect.size())
+
+                painter.drawPixmap(0, 0, self.scaled_mask)
 
         cen_siz = 20.0
         if self.xb is not None and self.yb is not None:
@@ -994,10 +1064,15 @@ class PopDisplayMenu(QMenu):
         mid_bot_box = QHBoxLayout()
         mid_bot_box.addWidget(QLabel("Number of Images to Add"))
         mid_bot_box.addWidget(self.my_parent.num_of_imgs_to_add)
+        mid_bot_box.addWidget(self.my_parent.stack_mode_select)
+
+        scan_box = QHBoxLayout()
+        scan_box.addWidget(self.my_parent.btn_project)
 
         img_select_box = QVBoxLayout()
         img_select_box.addLayout(mid_top_box)
         img_select_box.addLayout(mid_bot_box)
+        img_select_box.addLayout(scan_box)
 
         img_select_group_box = QGroupBox("IMG Navigation")
         img_select_group_box.setLayout(img_select_box)
@@ -1123,6 +1198,18 @@ class MyImgWin(QWidget):
         self.img_select = QSpinBox()
         self.img_step = QSpinBox()
         self.num_of_imgs_to_add = QSpinBox()
+        # how the images added are combined, also for the whole scan
+        self.stack_mode_select = QComboBox()
+        for stack_mode in STACK_MODES:
+            self.stack_mode_select.addItem(stack_mode)
+
+        self.stack_mode = STACK_MODES[0]
+        self.stack_mode_select.currentIndexChanged.connect(self.stack_mode_changed)
+        self.btn_project = QPushButton("Project Whole Scan")
+        self.btn_project.clicked.connect(self.btn_project_clicked)
+        self.frame_stack = None
+        self.frame_stack_key = None
+        self.projector = None
 
         max_min_validator = QIntValidator(-5, 999999, self)
 
@@ -1362,6 +1449,14 @@ class MyImgWin(QWidget):
         self.img_num = 1
         self.img_step_val = 1
         self.stack_size = 1
+        # where the last image shown was and which way the user moves
+        self.last_img_pos = None
+        self.read_dir = 1
+        frame_cache.max_bytes = sys_arg.frame_cache_mb * 1024 ** 2
+        # decoder processes of the movie, started the first time it plays
+        self.play_engine = None
+        self.expt_path = None
+        self.pan_num = 0
         # possible values of img2show are:
         # "origin", "modif" or "mask"
         self.img2show = "origin"
@@ -1610,9 +1705,9 @@ class MyImgWin(QWidget):
                 n_of_imgs = len(self.my_sweep.indices())
                 logger.debug("n_of_imgs(ini_contrast) = %s", n_of_imgs)
 
-                img_arr_n0 = self.my_sweep.get_raw_data(0)[0]
-                img_arr_n1 = self.my_sweep.get_raw_data(1)[0]
-                img_arr_n2 = self.my_sweep.get_raw_data(2)[0]
+                img_arr_n0 = frame_cache.get(self.my_sweep, 0)[0]
+                img_arr_n1 = frame_cache.get(self.my_sweep, 1)[0]
+                img_arr_n2 = frame_cache.get(self.my_sweep, 2)[0]
 
                 tst_sample = (
                     img_arr_n0[0:25, 0:25].as_double()
@@ -1638,6 +1733,7 @@ class MyImgWin(QWidget):
                 )
                 print("Unable to calculate mean and adjust contrast")
 
+    @traced("MyImgWin.ini_datablock")
     def ini_datablock(self, json_file_path):
         from dxtbx.model.experiment_list import ExperimentListFactory
         if json_file_path is not None:
@@ -1645,8 +1741,12 @@ class MyImgWin(QWidget):
                 cwd_path = os.path.join(sys_arg.directory, "dui_files")
                 n_json_file_path = os.path.join(cwd_path, json_file_path)
 
+                self.close_playback()
+                self.cancel_projection()
+                self.frame_stack = None
                 experiments = ExperimentListFactory.from_json_file(n_json_file_path)
                 self.my_sweep = experiments.imagesets()[0]
+                self.expt_path = n_json_file_path
                 ###########################################################
                 #self.my_sweep = datablock.extract_sweeps()[0]
                 self.img_select.clear()
@@ -1718,6 +1818,7 @@ class MyImgWin(QWidget):
         '''
 
 
+    @traced("MyImgWin.set_reflection_table")
     def set_reflection_table(self, pckl_file_path):
         if pckl_file_path[0] is not None:
             logger.debug("\npickle file (found) = %s", pckl_file_path[0])
@@ -1843,7 +1944,12 @@ class MyImgWin(QWidget):
             print("\n xb, yb, n_pan_xb_yb = None, None, None \n")
 
         self.my_painter.update_my_beam_centre(xb, yb, n_pan_xb_yb)
-        self.my_painter.update_my_mask(all_data.np_mask, all_data.mask_flex)
+        self.my_painter.update_my_mask(
+            all_data.np_mask,
+            all_data.mask_flex,
+            all_data.mask_tup,
+            all_data.mask_key,
+        )
 
 
     def update_exp(self, reference):
@@ -1885,7 +1991,7 @@ class MyImgWin(QWidget):
             img_pos = self.img_num - 1
             loc_stk_siz = self.stack_size
 
-            n_of_panels = len(self.my_sweep.get_raw_data(img_pos))
+            n_of_panels = len(frame_cache.get(self.my_sweep, img_pos))
             if n_of_panels == 1:
                 pan_num = 0
 
@@ -1896,29 +2002,21 @@ class MyImgWin(QWidget):
                 print("number of  panels NOT supported, defaulting to only first one")
                 pan_num = 1
 
+            self.pan_num = pan_num
             if loc_stk_siz == 1:
                 self.img_arr = panel_data_as_double(self.my_sweep, img_pos, pan_num)
 
             elif loc_stk_siz > 1:
-
-                if img_pos + loc_stk_siz > len(self.my_sweep.indices()) - 1:
-                    loc_stk_siz = len(self.my_sweep.indices()) - img_pos
-
-                loc_scale = 1.0 / float(loc_stk_siz)
-                self.img_arr = panel_data_as_double(self.my_sweep, img_pos, pan_num)
-
-                for times in range(1, loc_stk_siz):
-                    pos_to_add = (img_pos) + times
-                    self.img_arr = (
-                        self.img_arr
-                        + panel_data_as_double(self.my_sweep, pos_to_add, pan_num)
-                        * loc_scale
-                    )
+                loc_stk_siz = min(loc_stk_siz, len(self.my_sweep.indices()) - img_pos)
+                self.img_arr = flex.double(
+                    self.stacked_frames().get(img_pos, loc_stk_siz)
+                )
 
             if self.img2show != "origin":
                 self.check_debug_pars(do_anyway = True)
 
             self.painter_set_img_pix(img_pos, loc_stk_siz)
+            self.read_ahead(img_pos, loc_stk_siz)
 
         self.palette_label.setPixmap(
             QPixmap(
@@ -1931,6 +2029,93 @@ class MyImgWin(QWidget):
             )
         )
 
+    def stacked_frames(self):
+        """The FrameStack of this sweep, panels and stack mode"""
+        stack_key = (id(self.my_sweep), self.pan_num, self.stack_mode)
+        if self.frame_stack is None or self.frame_stack_key != stack_key:
+            my_sweep = self.my_sweep
+            pan_num = self.pan_num
+
+            def frame_fun(img_pos):
+                return panel_data_as_double(my_sweep, img_pos, pan_num).as_numpy_array()
+
+            self.frame_stack = FrameStack(frame_fun, self.stack_mode)
+            self.frame_stack_key = stack_key
+
+        return self.frame_stack
+
+    def stack_mode_changed(self, new_mode_num):
+        self.stack_mode = STACK_MODES[new_mode_num]
+        self.set_img()
+
+    def btn_project_clicked(self):
+        """Starts or stops projecting the whole scan in the stack mode"""
+        if self.projector is not None:
+            self.cancel_projection()
+            return
+
+        if self.my_sweep is None:
+            return
+
+        my_sweep = self.my_sweep
+        pan_num = self.pan_num
+
+        def frame_fun(img_pos):
+            # read once, not kept in the cache of the frames browsed
+            return panel_data_as_double(
+                my_sweep, img_pos, pan_num, keep=False
+            ).as_numpy_array()
+
+        self.projector = ScanProjector(
+            frame_fun, len(my_sweep.indices()), self.stack_mode
+        )
+        self.projector.start()
+        self.check_projection()
+
+    def check_projection(self):
+        projector = self.projector
+        if projector is None:
+            return
+
+        if not projector.done():
+            self.btn_project.setText(
+                "Stop Projecting ({:.0%})".format(projector.progress())
+            )
+            QTimer.singleShot(250, self.check_projection)
+            return
+
+        self.projector = None
+        self.btn_project.setText("Project Whole Scan")
+        if projector.result is None:
+            print("Failed to project the scan:", projector.error)
+            return
+
+        n_of_imgs = projector.n_img
+        logger.info("showing the %s of all %s images", projector.mode, n_of_imgs)
+        self.img_arr = flex.double(projector.result)
+        self.painter_set_img_pix(0, n_of_imgs)
+
+    def cancel_projection(self):
+        if self.projector is not None:
+            self.projector.cancel()
+            self.projector = None
+            self.btn_project.setText("Project Whole Scan")
+
+    def read_ahead(self, img_pos, loc_stk_siz):
+        """Decodes in the background what comes next in the same direction"""
+        if self.last_img_pos is not None:
+            jump = img_pos - self.last_img_pos
+            # first, last or a typed number do not change the direction
+            if abs(jump) in (1, self.img_step_val):
+                self.read_dir = jump
+
+        self.last_img_pos = img_pos
+        frame_cache.read_ahead(
+            self.my_sweep, img_pos, self.read_dir, loc_stk_siz, sys_arg.read_ahead
+        )
+        self.img_select.setToolTip(frame_cache.stats_txt())
+        logger.debug(frame_cache.stats_txt())
+
     def painter_set_img_pix(self, img_pos, loc_stk_siz):
         if self.img2show[0:4] == "mask":
             tmp_min = -0.5
@@ -2014,6 +2199,12 @@ class MyImgWin(QWidget):
         if self.video_timer.isActive():
             logger.debug("Stoping video")
             self.video_timer.stop()
+            if self.play_engine is not None and self.play_engine.playing:
+                self.play_engine.stop()
+                logger.info(self.play_engine.stats_txt())
+                # the last frame shown, with its reflections
+                self.set_img()
+
             try:
                 self.video_timer.timeout.disconnect()
             except BaseException as e:
@@ -2024,11 +2215,82 @@ class MyImgWin(QWidget):
                 )
                 logger.debug("unable to disconnect timer again")
 
+        elif self.can_play_decoded():
+            logger.debug("Playing Video with decoder processes")
+            if self.play_engine is None:
+                self.play_engine = PlaybackEngine(
+                    self.expt_path,
+                    self.img_arr.all(),
+                    len(self.my_sweep.indices()),
+                    self.pan_num,
+                    n_decoders=sys_arg.play_decoders,
+                )
+
+            self.play_engine.set_look(self.palette, self.i_min, self.i_max)
+            self.play_engine.play(self.img_num - 1, fps=sys_arg.play_fps)
+            self.video_timer.timeout.connect(self.play_tick)
+            self.video_timer.start(max(1, int(1000 / sys_arg.play_fps)))
+
         else:
             logger.debug("Playing Video")
             self.video_timer.timeout.connect(self.btn_next_clicked)
             self.video_timer.start(1)
 
+    def can_play_decoded(self):
+        """Whether the movie can come from the decoder processes"""
+        return (
+            self.expt_path is not None
+            and self.my_sweep is not None
+            and self.img2show == "origin"
+            and self.stack_size == 1
+            and sys_arg.play_fps > 0
+            and shared_memory is not None
+        )
+
+    def play_tick(self):
+        """Paints the frame due now, if the decoders have it ready"""
+        self.play_engine.set_look(self.palette, self.i_min, self.i_max)
+        frame = self.play_engine.next_frame()
+        if frame is None:
+            return
+
+        img_pos, bgrx_arr = frame
+        self.img_num = img_pos + 1
+        # moving the spin box must not decode the frame once more
+        self.img_select.blockSignals(True)
+        self.img_select.setValue(self.img_num)
+        self.img_select.blockSignals(False)
+
+        q_img = QImage(
+            bgrx_arr.data, bgrx_arr.shape[1], bgrx_arr.shape[0], QImage.Format_RGB32
+        )
+        if (
+            self.find_spt_flat_data_lst == [None]
+            and self.pred_spt_flat_data_lst == [None]
+        ):
+            self.my_painter.set_img_pix(q_img)
+
+        else:
+            self.my_painter.set_img_pix(
+                q_img=q_img,
+                obs_flat_data_in=self.find_spt_flat_data_lst[img_pos : img_pos + 1],
+                pre_flat_data_in=self.pred_spt_flat_data_lst[img_pos : img_pos + 1],
+                user_choice_in=(
+                    self.rad_but_fnd_hkl.checkState(),
+                    self.rad_but_pre_hkl.checkState(),
+                ),
+            )
+
+        self.img_select.setToolTip(self.play_engine.stats_txt())
+
+    def close_playback(self):
+        if self.play_engine is not None:
+            if self.video_timer.isActive():
+                self.btn_play_clicked()
+
+            self.play_engine.close()
+            self.play_engine = None
+
     def new_sliders_pos(self, pos1, pos2):
         self.max_i_edit.setText(str(int(pos1)))
         self.min_i_edit.setText(str(int(pos2)))
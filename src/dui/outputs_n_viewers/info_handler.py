@@ -24,6 +24,7 @@ from __future__ import absolute_import, division, print_function
 
 import logging
 import json
+import os
 import sys
 
 from dxtbx.model.experiment_list import ExperimentListFactory
@@ -80,6 +81,9 @@ class InfoData(object):
 
         self.np_mask = None
         self.mask_flex = None
+        # every panel of the mask and (path, mtime) of its file
+        self.mask_tup = None
+        self.mask_key = None
 
 
 def update_all_data(reflections_path=None, experiments_path=None):
@@ -153,11 +157,18 @@ def update_all_data(reflections_path=None, experiments_path=None):
             dat.mask_flex = mask_tup_obj[0]
             mask_np_arr = dat.mask_flex.as_numpy_array()
             dat.np_mask = mask_np_arr
+            dat.mask_tup = mask_tup_obj
+            dat.mask_key = (
+                os.path.abspath(mask_file),
+                os.path.getmtime(mask_file),
+            )
 
         except IOError:
             print("No mask in this node")
             dat.np_mask = None
             dat.mask_flex = None
+            dat.mask_tup = None
+            dat.mask_key = None
 
         # FIXME it takes just the first experiment. What if there are more?
         exp = experiments[0]
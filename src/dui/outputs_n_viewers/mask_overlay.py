@@ -0,0 +1,111 @@
+"""
+Red overlay of the masked pixels in the image viewer
+
+The overlay is a BGRA image as big as the shown image: panels stacked as
+<< panel_data_as_double >> stacks them, masked pixels red and half
+transparent, the rest fully transparent. It is built with NumPy in one
+go and, as the mask of a node only changes when its file does, kept by
+MaskOverlayCache per mask file and modification time.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# rows between stacked panels, as in << panel_data_as_double >>
+PANEL_GAP = 18
+
+# number of panels the viewer shows stacked, otherwise only the first one
+N_STACKED_PANELS = 24
+
+# colour of masked pixels, in the byte order of QImage.Format_ARGB32
+MASK_BGRA = (0, 0, 255, 175)
+
+# overlays kept, one per mask file
+N_OVERLAYS = 4
+
+
+def stacked_mask(lst_np_mask):
+    """
+    Boolean mask of the whole shown image (True where pixels are good),
+    from the mask of each panel
+    """
+    if len(lst_np_mask) != N_STACKED_PANELS:
+        return np.asarray(lst_np_mask[0], dtype=bool)
+
+    pan_height, pan_width = np.shape(lst_np_mask[0])
+    pan_step = pan_height + PANEL_GAP
+    np_stacked = np.ones((pan_step * len(lst_np_mask), pan_width), dtype=bool)
+    for pan_num, np_mask in enumerate(lst_np_mask):
+        top = pan_num * pan_step
+        np_stacked[top : top + pan_height, :] = np_mask
+
+    return np_stacked
+
+
+def overlay_bgra(np_mask):
+    """BGRA image, red where << np_mask >> is False and transparent elsewhere"""
+    np_masked = ~np.asarray(np_mask, dtype=bool)
+    img_array = np.zeros(np_masked.shape + (4,), dtype=np.uint8)
+    for channel, value in enumerate(MASK_BGRA):
+        if value:
+            # one pass per channel, no index arrays
+            np.multiply(np_masked, value, out=img_array[..., channel], casting="unsafe")
+
+    return img_array
+
+
+class MaskOverlayCache(object):
+    """
+    Last << n_overlays >> results of << build_fun() >>, by key, the
+    (path, mtime) of the mask file. Nothing is kept for the key None.
+    """
+
+    def __init__(self, n_overlays=N_OVERLAYS):
+        self.n_overlays = n_overlays
+        self.n_built = 0
+        self._overlays = OrderedDict()
+
+    def get(self, key, build_fun):
+        if key is not None and key in self._overlays:
+            self._overlays.move_to_end(key)
+            return self._overlays[key]
+
+        overlay = build_fun()
+        self.n_built += 1
+        if key is not None:
+            self._overlays[key] = overlay
+            while len(self._overlays) > self.n_overlays:
+                self._overlays.popitem(last=False)
+
+        return overlay
+
+    def clear(self):
+        self._overlays.clear()
+
+
+# one for every viewer, the same mask is shown in all of them
+mask_overlays = MaskOverlayCache()
@@ -0,0 +1,379 @@
+"""
+Playing a sweep as a movie in the image viewer
+
+Decoding and palette mapping a frame takes longer than showing it, so a
+pool of decoder processes does both and leaves the finished BGRX images in
+a ring of slots in shared memory. The GUI thread, at the target frame
+rate, only asks << PlaybackEngine.next_frame >> for the latest frame due
+and paints it; the frames that were not ready in time are dropped instead
+of slowing the movie down.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+
+except ImportError:
+    # Python < 3.8, the viewer plays the movie with its timer only
+    shared_memory = None
+
+try:
+    from queue import Empty
+
+except ImportError:
+    from Queue import Empty
+
+logger = logging.getLogger(__name__)
+
+# frames per second of the movie
+PLAY_FPS = 30
+
+# finished frames the decoders may be ahead of the movie
+N_SLOTS = 8
+
+# most decoder processes started when not told how many
+MAX_DECODERS = 4
+
+
+def load_imageset(expt_path):
+    """First imageset of the experiments in << expt_path >>"""
+    from dxtbx.model.experiment_list import ExperimentListFactory
+
+    return ExperimentListFactory.from_json_file(expt_path).imagesets()[0]
+
+
+def render_frame(imageset, index, pan_num, palette, i_min, i_max):
+    """BGRX image of the frame << index >>, as the viewer paints it"""
+    from dials.array_family import flex
+
+    try:
+        from img_view_tools import img_w_cpp, panel_data_as_double
+
+    except ImportError:
+        from .img_view_tools import img_w_cpp, panel_data_as_double
+
+    img_flex = panel_data_as_double(imageset, index, pan_num)
+    flex_mask = flex.double(flex.grid(img_flex.all()[0], img_flex.all()[1]), 0)
+    return img_w_cpp()(img_flex, flex_mask, i_min=i_min, i_max=i_max, palette=palette)
+
+
+def decode_loop(
+    shm_name, ring_shape, expt_path, pan_num, task_q, done_q, load_fun, render_fun
+):
+    """
+    Body of each decoder process: renders the frames asked in << task_q >>
+    into their slot of the ring and tells << done_q >>, until it gets None
+    """
+    try:
+        from frame_cache import frame_cache
+
+    except ImportError:
+        from .frame_cache import frame_cache
+
+    # every frame is decoded once, keeping them is the job of the ring
+    frame_cache.max_bytes = 0
+    shm = shared_memory.SharedMemory(name=shm_name)
+    ring = np.ndarray(ring_shape, dtype=np.uint8, buffer=shm.buf)
+    try:
+        imageset = load_fun(expt_path)
+        for task in iter(task_q.get, None):
+            gen, slot, seq, index, palette, i_min, i_max = task
+            try:
+                ring[slot] = render_fun(imageset, index, pan_num, palette, i_min, i_max)
+                done_ok = True
+
+            except Exception as e:
+                logger.info("could not decode image %s: %s", index, e)
+                done_ok = False
+
+            done_q.put((gen, slot, seq, done_ok))
+
+    finally:
+        del ring
+        shm.close()
+
+
+class PlaybackEngine(object):
+    """
+    Frames of << expt_path >> (<< n_img >> images of << shape >> pixels)
+    decoded by << n_decoders >> processes into << n_slots >> shared slots.
+
+    << load_fun(expt_path) >> and << render_fun(imageset, index, pan_num,
+    palette, i_min, i_max) >> run in the decoder processes, so they must
+    be importable module level functions.
+    """
+
+    def __init__(
+        self,
+        expt_path,
+        shape,
+        n_img,
+        pan_num=0,
+        n_decoders=0,
+        n_slots=N_SLOTS,
+        load_fun=load_imageset,
+        render_fun=render_frame,
+    ):
+        if n_decoders < 1:
+            n_decoders = max(1, min(MAX_DECODERS, multiprocessing.cpu_count() - 1))
+
+        self.expt_path = expt_path
+        self.shape = tuple(shape)
+        self.n_img = n_img
+        self.pan_num = pan_num
+        self.n_decoders = n_decoders
+        self.n_slots = max(n_slots, n_decoders + 2)
+        self.load_fun = load_fun
+        self.render_fun = render_fun
+
+        self.palette = "hot ascend"
+        self.i_min = -3
+        self.i_max = 100
+        self.fps = PLAY_FPS
+        self.playing = False
+        self.n_shown = 0
+        self.n_dropped = 0
+
+        self._gen = 0
+        self._procs = []
+        self._shm = None
+        self._ring = None
+        # per slot: None when free, ("busy", gen, seq), ("ready", seq) or
+        # ("shown", seq) for the one being painted
+        self._slots = []
+        self._shown_slot = None
+
+    def start(self):
+        """Creates the ring and starts the decoders, once"""
+        if self._procs:
+            return
+
+        ring_shape = (self.n_slots,) + self.shape + (4,)
+        n_bytes = int(np.prod(ring_shape))
+        self._shm = shared_memory.SharedMemory(create=True, size=n_bytes)
+        self._ring = np.ndarray(ring_shape, dtype=np.uint8, buffer=self._shm.buf)
+        self._slots = [None] * self.n_slots
+
+        # the GUI process must not be forked
+        mp_ctx = multiprocessing.get_context("spawn")
+        self._task_q = mp_ctx.Queue()
+        self._done_q = mp_ctx.Queue()
+        for _ in range(self.n_decoders):
+            proc = mp_ctx.Process(
+                target=decode_loop,
+                args=(
+                    self._shm.name,
+                    ring_shape,
+                    self.expt_path,
+                    self.pan_num,
+                    self._task_q,
+                    self._done_q,
+                    self.load_fun,
+                    self.render_fun,
+                ),
+            )
+            proc.daemon = True
+            proc.start()
+            self._procs.append(proc)
+
+        logger.info(
+            "playback with %s decoders, %s slots of %.0f MB",
+            self.n_decoders,
+            self.n_slots,
+            n_bytes / self.n_slots / 1024 ** 2,
+        )
+
+    def set_look(self, palette, i_min, i_max):
+        """Palette and contrast of the frames decoded from now on"""
+        self.palette = palette
+        self.i_min = i_min
+        self.i_max = i_max
+
+    def play(self, first, step=1, fps=PLAY_FPS, now=None):
+        """
+        Starts the movie at image << first >> (0 based), every << step >>
+        images, looping at the end
+        """
+        self.start()
+        self._gen += 1
+        self.first = first
+        self.step = max(1, step)
+        self.fps = max(1, fps)
+        self.t0 = time.time() if now is None else now
+        self.last_seq = -1
+        self.next_seq = 0
+        self.n_shown = 0
+        self.n_dropped = 0
+        # the frame painted and those decoded for the old movie are of no
+        # use, nor the old tasks no decoder took yet; slots a decoder is
+        # still writing are freed when it is done, by << _collect >>
+        for slot, state in enumerate(self._slots):
+            if state is not None and state[0] in ("ready", "shown"):
+                self._free(slot)
+
+        while True:
+            try:
+                task = self._task_q.get_nowait()
+
+            except Empty:
+                break
+
+            self._free(task[1])
+
+        self.playing = True
+        self._submit(0)
+
+    def stop(self):
+        """Pauses the movie, frames still decoding are dropped when done"""
+        self.playing = False
+        self._gen += 1
+
+    def index_of(self, seq):
+        return (self.first + seq * self.step) % self.n_img
+
+    def _free(self, slot):
+        self._slots[slot] = None
+        if slot == self._shown_slot:
+            self._shown_slot = None
+
+    def _collect(self):
+        while True:
+            try:
+                gen, slot, seq, done_ok = self._done_q.get_nowait()
+
+            except Empty:
+                return
+
+            if self._slots[slot] != ("busy", gen, seq):
+                # its task was taken back by << play >>
+                continue
+
+            if gen != self._gen or not done_ok or seq <= self.last_seq:
+                # from a previous play, failed, or too late to be shown
+                self._free(slot)
+                if gen == self._gen and self.playing:
+                    self.n_dropped += 1
+
+            else:
+                self._slots[slot] = ("ready", seq)
+
+    def n_ready(self):
+        """Frames decoded and waiting for their time to be shown"""
+        self._collect()
+        return sum(
+            1 for state in self._slots if state is not None and state[0] == "ready"
+        )
+
+    def _submit(self, clock_seq):
+        if self.next_seq < clock_seq:
+            # no time for these, better than showing them late
+            self.n_dropped += clock_seq - self.next_seq
+            self.next_seq = clock_seq
+
+        for slot, state in enumerate(self._slots):
+            if state is None:
+                seq = self.next_seq
+                self._slots[slot] = ("busy", self._gen, seq)
+                self._task_q.put(
+                    (
+                        self._gen,
+                        slot,
+                        seq,
+                        self.index_of(seq),
+                        self.palette,
+                        self.i_min,
+                        self.i_max,
+                    )
+                )
+                self.next_seq += 1
+
+    def next_frame(self, now=None):
+        """
+        The latest frame due at << now >>, as (index, BGRX array of
+        shape + (4,)), or None when there is nothing new to show.
+
+        The array stays valid until a later call returns another frame.
+        """
+        if not self.playing:
+            return None
+
+        if now is None:
+            now = time.time()
+
+        self._collect()
+        clock_seq = int((now - self.t0) * self.fps)
+        lst_due = sorted(
+            (state[1], slot)
+            for slot, state in enumerate(self._slots)
+            if state is not None and state[0] == "ready" and state[1] <= clock_seq
+        )
+        frame = None
+        if lst_due:
+            seq, slot = lst_due[-1]
+            for _, old_slot in lst_due[:-1]:
+                self._free(old_slot)
+                self.n_dropped += 1
+
+            if self._shown_slot is not None:
+                self._free(self._shown_slot)
+
+            self._slots[slot] = ("shown", seq)
+            self._shown_slot = slot
+            self.last_seq = seq
+            self.n_shown += 1
+            frame = (self.index_of(seq), self._ring[slot])
+
+        self._submit(clock_seq + 1)
+        return frame
+
+    def stats_txt(self):
+        n_frames = self.n_shown + self.n_dropped
+        return "{} frames shown, {} dropped ({:.0%}) at {} fps target".format(
+            self.n_shown,
+            self.n_dropped,
+            self.n_dropped / n_frames if n_frames else 0.0,
+            self.fps,
+        )
+
+    def close(self):
+        """Stops the decoders and frees the shared memory"""
+        self.playing = False
+        for _ in self._procs:
+            self._task_q.put(None)
+
+        for proc in self._procs:
+            proc.join(5)
+            if proc.is_alive():
+                proc.terminate()
+
+        self._procs = []
+        if self._shm is not None:
+            self._ring = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
@@ -83,6 +83,12 @@ class WebTab(QWidget):
             print("\n failed to show <<", new_path,  ">>  on web view (",e,")")
             self.web.setHtml(self.dummy_html)
 
+    def show_placeholder(self, txt_msg):
+        """Shown while the report of this step is still being generated"""
+        self.web.setHtml(
+            "<html><body><h3>" + txt_msg + "</h3></body></html>"
+        )
+
     def load_finished(self, ok_bool):
         print("HTML Load(ok) = %s", ok_bool)
         tmp_off = '''
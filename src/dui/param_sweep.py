@@ -0,0 +1,232 @@
+"""
+Parameter sweeps on DUI's navigation tree, one sibling node per combination
+of parameters, all run in the background by a BranchScheduler
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+from collections import OrderedDict
+import itertools
+import logging
+import os
+import re
+
+try:
+    from cli_utils import sys_arg
+
+except ImportError:
+    from .cli_utils import sys_arg
+
+logger = logging.getLogger(__name__)
+
+# metrics read from the log of each step, in the order shown in tables
+METRIC_NAMES = ["strong_spots", "indexed_%", "rmsd_x", "rmsd_y", "rmsd_z"]
+
+_saved_refl_re = re.compile(r"Saved (\d+) reflections to")
+
+
+def parse_grid_text(txt):
+    """
+    Reads a grid written one parameter per line as << name=value1,value2 >>
+
+    Returns:
+        (OrderedDict): parameter name -> list of values
+    """
+    grid = OrderedDict()
+    for lin in txt.splitlines():
+        lin = lin.strip()
+        if not lin or lin.startswith("#"):
+            continue
+
+        if "=" not in lin:
+            raise ValueError("missing << = >> in: " + lin)
+
+        name, values = lin.split("=", 1)
+        lst_val = [val.strip() for val in values.split(",") if val.strip()]
+        if not name.strip() or not lst_val:
+            raise ValueError("no values in: " + lin)
+
+        grid[name.strip()] = lst_val
+
+    return grid
+
+
+def expand_grid(grid):
+    """Every combination of the values in << grid >>, as a list of OrderedDict"""
+    lst_name = list(grid.keys())
+    return [
+        OrderedDict(zip(lst_name, values))
+        for values in itertools.product(*[grid[name] for name in lst_name])
+    ]
+
+
+def apply_params(cmd_lst, params):
+    """
+    Copy of << cmd_lst >> (as in << ll_command_lst >>) with the parameters
+    in << params >> replacing any previous value of the same parameter
+    """
+    lst_inner = [cmd_lst[0][0]]
+    for par in cmd_lst[0][1:]:
+        if par.split("=", 1)[0] not in params:
+            lst_inner.append(par)
+
+    for name, value in params.items():
+        lst_inner.append(name + "=" + str(value))
+
+    return [lst_inner] + [list(cmd) for cmd in cmd_lst[1:]]
+
+
+def _table_numbers(lin):
+    """Numbers of a "| 0 | 12 | 0.3 |" table row, None if it is not one"""
+    if not lin.startswith("|"):
+        return None
+
+    try:
+        return [float(cell) for cell in lin.strip("| \n").split("|")]
+
+    except ValueError:
+        return None
+
+
+def read_step_metrics(log_path):
+    """
+    Picks the strong spot count, the indexed fraction and the RMSDs from
+    the log of a DIALS step, the last value printed wins
+
+    Returns:
+        (dict): metric name -> number, only for metrics found
+    """
+    metrics = {}
+    table = None
+    with open(log_path) as log_in:
+        for lin in log_in:
+            lin = lin.strip()
+            saved_match = _saved_refl_re.search(lin)
+            if saved_match:
+                metrics["strong_spots"] = int(saved_match.group(1))
+
+            if "% indexed" in lin:
+                table = "indexed"
+            elif "RMSD_X" in lin:
+                table = "rmsd"
+            elif not lin.startswith(("|", "+", "-")):
+                table = None
+
+            numbers = _table_numbers(lin) if table is not None else None
+            if numbers is None:
+                continue
+
+            if table == "indexed":
+                metrics["indexed_%"] = numbers[-1]
+
+            elif table == "rmsd" and len(numbers) >= 5:
+                metrics["rmsd_x"], metrics["rmsd_y"], metrics["rmsd_z"] = numbers[2:5]
+
+    return metrics
+
+
+def read_node_metrics(node):
+    if node.log_file_out is None:
+        return {}
+
+    log_path = os.path.join(sys_arg.directory, "dui_files", node.log_file_out)
+    try:
+        return read_step_metrics(log_path)
+
+    except (IOError, OSError) as e:
+        logger.debug("no metrics for node %s: %s", node.lin_num, e)
+        return {}
+
+
+class ParamSweep(object):
+    """
+    Forks one sibling of a node per combination of a parameter grid and
+    hands them to << scheduler >>, which runs them concurrently
+    """
+
+    def __init__(self, runner, scheduler):
+        self.runner = runner
+        self.scheduler = scheduler
+        self.lst_entry = []
+        self._metrics = {}
+
+    def start(self, base_node, cmd_lst, grid):
+        """
+        Runs << cmd_lst >> with every combination of << grid >>, the first
+        one on << base_node >> itself if it did not run yet
+
+        Returns:
+            (List[CommandNode]): the nodes of this sweep
+        """
+        if base_node.prev_step is None:
+            raise ValueError("the Root node can not be swept")
+
+        lst_comb = expand_grid(grid)
+        lst_new = []
+        with self.runner.lock:
+            for params in lst_comb:
+                if (
+                    not lst_new
+                    and base_node.success is None
+                    and not self.scheduler.is_busy(base_node)
+                ):
+                    node = base_node
+
+                else:
+                    node = self.runner.add_branch(base_node.prev_step)
+
+                lst_new.append((node, params))
+
+        for node, params in lst_new:
+            self.scheduler.submit(node, apply_params(cmd_lst, params))
+
+        self.lst_entry += lst_new
+        return [node for node, _ in lst_new]
+
+    def results(self):
+        """
+        One row per node of the sweep with its lin_num, parameters, state
+        and metrics (once the node finished)
+        """
+        lst_row = []
+        for node, params in self.lst_entry:
+            if node.success is True and node.lin_num not in self._metrics:
+                self._metrics[node.lin_num] = read_node_metrics(node)
+
+            if node.run_state is not None:
+                state = node.run_state
+
+            elif node.success is None:
+                state = "cancelled"
+
+            else:
+                state = "done" if node.success else "failed"
+
+            lst_row.append(
+                {
+                    "lin_num": node.lin_num,
+                    "params": params,
+                    "state": state,
+                    "metrics": self._metrics.get(node.lin_num, {}),
+                }
+            )
+
+        return lst_row
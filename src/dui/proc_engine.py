@@ -0,0 +1,197 @@
+"""
+Non-blocking runner of the processes DUI launches
+
+The output of the process is read in big chunks by an asyncio event loop,
+every line goes to the log file on disk straight away while the UI gets
+them in batches, at most << MAX_UI_RATE >> times per second.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import asyncio
+import logging
+import subprocess
+import time
+from collections import deque
+
+try:
+    from tracing import tracer
+
+except ImportError:
+    from .tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# batches of lines handed to the UI per second, at most
+MAX_UI_RATE = 20
+
+# bytes read from the pipe at once
+CHUNK_SIZE = 64 * 1024
+
+# lines kept in memory, also the biggest batch the UI gets, older lines
+# of a batch are only in the log file
+TAIL_LINES = 2000
+
+
+class LineBatcher(object):
+    """
+    Splits the chunks read from a process into lines, appends them to
+    << out_log >> (a LineIndexedLog, or None) and keeps the ones the UI has
+    not seen yet until << flush >> hands them to << on_lines(str) >>
+    """
+
+    def __init__(self, out_log=None, on_lines=None, tail_lines=TAIL_LINES):
+        self.out_log = out_log
+        self.on_lines = on_lines
+        self.tail = deque(maxlen=tail_lines)
+        self.n_lines = 0
+        self.n_batches = 0
+        # time of the last output, a line or not (progress bars)
+        self.last_output = time.time()
+        self._partial = b""
+        self._pending = deque(maxlen=tail_lines)
+        self._n_skipped = 0
+
+    def _add_line(self, line):
+        line = line.rstrip(b"\r")
+        if self.out_log is not None:
+            self.out_log.append(line)
+
+        txt_lin = line.decode("utf-8", "replace")
+        if len(self._pending) == self._pending.maxlen:
+            self._n_skipped += 1
+
+        self._pending.append(txt_lin)
+        self.tail.append(txt_lin)
+        self.n_lines += 1
+
+    def feed(self, chunk):
+        if chunk:
+            self.last_output = time.time()
+
+        lst_line = (self._partial + chunk).split(b"\n")
+        self._partial = lst_line.pop()
+        for line in lst_line:
+            self._add_line(line)
+
+    def finish(self):
+        """Takes the last line even without a line end"""
+        if self._partial:
+            self._add_line(self._partial)
+            self._partial = b""
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        lst_lin = list(self._pending)
+        if self._n_skipped:
+            lst_lin.insert(
+                0, "... {} lines only in the log file".format(self._n_skipped)
+            )
+
+        self._pending.clear()
+        self._n_skipped = 0
+        self.n_batches += 1
+        if self.on_lines is not None:
+            self.on_lines("\n".join(lst_lin))
+
+    def tail_lines(self):
+        return list(self.tail)
+
+
+async def _run_async(run_cmd, cwd_path, batcher, use_shell, on_start, max_rate):
+    if use_shell:
+        my_process = await asyncio.create_subprocess_shell(
+            run_cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=cwd_path,
+        )
+
+    else:
+        my_process = await asyncio.create_subprocess_exec(
+            *run_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd_path
+        )
+
+    start_us = time.time() * 1e6
+    if on_start is not None:
+        on_start(my_process.pid)
+
+    async def flush_often():
+        while True:
+            await asyncio.sleep(1.0 / max_rate)
+            batcher.flush()
+
+    flush_task = asyncio.ensure_future(flush_often())
+    try:
+        while True:
+            chunk = await my_process.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+
+            batcher.feed(chunk)
+
+    finally:
+        flush_task.cancel()
+
+    batcher.finish()
+    batcher.flush()
+    exit_status = await my_process.wait()
+    if use_shell:
+        process_name = run_cmd.split(" ", 1)[0]
+
+    else:
+        process_name = run_cmd[0]
+
+    tracer.process(process_name, my_process.pid, start_us, exit_status)
+    return exit_status
+
+
+def run_process(
+    run_cmd,
+    cwd_path=None,
+    batcher=None,
+    use_shell=False,
+    on_start=None,
+    max_rate=MAX_UI_RATE,
+):
+    """
+    Runs << run_cmd >> (a list, or a string with << use_shell >>) until it
+    ends, feeding its output to << batcher >> (a LineBatcher).
+    << on_start(pid) >> is called as soon as the process exists.
+
+    Blocks the calling thread, which gets its own event loop.
+
+    Returns:
+        (int): exit status of the process
+    """
+    if batcher is None:
+        batcher = LineBatcher()
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _run_async(run_cmd, cwd_path, batcher, use_shell, on_start, max_rate)
+        )
+
+    finally:
+        loop.close()
@@ -0,0 +1,163 @@
+"""
+Keeping DIALS steps from starving the GUI or the whole workstation
+
+Every process DUI launches on this host gets, as soon as it starts:
+
+    a nice level      << step_nice >>, the GUI keeps its own
+    a CPU affinity    every allowed core but the first << gui_cores >>,
+                      left for the GUI (only with more than 2 cores)
+    an address space  << vmem_limit_mb >> (RLIMIT_AS), allocations past
+                      it fail with MemoryError instead of swapping
+
+and, with << mem_limit_mb >>, a MemoryGuard stops the step once its whole
+process tree uses more resident memory than that.
+
+Children of a step (mp.nproc workers) inherit all of it.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import os
+import threading
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# nice level of the steps, the GUI runs at 0
+STEP_NICE = 10
+
+# cores the steps leave to the GUI
+GUI_CORES = 1
+
+# seconds between checks of the memory of a step
+GUARD_INTERVAL = 0.5
+
+# what a process prints when an allocation failed
+OOM_MARKS = ("MemoryError", "std::bad_alloc", "Cannot allocate memory")
+
+
+class StepLimits(object):
+    """Nice level, cores and address space limit of the processes of a step"""
+
+    def __init__(self, nice=STEP_NICE, gui_cores=GUI_CORES, vmem_limit_mb=0):
+        self.nice = nice
+        self.gui_cores = gui_cores
+        self.vmem_limit_mb = vmem_limit_mb
+
+    def cpus(self):
+        """Cores the steps may use, None for all of them"""
+        try:
+            lst_cpu = sorted(os.sched_getaffinity(0))
+
+        except AttributeError:
+            return None
+
+        if self.gui_cores < 1 or len(lst_cpu) <= max(2, self.gui_cores):
+            return None
+
+        return lst_cpu[self.gui_cores :]
+
+    def apply(self, pid):
+        """Sets the limits on the running process << pid >>"""
+        try:
+            proc = psutil.Process(pid)
+            if self.nice and proc.nice() < self.nice:
+                # only lowering the priority needs no privileges
+                proc.nice(self.nice)
+
+            lst_cpu = self.cpus()
+            if lst_cpu is not None and hasattr(proc, "cpu_affinity"):
+                proc.cpu_affinity(lst_cpu)
+
+            if self.vmem_limit_mb and hasattr(psutil, "RLIMIT_AS"):
+                n_bytes = int(self.vmem_limit_mb * 1024 ** 2)
+                proc.rlimit(psutil.RLIMIT_AS, (n_bytes, n_bytes))
+
+        except (psutil.Error, OSError, ValueError) as e:
+            # the process may have ended already, nothing to limit
+            logger.debug("could not limit %s: %s", pid, e)
+
+
+def tree_rss(pid):
+    """Resident memory of << pid >> and all its children, in bytes"""
+    try:
+        parent_proc = psutil.Process(pid)
+        lst_proc = [parent_proc] + parent_proc.children(recursive=True)
+
+    except psutil.Error:
+        return 0
+
+    rss = 0
+    for proc in lst_proc:
+        try:
+            rss += proc.memory_info().rss
+
+        except psutil.Error:
+            continue
+
+    return rss
+
+
+def says_out_of_memory(lst_lin):
+    """Whether the last lines of output tell an allocation failed"""
+    return any(mark in lin for lin in lst_lin for mark in OOM_MARKS)
+
+
+class MemoryGuard(object):
+    """
+    Calls << on_over(rss) >> once, when the process tree of << pid >> uses
+    more than << mem_limit_mb >> of resident memory
+    """
+
+    def __init__(self, pid, mem_limit_mb, on_over, interval=GUARD_INTERVAL):
+        self.pid = pid
+        self.limit = mem_limit_mb * 1024 ** 2
+        self.on_over = on_over
+        self.interval = interval
+        self.rss_over = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def check(self):
+        rss = tree_rss(self.pid)
+        if rss > self.limit:
+            self.rss_over = rss
+            self.on_over(rss)
+            return True
+
+        return False
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            if self.check():
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
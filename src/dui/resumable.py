@@ -0,0 +1,226 @@
+"""
+Steps that can be stopped and continued later
+
+A step made of several commands records each one that finished in a
+checkpoint file, running the step again skips those whose outputs are
+still there. Outputs of a command stopped half way are moved aside to
+dui_files/quarantine so nothing reads them by mistake.
+
+Only with the explicit << integrate_blocks=N >> (off by default),
+integrate becomes N such commands over consecutive image ranges
+(dials.slice_sequence + dials.integrate each), joined at the end by
+dials.combine_experiments. That is NOT the same result as integrating in
+one go: each block becomes an experiment of its own, with its own
+profile model, which later steps (scaling) see as N sweeps. Experiments
+with more than one scan are always integrated in one go.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+QUARANTINE_DIR = "quarantine"
+
+
+def output_files(lst_single):
+    """Files a command writes, from its output.*=file arguments"""
+    return [
+        arg.split("=", 1)[1]
+        for arg in lst_single[1:]
+        if arg.startswith("output.") and "=" in arg
+    ]
+
+
+def quarantine_outputs(cwd_path, lst_single):
+    """
+    Moves what a stopped command left of its outputs to the quarantine
+    directory, replacing an older attempt of the same files
+
+    Returns:
+        (List[str]): names of the files moved
+    """
+    quarantine_path = os.path.join(cwd_path, QUARANTINE_DIR)
+    lst_moved = []
+    for file_name in output_files(lst_single):
+        src_path = os.path.join(cwd_path, file_name)
+        if not os.path.isfile(src_path):
+            continue
+
+        if not os.path.isdir(quarantine_path):
+            os.makedirs(quarantine_path)
+
+        try:
+            os.replace(src_path, os.path.join(quarantine_path, file_name))
+            lst_moved.append(file_name)
+
+        except OSError as e:
+            logger.warning("could not quarantine %s: %s", file_name, e)
+
+    return lst_moved
+
+
+class StepCheckpoint(object):
+    """
+    Which commands of << lst_cmd >> finished, in the file << path >>, with
+    the size of their outputs to tell whether these are still there
+    """
+
+    def __init__(self, path, lst_cmd):
+        self.path = path
+        self.lst_cmd = [list(lst_single) for lst_single in lst_cmd]
+        self.lst_done = []
+
+    def n_done(self, cwd_path):
+        """Number of leading commands that can be skipped"""
+        try:
+            with open(self.path) as ckpt_in:
+                ckpt_dict = json.load(ckpt_in)
+
+        except (IOError, OSError, ValueError):
+            return 0
+
+        if ckpt_dict.get("cmds") != self.lst_cmd:
+            # other parameters or inputs, start again
+            return 0
+
+        self.lst_done = []
+        for size_dict in ckpt_dict["done"]:
+            for file_name, size in size_dict.items():
+                path = os.path.join(cwd_path, file_name)
+                if not os.path.isfile(path) or os.path.getsize(path) != size:
+                    return len(self.lst_done)
+
+            self.lst_done.append(size_dict)
+
+        return len(self.lst_done)
+
+    def mark_done(self, pos, cwd_path):
+        del self.lst_done[pos:]
+        size_dict = {}
+        for file_name in output_files(self.lst_cmd[pos]):
+            path = os.path.join(cwd_path, file_name)
+            if os.path.isfile(path):
+                size_dict[file_name] = os.path.getsize(path)
+
+        self.lst_done.append(size_dict)
+        with open(self.path + ".tmp", "w") as ckpt_out:
+            json.dump({"cmds": self.lst_cmd, "done": self.lst_done}, ckpt_out)
+
+        os.replace(self.path + ".tmp", self.path)
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def image_blocks(first, last, n_blocks):
+    """<< n_blocks >> (at most one per image) consecutive ranges of images"""
+    n_img = last - first + 1
+    n_blocks = max(1, min(n_blocks, n_img))
+    lst_block = []
+    start = first
+    for num in range(n_blocks):
+        stop = first + (n_img * (num + 1)) // n_blocks - 1
+        lst_block.append((start, stop))
+        start = stop + 1
+
+    return lst_block
+
+
+def split_integrate(lst_inner, lin_num, run_path, n_blocks):
+    """
+    Commands integrating the images in << n_blocks >> parts, given the
+    single dials.integrate command << lst_inner >>, or [lst_inner] when
+    the images can not be split (no scan, or more than one, in the
+    experiments). The blocks end as separate experiments.
+    """
+    arg_dict = {}
+    lst_par = []
+    for arg in lst_inner[1:]:
+        if arg.startswith(("input.", "output.")):
+            key, value = arg.split("=", 1)
+            arg_dict[key] = value
+
+        else:
+            lst_par.append(arg)
+
+    try:
+        with open(os.path.join(run_path, arg_dict["input.experiments"])) as exp_in:
+            lst_scan = json.load(exp_in)["scan"]
+
+        if len(lst_scan) != 1:
+            raise ValueError("{} scans in the experiments".format(len(lst_scan)))
+
+        first, last = lst_scan[0]["image_range"]
+
+    except (IOError, OSError, ValueError, KeyError, IndexError) as e:
+        logger.warning("integrating in one go, no single image range: %s", e)
+        return [lst_inner]
+
+    logger.warning(
+        "integrating in %d blocks, combined as %d separate experiments",
+        n_blocks,
+        n_blocks,
+    )
+
+    lst_cmd = []
+    lst_expt = []
+    lst_refl = []
+    for num, (start, stop) in enumerate(image_blocks(first, last, n_blocks)):
+        prefix = "{}_block{}_".format(lin_num, num)
+        lst_cmd.append(
+            [
+                "dials.slice_sequence",
+                "input.experiments=" + arg_dict["input.experiments"],
+                "input.reflections=" + arg_dict["input.reflections"],
+                "image_range={},{}".format(start, stop),
+                "output.experiments=" + prefix + "sliced.expt",
+                "output.reflections=" + prefix + "sliced.refl",
+            ]
+        )
+        lst_cmd.append(
+            ["dials.integrate"]
+            + lst_par
+            + [
+                "input.experiments=" + prefix + "sliced.expt",
+                "input.reflections=" + prefix + "sliced.refl",
+                "output.experiments=" + prefix + "integrated.expt",
+                "output.reflections=" + prefix + "integrated.refl",
+                "output.log=" + prefix + "integrate.log",
+            ]
+        )
+        lst_expt.append("input.experiments=" + prefix + "integrated.expt")
+        lst_refl.append("input.reflections=" + prefix + "integrated.refl")
+
+    lst_cmd.append(
+        ["dials.combine_experiments"]
+        + lst_expt
+        + lst_refl
+        + [
+            "output.experiments=" + arg_dict["output.experiments"],
+            "output.reflections=" + arg_dict["output.reflections"],
+        ]
+    )
+    return lst_cmd
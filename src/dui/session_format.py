@@ -0,0 +1,338 @@
+"""
+On-disk format of DUI's navigation tree
+
+The snapshot (session.snapshot.json) holds a schema version and the
+skeleton of the tree: lin_num, parent, command and success of every node,
+plus the offset of the rest of each node (output files, full commands)
+inside a separate details file. Loading a session reads only the
+skeleton, the details of a node are read the first time it is used.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import json
+import logging
+import os
+import pickle
+import threading
+
+try:
+    import cli_utils
+    import m_idials
+    from m_idials import CommandNode, Runner
+    from cli_utils import DialsCommand
+
+except ImportError:
+    from . import cli_utils
+    from . import m_idials
+    from .m_idials import CommandNode, Runner
+    from .cli_utils import DialsCommand
+
+logger = logging.getLogger(__name__)
+
+FORMAT_NAME = "dui-session"
+SCHEMA_VERSION = 2
+
+SNAPSHOT_NAME = "session.snapshot.json"
+DETAILS_PREFIX = "session.details."
+
+# attributes of CommandNode read at startup, besides lin_num and parent
+SKELETON_FIELDS = ["ll_command_lst", "success"]
+
+# attributes of CommandNode read only when the node gets visited
+DETAIL_FIELDS = [
+    "refl_pickle_file_out",
+    "json_file_out",
+    "phil_file_out",
+    "log_file_out",
+    "report_out",
+    "predict_pickle_out",
+    "err_file_out",
+    "json_sym_out",
+    "cmd_lst_to_run",
+    "prefix_out",
+    "telemetry",
+]
+
+NODE_FIELDS = SKELETON_FIELDS + DETAIL_FIELDS
+
+
+class SessionFormatError(Exception):
+    pass
+
+
+def node_to_dict(node):
+    if node.prev_step is None:
+        parent = None
+
+    else:
+        parent = node.prev_step.lin_num
+
+    node_dict = {"lin_num": node.lin_num, "parent": parent}
+    for field in NODE_FIELDS:
+        node_dict[field] = getattr(node, field, None)
+
+    node_dict["full_cmd_lst"] = node.dials_command.full_cmd_lst
+    return node_dict
+
+
+def set_node_details(node, node_dict):
+    for field in DETAIL_FIELDS:
+        value = node_dict.get(field)
+        if field != "prefix_out" or value is not None:
+            setattr(node, field, value)
+
+    node.dials_command = DialsCommand()
+    node.dials_command.full_cmd_lst = node_dict.get("full_cmd_lst", [None])
+
+
+def node_from_dict(node_dict, prev_step, details_store=None):
+    """
+    Builds a node from a full node dictionary, or from a skeleton entry
+    (with a "details" offset) whose details are read later from
+    << details_store >>
+    """
+    if "details" in node_dict:
+        offset, length = node_dict["details"]
+        return CommandNode.lazy(
+            prev_step,
+            node_dict["lin_num"],
+            node_dict["ll_command_lst"],
+            node_dict["success"],
+            details_store.loader(offset, length),
+        )
+
+    node = CommandNode.lazy(
+        prev_step,
+        node_dict["lin_num"],
+        node_dict["ll_command_lst"],
+        node_dict["success"],
+        None,
+    )
+    set_node_details(node, node_dict)
+    return node
+
+
+class DetailsStore(object):
+    """
+    Read access to a details file, kept open so the file can be replaced
+    by a newer snapshot while the nodes of this one are still lazy
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._det_in = open(path, "rb")
+        self._lock = threading.Lock()
+
+    def read_raw(self, offset, length):
+        with self._lock:
+            self._det_in.seek(offset)
+            return self._det_in.read(length)
+
+    def loader(self, offset, length):
+        def load_details(node):
+            node_dict = json.loads(self.read_raw(offset, length).decode("utf-8"))
+            set_node_details(node, node_dict)
+
+        return load_details
+
+    def close(self):
+        self._det_in.close()
+
+
+def runner_from_state(state):
+    details_store = None
+    if state.get("details_path") is not None:
+        details_store = DetailsStore(state["details_path"])
+
+    step_list = []
+    node_dict = {}
+    for lin_num in sorted(state["nodes"]):
+        tmp_dict = state["nodes"][lin_num]
+        prev_step = node_dict.get(tmp_dict["parent"])
+        if tmp_dict["parent"] is not None and prev_step is None:
+            logger.debug("dropping orphan node %s", lin_num)
+            continue
+
+        node = node_from_dict(tmp_dict, prev_step, details_store)
+        if prev_step is not None:
+            prev_step.next_step_list.append(node)
+
+        node_dict[lin_num] = node
+        step_list.append(node)
+
+    return Runner.from_nodes(step_list, state["current_line"], state["bigger_lin"])
+
+
+def fsync_dir(dir_path):
+    try:
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+
+    except OSError:
+        # not possible on Windows, os.replace is already atomic there
+        return
+
+    try:
+        os.fsync(dir_fd)
+
+    finally:
+        os.close(dir_fd)
+
+
+def write_snapshot(dir_path, state, seq):
+    """
+    Writes the details file of << state >>, then atomically replaces the
+    snapshot pointing to it and removes older details files
+    """
+    det_name = DETAILS_PREFIX + str(seq)
+    det_path = os.path.join(dir_path, det_name)
+    lst_skel = []
+    src_store = None
+    with open(det_path + ".tmp", "wb") as det_out:
+        offset = 0
+        for lin_num in sorted(state["nodes"]):
+            node_dict = state["nodes"][lin_num]
+            if "details" in node_dict:
+                # unchanged node, copy its details without decoding them
+                if src_store is None:
+                    src_store = DetailsStore(state["details_path"])
+
+                raw = src_store.read_raw(*node_dict["details"])
+
+            else:
+                det_dict = {field: node_dict.get(field) for field in DETAIL_FIELDS}
+                det_dict["full_cmd_lst"] = node_dict.get("full_cmd_lst", [None])
+                raw = json.dumps(det_dict, separators=(",", ":")).encode("utf-8")
+
+            det_out.write(raw)
+            lst_skel.append(
+                [
+                    lin_num,
+                    node_dict["parent"],
+                    node_dict["ll_command_lst"],
+                    node_dict["success"],
+                    offset,
+                    len(raw),
+                ]
+            )
+            offset += len(raw)
+
+        det_out.flush()
+        os.fsync(det_out.fileno())
+
+    if src_store is not None:
+        src_store.close()
+
+    os.replace(det_path + ".tmp", det_path)
+
+    snapshot = {
+        "format": FORMAT_NAME,
+        "version": SCHEMA_VERSION,
+        "seq": seq,
+        "current_line": state["current_line"],
+        "bigger_lin": state["bigger_lin"],
+        "details": det_name,
+        "skeleton": lst_skel,
+    }
+    final_path = os.path.join(dir_path, SNAPSHOT_NAME)
+    with open(final_path + ".tmp", "w") as snp_out:
+        json.dump(snapshot, snp_out, separators=(",", ":"))
+        snp_out.flush()
+        os.fsync(snp_out.fileno())
+
+    os.replace(final_path + ".tmp", final_path)
+    fsync_dir(dir_path)
+    remove_stale_details(dir_path, det_name)
+
+
+def remove_stale_details(dir_path, det_name):
+    for file_name in os.listdir(dir_path):
+        if file_name.startswith(DETAILS_PREFIX) and file_name != det_name:
+            try:
+                os.remove(os.path.join(dir_path, file_name))
+
+            except OSError:
+                # still open by lazy nodes on Windows, next snapshot will do it
+                logger.debug("could not remove %s yet", file_name)
+
+
+def read_snapshot(dir_path):
+    """
+    Reads the skeleton of a saved tree
+
+    Returns:
+        (Tuple[dict, int]): state and sequence number of the snapshot
+    """
+    with open(os.path.join(dir_path, SNAPSHOT_NAME)) as snp_in:
+        snapshot = json.load(snp_in)
+
+    # no released DUI wrote any other schema
+    version = snapshot.get("version")
+    if version != SCHEMA_VERSION:
+        raise SessionFormatError(
+            "session saved with schema version {}, this DUI reads {}".format(
+                version, SCHEMA_VERSION
+            )
+        )
+
+    state = {
+        "nodes": {},
+        "current_line": snapshot["current_line"],
+        "bigger_lin": snapshot["bigger_lin"],
+        "details_path": os.path.join(dir_path, snapshot["details"]),
+    }
+    for lin_num, parent, ll_command_lst, success, offset, length in snapshot[
+        "skeleton"
+    ]:
+        state["nodes"][lin_num] = {
+            "lin_num": lin_num,
+            "parent": parent,
+            "ll_command_lst": ll_command_lst,
+            "success": success,
+            "details": (offset, length),
+        }
+
+    return state, snapshot["seq"]
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """
+    Finds the node classes wherever they were when the pickle was written,
+    bkp.pickle files from the CLI loop refer to them as __main__.Runner
+    """
+
+    moved_classes = {
+        "CommandNode": m_idials,
+        "Runner": m_idials,
+        "DialsCommand": cli_utils,
+    }
+
+    def find_class(self, module, name):
+        if name in self.moved_classes:
+            return getattr(self.moved_classes[name], name)
+
+        return pickle.Unpickler.find_class(self, module, name)
+
+
+def load_legacy_pickle(path):
+    """Reads a Runner from a bkp.pickle written by older versions of DUI"""
+    with open(path, "rb") as bkp_in:
+        return _LegacyUnpickler(bkp_in).load()
@@ -0,0 +1,305 @@
+"""
+DUI's append-only journal of changes in the navigation tree
+
+Every action done to the Runner (run, goto, mkchi, mksib, clean) is
+appended to << dui_files/session.journal >> as a small JSON record, so
+saving the session costs O(changes) instead of pickling the whole tree.
+From time to time the journal is folded into a snapshot by a background
+thread.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import json
+import logging
+import os
+import threading
+import zlib
+
+try:
+    from session_format import (
+        SNAPSHOT_NAME,
+        fsync_dir,
+        node_to_dict,
+        read_snapshot,
+        runner_from_state,
+        write_snapshot,
+    )
+
+except ImportError:
+    from .session_format import (
+        SNAPSHOT_NAME,
+        fsync_dir,
+        node_to_dict,
+        read_snapshot,
+        runner_from_state,
+        write_snapshot,
+    )
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_NAME = "session.journal"
+
+
+def apply_record(state, record):
+    """
+    Applies one journal record to a << state >> dictionary with the keys
+    "nodes" (lin_num -> node dict), "current_line" and "bigger_lin"
+    """
+    node_dict = record.get("node")
+    if node_dict is not None:
+        state["nodes"][node_dict["lin_num"]] = node_dict
+        if node_dict["lin_num"] > state["bigger_lin"]:
+            state["bigger_lin"] = node_dict["lin_num"]
+
+    for lin_num in record.get("removed", []):
+        state["nodes"].pop(lin_num, None)
+
+    state["current_line"] = record["cur"]
+
+
+def encode_record(record):
+    data = json.dumps(record, separators=(",", ":")).encode("utf-8")
+    return b"%08x\t" % (zlib.crc32(data) & 0xFFFFFFFF) + data + b"\n"
+
+
+def read_records(path):
+    """
+    Reads the valid records of a journal file, a torn or corrupted line
+    (from a crash while writing) ends the reading.
+
+    Returns:
+        (Tuple[List[dict], int]): records and byte length of the valid part
+    """
+    lst_rec = []
+    valid_len = 0
+    with open(path, "rb") as jrn_in:
+        for line in jrn_in:
+            if not line.endswith(b"\n"):
+                logger.debug("torn record at the end of %s", path)
+                break
+
+            try:
+                crc_str, data = line[:-1].split(b"\t", 1)
+                if int(crc_str, 16) != zlib.crc32(data) & 0xFFFFFFFF:
+                    raise ValueError("checksum mismatch")
+
+                lst_rec.append(json.loads(data.decode("utf-8")))
+
+            except ValueError as e:
+                logger.warning("corrupted record in %s: %s", path, e)
+                break
+
+            valid_len += len(line)
+
+    return lst_rec, valid_len
+
+
+class SessionJournal(object):
+    """
+    Write-ahead journal of the navigation tree living in << dui_files >>
+
+    Files:
+        session.snapshot.json   the whole tree up to some sequence number,
+                                see session_format
+        session.journal         records appended since then
+        session.journal.<seq>   older records waiting to be folded into
+                                the snapshot by the compacting thread
+
+    A record is one line "<crc32>\\t<json>", written and fsync-ed before
+    the action is considered saved.
+    """
+
+    def __init__(self, dir_path, compact_every=500):
+        self.dir_path = dir_path
+        self.compact_every = compact_every
+        self.runner = None
+        self.seq = 0
+        self.n_pending = 0
+        self._jrn_out = None
+        self._lock = threading.Lock()
+        self._compact_thread = None
+
+    @staticmethod
+    def exists(dir_path):
+        return os.path.isfile(os.path.join(dir_path, SNAPSHOT_NAME))
+
+    def _journal_path(self):
+        return os.path.join(self.dir_path, JOURNAL_NAME)
+
+    def _segment_paths(self):
+        """Rotated segments, oldest first"""
+        lst_seg = []
+        for file_name in os.listdir(self.dir_path):
+            if file_name.startswith(JOURNAL_NAME + "."):
+                try:
+                    seg_seq = int(file_name[len(JOURNAL_NAME) + 1 :])
+                    lst_seg.append((seg_seq, file_name))
+
+                except ValueError:
+                    logger.debug("ignoring %s", file_name)
+
+        return [os.path.join(self.dir_path, name) for _, name in sorted(lst_seg)]
+
+    def load_state(self):
+        """Replays the snapshot plus every journal record after it"""
+        state, snap_seq = read_snapshot(self.dir_path)
+        self.seq = snap_seq
+        self.n_pending = 0
+        for path in self._segment_paths() + [self._journal_path()]:
+            if not os.path.isfile(path):
+                continue
+
+            lst_rec, valid_len = read_records(path)
+            for record in lst_rec:
+                if record["seq"] > snap_seq:
+                    apply_record(state, record)
+                    self.n_pending += 1
+                    self.seq = max(self.seq, record["seq"])
+
+            if valid_len < os.path.getsize(path):
+                # drop the torn tail so next appends start on a clean line
+                with open(path, "r+b") as jrn_fix:
+                    jrn_fix.truncate(valid_len)
+
+        return state
+
+    def load(self):
+        """Rebuilds the Runner saved in << dir_path >>"""
+        return runner_from_state(self.load_state())
+
+    def attach(self, runner, fresh=True):
+        """
+        Starts journaling << runner >>, if << fresh >> the runner did not come
+        from this journal and a new snapshot of it is written first
+        """
+        self.close()
+        if fresh:
+            for path in self._segment_paths() + [self._journal_path()]:
+                if os.path.isfile(path):
+                    os.remove(path)
+
+            state = {
+                "nodes": {},
+                "current_line": runner.current_line,
+                "bigger_lin": runner.bigger_lin,
+                "details_path": None,
+            }
+            for node in runner.step_list:
+                state["nodes"][node.lin_num] = node_to_dict(node)
+
+            write_snapshot(self.dir_path, state, self.seq)
+            self.n_pending = 0
+
+        self.runner = runner
+        self._jrn_out = open(self._journal_path(), "ab")
+        runner.journal = self
+
+    def log(self, op, node=None, **extra):
+        if self._jrn_out is None:
+            return
+
+        record = dict(extra)
+        record["op"] = op
+        record["cur"] = self.runner.current_line
+        if node is not None:
+            record["node"] = node_to_dict(node)
+
+        with self._lock:
+            self.seq += 1
+            record["seq"] = self.seq
+            self._jrn_out.write(encode_record(record))
+            self._jrn_out.flush()
+            os.fsync(self._jrn_out.fileno())
+            self.n_pending += 1
+            to_compact = self.n_pending >= self.compact_every
+
+        if to_compact:
+            self.compact()
+
+    def log_node(self, node):
+        """Saves the current state of << node >> (results or edited commands)"""
+        self.log("node", node)
+
+    def _rotate(self):
+        """Moves the active journal aside, must be called holding the lock"""
+        self._jrn_out.close()
+        seg_path = self._journal_path() + "." + str(self.seq)
+        os.rename(self._journal_path(), seg_path)
+        fsync_dir(self.dir_path)
+        self._jrn_out = open(self._journal_path(), "ab")
+        self.n_pending = 0
+
+    def compact(self, wait=False):
+        """Folds the journal into the snapshot in a background thread"""
+        if self._compact_thread is not None and self._compact_thread.is_alive():
+            if wait:
+                self._compact_thread.join()
+
+            return
+
+        with self._lock:
+            if self._jrn_out is None:
+                return
+
+            self._rotate()
+
+        self._compact_thread = threading.Thread(target=self._fold_segments)
+        self._compact_thread.daemon = True
+        self._compact_thread.start()
+        if wait:
+            self._compact_thread.join()
+
+    def _fold_segments(self):
+        try:
+            state, snap_seq = read_snapshot(self.dir_path)
+            lst_seg = self._segment_paths()
+            last_seq = snap_seq
+            for path in lst_seg:
+                lst_rec, _ = read_records(path)
+                for record in lst_rec:
+                    if record["seq"] > snap_seq:
+                        apply_record(state, record)
+                        last_seq = max(last_seq, record["seq"])
+
+            write_snapshot(self.dir_path, state, last_seq)
+            for path in lst_seg:
+                os.remove(path)
+
+            logger.debug("compacted %s journal segments", len(lst_seg))
+
+        except (IOError, OSError, ValueError) as e:
+            # segments are kept, next compaction or load will retry them
+            logger.warning("failed to compact session journal: %s", e)
+
+    def close(self):
+        if self._compact_thread is not None:
+            self._compact_thread.join()
+            self._compact_thread = None
+
+        with self._lock:
+            if self._jrn_out is not None:
+                self._jrn_out.close()
+                self._jrn_out = None
+
+        if self.runner is not None:
+            self.runner.journal = None
+            self.runner = None
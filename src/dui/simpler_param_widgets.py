@@ -25,9 +25,8 @@ from __future__ import absolute_import, division, print_function
 import logging
 import sys
 
-import libtbx.introspection
-
 try:
+    from cli_utils import budget_for_session
     from qt import (
         QApplication,
         QComboBox,
@@ -43,6 +42,7 @@ try:
     )
 
 except ImportError:
+    from .cli_utils import budget_for_session
     from .qt import (
         QApplication,
         QComboBox,
@@ -190,7 +190,8 @@ class FindspotsSimplerParameterTab(QWidget):
         self.item_changed.emit(str_path, str_value)
 
     def set_max_nproc(self):
-        cpu_max_proc = int(libtbx.introspection.number_of_processors())
+        # the cores actually free are handed out when the step runs
+        cpu_max_proc = budget_for_session().n_cores
         self.box_nproc.setValue(cpu_max_proc)
         return cpu_max_proc
 
@@ -498,7 +499,8 @@ class IntegrateSimplerParamTab(QWidget):
         self.item_changed.emit(str_path, str_value)
 
     def set_max_nproc(self):
-        cpu_max_proc = int(libtbx.introspection.number_of_processors())
+        # the cores actually free are handed out when the step runs
+        cpu_max_proc = budget_for_session().n_cores
         self.box_nproc.setValue(cpu_max_proc)
         return cpu_max_proc
 
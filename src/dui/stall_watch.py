@@ -0,0 +1,166 @@
+"""
+Telling apart a slow step from a stuck one
+
+While a command runs, a StallWatchdog looks at how long ago it printed
+anything and how much CPU its processes use. A command silent for
+<< stall_s >> seconds with the CPU (almost) idle is flagged as stalled,
+typically a deadlock or a filesystem that stopped answering. What happens
+then depends on << stall_action >>:
+
+    flag      mark the node as stalled in the tree, dump its stacks
+    cancel    also stop it, the step fails
+    requeue   also stop it and run the step once more, from the last
+              command it finished
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+STALL_ACTIONS = ["flag", "cancel", "requeue"]
+
+# seconds without output before a command may be stalled
+STALL_S = 600.0
+
+# below this CPU use (% of one core) a silent command is not working
+IDLE_CPU = 5.0
+
+# seconds py-spy gets to dump the stacks of one process
+DUMP_TIMEOUT = 30
+
+
+class StallWatchdog(object):
+    """
+    Calls << on_stall(True, silent_s) >> once << batcher >> (a LineBatcher)
+    got nothing for << stall_s >> seconds while << cpu_fun() >> (% of one
+    core, None when not known) stays under << idle_cpu >>, and
+    << on_stall(False, 0) >> when output comes back
+    """
+
+    def __init__(
+        self, batcher, on_stall, cpu_fun=None, stall_s=STALL_S, idle_cpu=IDLE_CPU
+    ):
+        self.batcher = batcher
+        self.on_stall = on_stall
+        self.cpu_fun = cpu_fun
+        self.stall_s = stall_s
+        self.idle_cpu = idle_cpu
+        self.stalled = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def check(self, now=None):
+        if now is None:
+            now = time.time()
+
+        silent_s = now - self.batcher.last_output
+        if self.stalled:
+            if silent_s < self.stall_s:
+                self.stalled = False
+                self.on_stall(False, 0)
+
+            return self.stalled
+
+        if silent_s < self.stall_s:
+            return False
+
+        cpu = None if self.cpu_fun is None else self.cpu_fun()
+        if cpu is not None and cpu >= self.idle_cpu:
+            # busy with no output, slow but alive
+            return False
+
+        self.stalled = True
+        self.on_stall(True, silent_s)
+        return True
+
+    def _run(self):
+        # checking often enough to be late by a small part of stall_s
+        while not self._stopped.wait(max(0.1, min(5.0, self.stall_s / 10))):
+            self.check()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def stack_dump(pid, signal_ok=False):
+    """
+    Python stacks of << pid >> and its children, from py-spy when it is
+    installed. Without py-spy, << signal_ok >> (for processes that called
+    faulthandler.register(SIGUSR1), like the warm workers) makes the
+    process print them in its own output.
+
+    Returns:
+        (str): the stacks, or where to find them
+    """
+    py_spy = shutil.which("py-spy")
+    if py_spy is not None:
+        try:
+            lst_pid = [pid] + [
+                child.pid for child in psutil.Process(pid).children(recursive=True)
+            ]
+
+        except psutil.Error as e:
+            return "no process {} to dump: {}".format(pid, e)
+
+        lst_txt = []
+        for proc_pid in lst_pid:
+            try:
+                dump_out = subprocess.check_output(
+                    [py_spy, "dump", "--pid", str(proc_pid)],
+                    stderr=subprocess.STDOUT,
+                    timeout=DUMP_TIMEOUT,
+                )
+                dump_txt = dump_out.decode("utf-8", "replace")
+
+            except (OSError, subprocess.SubprocessError) as e:
+                dump_txt = "py-spy failed: {}".format(e)
+
+            lst_txt.append("--- pid {} ---\n{}".format(proc_pid, dump_txt))
+
+        return "\n".join(lst_txt)
+
+    if signal_ok and hasattr(signal, "SIGUSR1"):
+        try:
+            os.kill(pid, signal.SIGUSR1)
+
+        except OSError as e:
+            return "no process {} to dump: {}".format(pid, e)
+
+        return "stacks of {} printed in the output of the step".format(pid)
+
+    return "no stack dump of {}, install py-spy to get one".format(pid)
@@ -0,0 +1,315 @@
+"""
+Content-addressed cache of DIALS step results
+
+A step is identified by its command, its parameters (as the user gave them
+in << ll_command_lst >>) and the contents of its input files. When the same
+step runs again, the outputs of the previous run are hard linked into
+place instead of running DIALS again.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shlex
+import shutil
+import threading
+import time
+
+try:
+    from cli_utils import sys_arg
+
+except ImportError:
+    from .cli_utils import sys_arg
+
+logger = logging.getLogger(__name__)
+
+# bump when the way keys are computed changes, old entries then just miss
+CACHE_VERSION = 2
+
+# steps whose outputs depend only on their parameters and input files,
+# import reads images and bravais/reindex write files named after the node
+CACHEABLE_STEPS = ["find_spots", "index", "refine", "integrate", "symmetry", "scale"]
+
+# name of the captured output (<lin>_<cmd>_out.log) inside a cache entry
+OUT_LOG_ROLE = "out_log"
+
+
+def cache_for_session(dui_files_path):
+    """
+    StepCache of a session, sized after << sys_arg.cache_size_mb >>,
+    None when caching is turned off
+    """
+    if sys_arg.cache_size_mb <= 0:
+        return None
+
+    return StepCache(
+        os.path.join(dui_files_path, "step_cache"),
+        max_bytes=sys_arg.cache_size_mb * 1024 ** 2,
+    )
+
+
+def link_or_copy(src_path, dst_path):
+    """Hard links << src_path >> as << dst_path >>, copies if not possible"""
+    if os.path.lexists(dst_path):
+        os.remove(dst_path)
+
+    try:
+        os.link(src_path, dst_path)
+
+    except (OSError, AttributeError):
+        # other file system, or no hard links on it
+        shutil.copy2(src_path, dst_path)
+
+
+def cmd_file_args(cmd_lst_to_run, prefix):
+    """
+    Pairs (parameter, file name) of every << prefix >>*=value argument
+    in the commands to run, e.g. ("output.experiments", "3_experiments.expt")
+    """
+    lst_pair = []
+    for lst_single in cmd_lst_to_run:
+        for arg in lst_single[1:]:
+            if arg.startswith(prefix) and "=" in arg:
+                lst_pair.append(tuple(arg.split("=", 1)))
+
+    return lst_pair
+
+
+def normalized_params(lst_par):
+    """
+    Parameters of a step as written in any order and spacing, as one list:
+    no spaces around "=", sorted by name (repeated names keep their order)
+    """
+    par_str = re.sub(r"\s*=\s*", "=", " ".join(lst_par))
+    try:
+        lst_tok = shlex.split(par_str)
+
+    except ValueError:
+        # unbalanced quotes
+        lst_tok = par_str.split()
+
+    return sorted(lst_tok, key=lambda tok: tok.split("=", 1)[0])
+
+
+class StepCache(object):
+    """
+    Cache living in << dir_path >> (dui_files/step_cache), at most
+    << max_bytes >> of results, the least recently used go first
+
+    Files:
+        index.json         entries with their size and last use, plus stats
+        <key>/<role>       stored outputs, << role >> being the output
+                           parameter (output.reflections ...) or "out_log"
+    """
+
+    def __init__(self, dir_path, max_bytes=4 * 1024 ** 3):
+        self.dir_path = dir_path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._hash_memo = {}
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes_reused = 0
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+        self._read_index()
+
+    def _index_path(self):
+        return os.path.join(self.dir_path, "index.json")
+
+    def _read_index(self):
+        try:
+            with open(self._index_path()) as idx_in:
+                index = json.load(idx_in)
+
+        except (IOError, OSError, ValueError):
+            return
+
+        if index.get("version") != CACHE_VERSION:
+            return
+
+        self.entries = index["entries"]
+        self.hits = index["hits"]
+        self.misses = index["misses"]
+        self.bytes_reused = index["bytes_reused"]
+
+    def _write_index(self):
+        """Must be called holding the lock"""
+        index = {
+            "version": CACHE_VERSION,
+            "entries": self.entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_reused": self.bytes_reused,
+        }
+        tmp_path = self._index_path() + ".tmp"
+        with open(tmp_path, "w") as idx_out:
+            json.dump(index, idx_out)
+
+        os.replace(tmp_path, self._index_path())
+
+    def _file_hash(self, path):
+        """sha256 of a file, remembered while its size and mtime stay the same"""
+        f_stat = os.stat(path)
+        memo_key = (path, f_stat.st_size, f_stat.st_mtime)
+        if memo_key not in self._hash_memo:
+            f_hash = hashlib.sha256()
+            with open(path, "rb") as f_in:
+                for chunk in iter(lambda: f_in.read(1024 * 1024), b""):
+                    f_hash.update(chunk)
+
+            self._hash_memo[memo_key] = f_hash.hexdigest()
+
+        return self._hash_memo[memo_key]
+
+    def step_key(self, node, cwd_path):
+        """
+        Key of the step << node >> is about to run (after build_command),
+        None if it can not be cached
+        """
+        step_name = node.ll_command_lst[0][0]
+        if step_name not in CACHEABLE_STEPS:
+            return None
+
+        lst_par = normalized_params(node.ll_command_lst[0][1:])
+        lst_input = []
+        for par_name, file_name in cmd_file_args(node.cmd_lst_to_run, "input."):
+            try:
+                lst_input.append(
+                    [par_name, self._file_hash(os.path.join(cwd_path, file_name))]
+                )
+
+            except (IOError, OSError):
+                logger.debug("missing input %s, not caching", file_name)
+                return None
+
+        key_src = json.dumps([CACHE_VERSION, step_name, lst_par, lst_input])
+        return hashlib.sha256(key_src.encode("utf-8")).hexdigest()
+
+    def _out_files(self, node, cwd_path, out_path):
+        lst_out = [
+            (par_name, os.path.join(cwd_path, file_name))
+            for par_name, file_name in cmd_file_args(node.cmd_lst_to_run, "output.")
+        ]
+        lst_out.append((OUT_LOG_ROLE, out_path))
+        return lst_out
+
+    def fetch(self, node, cwd_path, out_path):
+        """
+        Puts the cached outputs of an identical step where << node >> would
+        write its own, returns False on a cache miss
+        """
+        key = self.step_key(node, cwd_path)
+        if key is None:
+            return False
+
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                self._write_index()
+                return False
+
+            out_dict = dict(self._out_files(node, cwd_path, out_path))
+            try:
+                for role in entry["roles"]:
+                    link_or_copy(
+                        os.path.join(self.dir_path, key, role), out_dict[role]
+                    )
+
+            except (IOError, OSError, KeyError) as e:
+                logger.warning("dropping broken cache entry %s: %s", key, e)
+                self._remove_entry(key)
+                self.misses += 1
+                self._write_index()
+                return False
+
+            entry["used"] = time.time()
+            self.hits += 1
+            self.bytes_reused += entry["size"]
+            self._write_index()
+
+        return True
+
+    def store(self, node, cwd_path, out_path):
+        """Keeps the outputs of << node >>, that just ran successfully"""
+        key = self.step_key(node, cwd_path)
+        if key is None:
+            return
+
+        with self._lock:
+            if key in self.entries:
+                return
+
+            entry_path = os.path.join(self.dir_path, key)
+            if os.path.isdir(entry_path):
+                shutil.rmtree(entry_path)
+
+            os.mkdir(entry_path)
+            lst_role = []
+            size = 0
+            try:
+                for role, path in self._out_files(node, cwd_path, out_path):
+                    if os.path.isfile(path):
+                        link_or_copy(path, os.path.join(entry_path, role))
+                        lst_role.append(role)
+                        size += os.path.getsize(path)
+
+            except (IOError, OSError) as e:
+                logger.warning("could not cache node %s: %s", node.lin_num, e)
+                shutil.rmtree(entry_path, ignore_errors=True)
+                return
+
+            self.entries[key] = {"roles": lst_role, "size": size, "used": time.time()}
+            self._evict()
+            self._write_index()
+
+    def _remove_entry(self, key):
+        shutil.rmtree(os.path.join(self.dir_path, key), ignore_errors=True)
+        del self.entries[key]
+
+    def _evict(self):
+        """Drops least recently used entries until under the size limit"""
+        total = sum(entry["size"] for entry in self.entries.values())
+        for key in sorted(self.entries, key=lambda key: self.entries[key]["used"]):
+            if total <= self.max_bytes:
+                break
+
+            total -= self.entries[key]["size"]
+            self._remove_entry(key)
+
+    def stats(self):
+        with self._lock:
+            n_lookup = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / n_lookup if n_lookup else 0.0,
+                "entries": len(self.entries),
+                "size": sum(entry["size"] for entry in self.entries.values()),
+                "bytes_reused": self.bytes_reused,
+            }
@@ -0,0 +1,182 @@
+"""
+DUI's parameter sweep dialog
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import logging
+
+try:
+    from param_sweep import METRIC_NAMES, expand_grid, parse_grid_text
+    from qt import (
+        QDialog,
+        QHBoxLayout,
+        QLabel,
+        QPlainTextEdit,
+        QPushButton,
+        QSpinBox,
+        QTableWidget,
+        QTableWidgetItem,
+        Qt,
+        QVBoxLayout,
+        Signal,
+    )
+
+except ImportError:
+    from .param_sweep import METRIC_NAMES, expand_grid, parse_grid_text
+    from .qt import (
+        QDialog,
+        QHBoxLayout,
+        QLabel,
+        QPlainTextEdit,
+        QPushButton,
+        QSpinBox,
+        QTableWidget,
+        QTableWidgetItem,
+        Qt,
+        QVBoxLayout,
+        Signal,
+    )
+
+logger = logging.getLogger(__name__)
+
+
+def _table_item(value):
+    tbl_item = QTableWidgetItem()
+    if isinstance(value, (int, float)):
+        # numbers are sorted as numbers, not as text
+        tbl_item.setData(Qt.DisplayRole, value)
+
+    else:
+        tbl_item.setText(str(value))
+
+    tbl_item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
+    return tbl_item
+
+
+class SweepDialog(QDialog):
+    """
+    Asks for a parameter grid, starts the sweep from the current node and
+    shows the results of every branch in a sortable table
+
+    Attributes:
+        node_selected (Signal): lin_num of a double-clicked row
+    """
+
+    node_selected = Signal(int)
+
+    def __init__(self, param_sweep, parent=None):
+        super(SweepDialog, self).__init__(parent)
+        self.param_sweep = param_sweep
+        self.base_node = None
+        self.cmd_lst = None
+
+        vbox = QVBoxLayout()
+        self.cmd_label = QLabel("")
+        vbox.addWidget(self.cmd_label)
+
+        self.grid_edit = QPlainTextEdit()
+        self.grid_edit.setPlaceholderText(
+            "one parameter per line, e.g.:\n"
+            "spotfinder.threshold.dispersion.sigma_strong=3,4,6\n"
+            "spotfinder.threshold.dispersion.min_local=0,2"
+        )
+        self.grid_edit.textChanged.connect(self.grid_changed)
+        vbox.addWidget(self.grid_edit)
+
+        hbox = QHBoxLayout()
+        self.n_comb_label = QLabel("0 branches")
+        hbox.addWidget(self.n_comb_label)
+        hbox.addStretch()
+        hbox.addWidget(QLabel("at the same time"))
+        self.max_run_spn = QSpinBox()
+        self.max_run_spn.setMinimum(1)
+        self.max_run_spn.setValue(param_sweep.scheduler.max_running)
+        self.max_run_spn.valueChanged.connect(param_sweep.scheduler.set_max_running)
+        hbox.addWidget(self.max_run_spn)
+        self.run_btn = QPushButton("Run sweep")
+        self.run_btn.clicked.connect(self.run_clicked)
+        self.run_btn.setEnabled(False)
+        hbox.addWidget(self.run_btn)
+        vbox.addLayout(hbox)
+
+        self.res_table = QTableWidget()
+        self.res_table.setSortingEnabled(True)
+        self.res_table.cellDoubleClicked.connect(self.row_double_clicked)
+        vbox.addWidget(self.res_table)
+
+        self.setLayout(vbox)
+        self.setWindowTitle("Parameter Sweep")
+        self.resize(720, 480)
+
+    def set_base(self, base_node, cmd_lst):
+        """Node and command the next sweep starts from"""
+        self.base_node = base_node
+        self.cmd_lst = cmd_lst
+        self.cmd_label.setText("sweeping: " + " ".join(cmd_lst[0]))
+        self.grid_changed()
+
+    def grid_changed(self):
+        try:
+            n_comb = len(expand_grid(parse_grid_text(self.grid_edit.toPlainText())))
+            self.n_comb_label.setText("{} branches".format(n_comb))
+
+        except ValueError as e:
+            n_comb = 0
+            self.n_comb_label.setText(str(e))
+
+        self.run_btn.setEnabled(n_comb > 0 and self.base_node is not None)
+
+    def run_clicked(self):
+        grid = parse_grid_text(self.grid_edit.toPlainText())
+        self.param_sweep.start(self.base_node, self.cmd_lst, grid)
+        self.base_node = None
+        self.run_btn.setEnabled(False)
+        self.update_results()
+
+    def update_results(self):
+        lst_row = self.param_sweep.results()
+        lst_par = []
+        for row in lst_row:
+            for name in row["params"]:
+                if name not in lst_par:
+                    lst_par.append(name)
+
+        lst_head = ["node", "state"] + [name.split(".")[-1] for name in lst_par]
+        lst_head += METRIC_NAMES
+
+        self.res_table.setSortingEnabled(False)
+        self.res_table.clear()
+        self.res_table.setColumnCount(len(lst_head))
+        self.res_table.setHorizontalHeaderLabels(lst_head)
+        self.res_table.setRowCount(len(lst_row))
+        for row_num, row in enumerate(lst_row):
+            lst_val = [row["lin_num"], row["state"]]
+            lst_val += [row["params"].get(name, "") for name in lst_par]
+            lst_val += [row["metrics"].get(name, "") for name in METRIC_NAMES]
+            for col_num, value in enumerate(lst_val):
+                self.res_table.setItem(row_num, col_num, _table_item(value))
+
+        self.res_table.setSortingEnabled(True)
+        self.res_table.resizeColumnsToContents()
+
+    def row_double_clicked(self, row_num, col_num):
+        self.node_selected.emit(int(self.res_table.item(row_num, 0).text()))
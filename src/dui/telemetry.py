@@ -0,0 +1,312 @@
+"""
+CPU, memory and I/O used by the processes of each step
+
+While a DIALS process runs, its whole process tree is sampled with psutil.
+Each node keeps a small summary and a few downsampled points in
+<< node.telemetry >>, which can be exported for a session as JSON and CSV.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# seconds between samples at first, doubled each time the samples get thinned
+SAMPLE_INTERVAL = 0.5
+
+# points kept per step, every other one is dropped when there are more
+MAX_SAMPLES = 120
+
+# columns of the exported CSV, one row per step
+CSV_FIELDS = [
+    "lin_num",
+    "command",
+    "success",
+    "wall_s",
+    "cpu_mean",
+    "cpu_max",
+    "rss_peak_mb",
+    "read_mb",
+    "write_mb",
+    "threads_max",
+]
+
+
+class ProcSampler(object):
+    """
+    Samples the process << pid >> and its children in a background thread
+    from << start >> until << stop >>, which returns the telemetry dict:
+
+        wall_s, cpu_mean, cpu_max (% of one core), rss_peak, read_bytes,
+        write_bytes (bytes), threads_max and samples, a list of
+        [seconds, cpu %, rss MB, threads]
+
+    With << baseline >> the process was already running other jobs (a warm
+    worker), so its I/O counted before << start >> is left out.
+    """
+
+    def __init__(self, pid, interval=SAMPLE_INTERVAL, baseline=False):
+        self.pid = pid
+        self.interval = interval
+        self.baseline = baseline
+        # I/O of each process at << start >>, subtracted at << stop >>
+        self._io_base = {}
+        self.samples = []
+        self.cpu_max = 0.0
+        # CPU % of the last sample, None before the first one
+        self.cpu_last = None
+        self.rss_peak = 0
+        self.threads_max = 0
+        self._cpu_sum = 0.0
+        self._n_sampled = 0
+        self._io_dict = {}
+        self._proc_dict = {}
+        self._start_time = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _proc(self, pid):
+        # the same Process object is needed to get cpu_percent between calls
+        if pid not in self._proc_dict:
+            self._proc_dict[pid] = psutil.Process(pid)
+            self._proc_dict[pid].cpu_percent(None)
+
+        return self._proc_dict[pid]
+
+    def sample(self):
+        try:
+            lst_pid = [self.pid] + [
+                child.pid for child in psutil.Process(self.pid).children(True)
+            ]
+
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return
+
+        cpu = 0.0
+        rss = 0
+        n_threads = 0
+        for pid in lst_pid:
+            try:
+                proc = self._proc(pid)
+                with proc.oneshot():
+                    cpu += proc.cpu_percent(None)
+                    rss += proc.memory_info().rss
+                    n_threads += proc.num_threads()
+                    if hasattr(proc, "io_counters"):
+                        io_count = proc.io_counters()
+                        # counters of a process are gone once it ends
+                        self._io_dict[pid] = (
+                            io_count.read_bytes,
+                            io_count.write_bytes,
+                        )
+
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+
+        self.cpu_last = cpu
+        self.cpu_max = max(self.cpu_max, cpu)
+        self.rss_peak = max(self.rss_peak, rss)
+        self.threads_max = max(self.threads_max, n_threads)
+        self._cpu_sum += cpu
+        self._n_sampled += 1
+        self.samples.append(
+            [
+                round(time.time() - self._start_time, 1),
+                round(cpu),
+                round(rss / 1024 ** 2, 1),
+                n_threads,
+            ]
+        )
+        if len(self.samples) > MAX_SAMPLES:
+            self.samples = self.samples[::2]
+            self.interval *= 2
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._start_time = time.time()
+        self.sample()
+        if self.baseline:
+            self._io_base = dict(self._io_dict)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        lst_io = []
+        for pid, (read_bytes, write_bytes) in self._io_dict.items():
+            read_base, write_base = self._io_base.get(pid, (0, 0))
+            lst_io.append((read_bytes - read_base, write_bytes - write_base))
+
+        return {
+            "wall_s": round(time.time() - self._start_time, 2),
+            "cpu_mean": round(self._cpu_sum / max(1, self._n_sampled), 1),
+            "cpu_max": round(self.cpu_max, 1),
+            "rss_peak": self.rss_peak,
+            "read_bytes": sum(io_pair[0] for io_pair in lst_io),
+            "write_bytes": sum(io_pair[1] for io_pair in lst_io),
+            "threads_max": self.threads_max,
+            "samples": self.samples,
+        }
+
+
+def merge(first, second):
+    """Telemetry of two processes run one after the other by the same step"""
+    if first is None:
+        return second
+
+    wall_s = first["wall_s"] + second["wall_s"]
+    cpu_mean = (
+        first["cpu_mean"] * first["wall_s"] + second["cpu_mean"] * second["wall_s"]
+    ) / max(wall_s, 1e-6)
+    lst_sample = first["samples"] + [
+        [sample[0] + first["wall_s"]] + sample[1:] for sample in second["samples"]
+    ]
+    return {
+        "wall_s": round(wall_s, 2),
+        "cpu_mean": round(cpu_mean, 1),
+        "cpu_max": max(first["cpu_max"], second["cpu_max"]),
+        "rss_peak": max(first["rss_peak"], second["rss_peak"]),
+        "read_bytes": first["read_bytes"] + second["read_bytes"],
+        "write_bytes": first["write_bytes"] + second["write_bytes"],
+        "threads_max": max(first["threads_max"], second["threads_max"]),
+        "samples": lst_sample[:: 1 + len(lst_sample) // (MAX_SAMPLES + 1)],
+    }
+
+
+def telemetry_tip(node):
+    """Lines for the tooltip of << node >> in the tree, "" if not measured"""
+    # nodes of a saved session are not loaded just for a tooltip
+    telemetry = vars(node).get("telemetry")
+    if not telemetry:
+        return ""
+
+    return (
+        "\n {:.1f} s, CPU {:.0f}% mean {:.0f}% peak, {} threads"
+        "\n RSS peak {:.0f} MB, read {:.0f} MB, written {:.0f} MB".format(
+            telemetry["wall_s"],
+            telemetry["cpu_mean"],
+            telemetry["cpu_max"],
+            telemetry["threads_max"],
+            telemetry["rss_peak"] / 1024 ** 2,
+            telemetry["read_bytes"] / 1024 ** 2,
+            telemetry["write_bytes"] / 1024 ** 2,
+        )
+    )
+
+
+def csv_row(node):
+    telemetry = node.telemetry
+    return {
+        "lin_num": node.lin_num,
+        "command": node.ll_command_lst[0][0],
+        "success": node.success,
+        "wall_s": telemetry["wall_s"],
+        "cpu_mean": telemetry["cpu_mean"],
+        "cpu_max": telemetry["cpu_max"],
+        "rss_peak_mb": round(telemetry["rss_peak"] / 1024 ** 2, 1),
+        "read_mb": round(telemetry["read_bytes"] / 1024 ** 2, 1),
+        "write_mb": round(telemetry["write_bytes"] / 1024 ** 2, 1),
+        "threads_max": telemetry["threads_max"],
+    }
+
+
+def export_session(runner, dir_path):
+    """
+    Writes telemetry.json (every sample) and telemetry.csv (a row per
+    step) of the measured nodes of << runner >> in << dir_path >>
+
+    Returns:
+        (int): number of steps exported
+    """
+    lst_node = [
+        node for node in runner.step_list if getattr(node, "telemetry", None)
+    ]
+    json_dict = {
+        str(node.lin_num): dict(
+            node.telemetry, command=node.ll_command_lst[0], success=node.success
+        )
+        for node in lst_node
+    }
+    with open(os.path.join(dir_path, "telemetry.json"), "w") as json_out:
+        json.dump(json_dict, json_out, indent=1)
+
+    with open(os.path.join(dir_path, "telemetry.csv"), "w") as csv_out:
+        writer = csv.DictWriter(csv_out, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        for node in lst_node:
+            writer.writerow(csv_row(node))
+
+    return len(lst_node)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Exports what each step of a DUI session used",
+        usage="dui-telemetry [-h|--help] [directory=DIRECTORY]",
+    )
+    parser.add_argument("positionals", type=str, nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    directory = str(os.getcwd())
+    for arg in args.positionals:
+        if arg.startswith("directory="):
+            directory = os.path.abspath(arg[len("directory=") :])
+
+    try:
+        from session_format import SessionFormatError
+        from session_journal import SessionJournal
+
+    except ImportError:
+        from .session_format import SessionFormatError
+        from .session_journal import SessionJournal
+
+    dui_files_path = os.path.join(directory, "dui_files")
+    try:
+        runner = SessionJournal(dui_files_path).load()
+
+    except (IOError, OSError, ValueError, SessionFormatError) as e:
+        print("no DUI session in", directory, "(", e, ")")
+        sys.exit(1)
+
+    n_step = export_session(runner, dui_files_path)
+    print(n_step, "steps written to telemetry.json and .csv in", dui_files_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Opt-in timeline of what DUI does, in Chrome trace event format
+
+With << dui --trace out.json >> the functions decorated with << traced >>,
+the blocks wrapped in << tracer.span(...) >> and the lifetimes of the
+processes DUI launches are written to out.json, to be opened with
+chrome://tracing or https://ui.perfetto.dev. Without it, every hook costs
+a single attribute check.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import atexit
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _now_us():
+    return time.time() * 1e6
+
+
+class Tracer(object):
+    """
+    Collects complete ("X") events, each one with the pid and thread id it
+    happened in, nested spans show up nested in the viewer
+    """
+
+    def __init__(self):
+        self.path = None
+        self.events = []
+        self._lock = threading.Lock()
+        self._named = set()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def enable(self, path):
+        """Starts recording, written to << path >> on save and at exit"""
+        if self.path is None:
+            atexit.register(self.save)
+
+        self.path = os.path.abspath(path)
+        self._name_track(os.getpid(), None, "process_name", "DUI")
+
+    def _name_track(self, pid, tid, meta_name, label):
+        """Metadata event naming a process or thread lane, once"""
+        if (pid, tid, meta_name) in self._named:
+            return
+
+        self._named.add((pid, tid, meta_name))
+        meta_event = {
+            "name": meta_name,
+            "ph": "M",
+            "pid": pid,
+            "args": {"name": label},
+        }
+        if tid is not None:
+            meta_event["tid"] = tid
+
+        self.events.append(meta_event)
+
+    def complete(self, name, start_us, end_us, cat="dui", args=None, pid=None):
+        """
+        Adds a span that started at << start_us >> (microseconds since the
+        epoch), in this thread or, given a << pid >>, in a lane of its own
+        """
+        if pid is None:
+            pid = os.getpid()
+            tid = threading.current_thread().ident
+            tid_name = threading.current_thread().name
+
+        else:
+            tid = pid
+            tid_name = name
+
+        trace_event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": int(start_us),
+            "dur": int(end_us - start_us),
+            "pid": pid,
+            "tid": tid,
+        }
+        if args:
+            trace_event["args"] = args
+
+        with self._lock:
+            if pid != os.getpid():
+                self._name_track(pid, None, "process_name", name)
+
+            self._name_track(pid, tid, "thread_name", tid_name)
+            self.events.append(trace_event)
+
+    @contextlib.contextmanager
+    def span(self, name, cat="dui", **args):
+        if not self.enabled:
+            yield
+            return
+
+        start_us = _now_us()
+        try:
+            yield
+
+        finally:
+            self.complete(name, start_us, _now_us(), cat, args)
+
+    def traced(self, name=None, cat="dui"):
+        """Decorator recording every call of a function as a span"""
+
+        def decorate(fun):
+            span_name = name or fun.__module__.split(".")[-1] + "." + fun.__name__
+
+            @functools.wraps(fun)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fun(*args, **kwargs)
+
+                start_us = _now_us()
+                try:
+                    return fun(*args, **kwargs)
+
+                finally:
+                    self.complete(span_name, start_us, _now_us(), cat)
+
+            return wrapper
+
+        return decorate
+
+    def process(self, name, pid, start_us, exit_status=None):
+        """Records the lifetime of a child process, ending now"""
+        if self.enabled:
+            self.complete(
+                name,
+                start_us,
+                _now_us(),
+                cat="process",
+                args={"pid": pid, "exit_status": exit_status},
+                pid=pid,
+            )
+
+    def save(self):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            lst_event = list(self.events)
+
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as trace_out:
+                json.dump(
+                    {"traceEvents": lst_event, "displayTimeUnit": "ms"}, trace_out
+                )
+
+            os.replace(tmp_path, self.path)
+
+        except (IOError, OSError) as e:
+            logger.warning("could not write trace %s: %s", self.path, e)
+
+
+tracer = Tracer()
+traced = tracer.traced
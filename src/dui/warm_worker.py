@@ -0,0 +1,149 @@
+"""
+Long-lived process running DIALS commands without starting a new Python
+
+Started by the warm executor (see executors.py), it imports the DIALS
+stack once, then reads jobs as JSON lines on stdin:
+
+    {"argv": ["dials.find_spots", ...], "cwd": "...", "token": "..."}
+
+and runs << dials.command_line.find_spots >> as << __main__ >> with that
+argv, in that directory. The output of the command is the output of this
+process, followed by << END_MARK token exit_status >> and a line end.
+
+Deliberately imports nothing from DUI, it runs as a plain script.
+
+Author: Luis Fuentes-Montero (Luiso)
+With strong help from DIALS and CCP4 teams
+
+copyright (c) CCP4 - DLS
+"""
+from __future__ import absolute_import, division, print_function
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import faulthandler
+import importlib
+import json
+import logging
+import os
+import runpy
+import signal
+import sys
+import traceback
+
+# follows the output of each job, never printed by DIALS
+END_MARK = "\x00dui-warm-end"
+
+# imported before the first job, the ones missing are skipped
+PRELOAD = [
+    "dxtbx.model.experiment_list",
+    "dials.array_family.flex",
+    "dials.util.options",
+    "dials.command_line.find_spots",
+    "dials.command_line.index",
+    "dials.command_line.refine_bravais_settings",
+    "dials.command_line.reindex",
+    "dials.command_line.refine",
+    "dials.command_line.integrate",
+    "dials.command_line.symmetry",
+    "dials.command_line.scale",
+    "dials.command_line.predict",
+    "dials.command_line.report",
+]
+
+
+def preload(lst_module):
+    # whatever the imports print is not part of any job
+    saved_fd = os.dup(1)
+    null_fd = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(null_fd, 1)
+    try:
+        for module_name in lst_module:
+            try:
+                importlib.import_module(module_name)
+
+            except Exception:
+                continue
+
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_fd, 1)
+        os.close(saved_fd)
+        os.close(null_fd)
+
+
+def module_of(command):
+    """dials.find_spots -> dials.command_line.find_spots"""
+    return "dials.command_line." + command.split(".", 1)[1]
+
+
+def run_job(argv, cwd_path):
+    """Runs one command as its own dispatcher would, returns the exit status"""
+    old_cwd = os.getcwd()
+    old_argv = sys.argv
+    exit_status = 0
+    try:
+        os.chdir(cwd_path)
+        sys.argv = list(argv)
+        os.environ["LIBTBX_DISPATCHER_NAME"] = argv[0]
+        runpy.run_module(module_of(argv[0]), run_name="__main__", alter_sys=True)
+
+    except SystemExit as e:
+        if e.code is None:
+            exit_status = 0
+
+        elif isinstance(e.code, int):
+            exit_status = e.code
+
+        else:
+            print(e.code, file=sys.stderr)
+            exit_status = 1
+
+    except BaseException:
+        traceback.print_exc()
+        exit_status = 1
+
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.argv = old_argv
+        os.chdir(old_cwd)
+        # log files of this job must not get the output of the next one
+        root_logger = logging.getLogger()
+        for handler in list(root_logger.handlers):
+            root_logger.removeHandler(handler)
+            handler.close()
+
+    return exit_status
+
+
+def main():
+    if hasattr(signal, "SIGUSR1"):
+        # stacks on demand, for the stall watchdog
+        faulthandler.register(signal.SIGUSR1, all_threads=True)
+
+    preload(PRELOAD)
+    job_in = sys.stdin
+    for json_line in iter(job_in.readline, ""):
+        job_dict = json.loads(json_line)
+        exit_status = run_job(job_dict["argv"], job_dict["cwd"])
+        sys.stdout.write(
+            "{} {} {}\n".format(END_MARK, job_dict["token"], exit_status)
+        )
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# coding: utf-8
+
+"""Test the headless batch pipeline"""
+
+import os
+
+import pytest
+
+from dui import batch_dui
+from dui.batch_dui import (
+    batch_jobs,
+    dataset_dir_name,
+    import_arg,
+    parse_recipe,
+    run_batch,
+)
+from dui.cli_utils import sys_arg
+from dui.session_journal import SessionJournal
+
+
+def test_parse_recipe():
+    lst_step = parse_recipe(
+        ["# standard processing", "import", "", "find_spots spotfinder.mp.nproc=2"]
+    )
+    assert lst_step == [["import"], ["find_spots", "spotfinder.mp.nproc=2"]]
+    with pytest.raises(ValueError):
+        parse_recipe(["import", "not_a_step"])
+
+
+def test_dataset_dir_name():
+    assert dataset_dir_name("/data/x4/X4_wide_M1S4_2_####.cbf", 3) == (
+        "0003_X4_wide_M1S4_2_.cbf"
+    )
+
+
+def test_import_arg():
+    assert import_arg("/data/img_####.cbf") == "input.template=/data/img_####.cbf"
+    assert import_arg("/data/img_master.h5") == "/data/img_master.h5"
+
+
+def test_dataset_survives_a_failed_export(tmpdir, monkeypatch):
+    def export_session(runner, dui_files_path):
+        raise IOError("disk full")
+
+    monkeypatch.setattr(batch_dui, "export_session", export_session)
+    lst_summary = run_batch(["/no/such/img_####.cbf"], [["import"]], str(tmpdir))
+    assert lst_summary[0]["failed_step"] == "import"
+
+
+def test_jobs_carry_their_settings_and_cores(monkeypatch):
+    monkeypatch.setattr(sys_arg, "cpu_budget", 8)
+    lst_template = ["/d/a_####.cbf", "/d/b_####.cbf", "/d/c_####.cbf"]
+    lst_job = batch_jobs(
+        lst_template, [["import"]], "/out", n_workers=3, overrides={"stall_s": 5.0}
+    )
+    assert [job[3] for job in lst_job] == [{"stall_s": 5.0, "cpu_budget": 2}] * 3
+    # one worker alone shares the budget of the session
+    lst_job = batch_jobs(lst_template[:1], [["import"]], "/out", n_workers=3)
+    assert lst_job[0][3] == {}
+
+
+def test_settings_applied_in_the_worker(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys_arg, "stall_s", 600.0)
+    monkeypatch.setattr(sys_arg, "stall_action", "flag")
+    run_batch(
+        ["/no/such/img_####.cbf"],
+        [["import"]],
+        str(tmpdir),
+        overrides={"stall_s": 30.0, "stall_action": "cancel"},
+    )
+    assert (sys_arg.stall_s, sys_arg.stall_action) == (30.0, "cancel")
+
+
+def test_each_dataset_gets_its_session(tmpdir):
+    lst_template = ["/no/such/dir_a/img_####.cbf", "/no/such/dir_b/img_####.cbf"]
+    lst_summary = run_batch(
+        lst_template, [["import"], ["find_spots"]], str(tmpdir), n_workers=2
+    )
+    assert [smr["template"] for smr in lst_summary] == lst_template
+    for summary in lst_summary:
+        # without images (or DIALS) the import step can not succeed
+        assert summary["failed_step"] == "import"
+        dui_files_path = os.path.join(summary["directory"], "dui_files")
+        assert SessionJournal.exists(dui_files_path)
+        runner = SessionJournal(dui_files_path).load()
+        assert runner.current_node.ll_command_lst[0][:2] == [
+            "import",
+            "input.template=" + summary["template"],
+        ]
+        assert runner.current_node.success is False
@@ -0,0 +1,95 @@
+# coding: utf-8
+
+"""Test running several branches of the navigation tree at the same time"""
+
+import threading
+import time
+
+from dui.branch_scheduler import DONE, FAILED, BranchScheduler
+from dui.m_idials import Runner
+
+
+class _SlowRunner(object):
+    """Stands for a Runner whose steps wait until they are released"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.n_running = 0
+        self.max_seen = 0
+        self._lock = threading.Lock()
+
+    def run_node(self, node, cmd_lst, ref_to_class):
+        with self._lock:
+            self.n_running += 1
+            self.max_seen = max(self.max_seen, self.n_running)
+
+        self.release.wait(5)
+        ref_to_class.emit_print_signal("done " + str(node.lin_num))
+        node.success = cmd_lst[0][0] != "fail"
+        with self._lock:
+            self.n_running -= 1
+
+
+def test_siblings_run_concurrently_within_limit():
+    runner = Runner()
+    lst_node = []
+    for _ in range(3):
+        runner.run(["goto", "0"], None)
+        runner.run(["mkchi"], None)
+        lst_node.append(runner.current_node)
+
+    slow_runner = _SlowRunner()
+    lst_out = []
+    scheduler = BranchScheduler(
+        slow_runner, max_running=2, on_output=lambda lin, txt: lst_out.append(lin)
+    )
+    for node, cmd in zip(lst_node, ["find_spots", "fail", "index"]):
+        assert scheduler.submit(node, [[cmd]])
+
+    assert [node.run_state for node in lst_node] == ["running", "running", "queued"]
+    assert not scheduler.submit(lst_node[0], [["find_spots"]])
+
+    slow_runner.release.set()
+    while scheduler.n_active():
+        time.sleep(0.01)
+
+    assert slow_runner.max_seen == 2
+    assert [node.run_state for node in lst_node] == [DONE, FAILED, DONE]
+    assert sorted(lst_out) == [node.lin_num for node in lst_node]
+
+
+def test_cancel_queued_node():
+    runner = Runner()
+    runner.run(["mkchi"], None)
+    first_node = runner.current_node
+    runner.run(["mksib"], None)
+    second_node = runner.current_node
+
+    slow_runner = _SlowRunner()
+    scheduler = BranchScheduler(slow_runner, max_running=1)
+    scheduler.submit(first_node, [["find_spots"]])
+    scheduler.submit(second_node, [["find_spots"]])
+    scheduler.cancel(second_node, lambda pid: None)
+    assert second_node.run_state is None
+    assert second_node.success is None
+
+    slow_runner.release.set()
+    scheduler.shutdown(lambda pid: None)
+
+
+def test_queued_command_is_a_copy():
+    runner = Runner()
+    runner.run(["mkchi"], None)
+    node = runner.current_node
+
+    slow_runner = _SlowRunner()
+    scheduler = BranchScheduler(slow_runner, max_running=1)
+    command_lst = [["find_spots", "spotfinder.mp.nproc=2"]]
+    scheduler.submit(node, command_lst)
+    # the GUI goes on editing its parameters for the next step
+    command_lst[0].append("min_spot_size=3")
+    command_lst.append(["index"])
+    assert node.ll_command_lst == [["find_spots", "spotfinder.mp.nproc=2"]]
+
+    slow_runner.release.set()
+    scheduler.shutdown(lambda pid: None)
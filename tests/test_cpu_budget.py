@@ -0,0 +1,121 @@
+# coding: utf-8
+
+"""Test the CPU budget shared by concurrent steps"""
+
+import sys
+import threading
+import time
+
+from dui import cpu_budget
+from dui.cli_utils import budget_for_session, run_side_cmd
+from dui.cpu_budget import CpuBudget, cgroup_cores, detect_cores, with_nproc
+
+
+def test_cgroup_quota(tmpdir):
+    tmpdir.join("cpu.max").write("max 100000\n")
+    assert cgroup_cores(str(tmpdir)) is None
+    tmpdir.join("cpu.max").write("250000 100000\n")
+    assert cgroup_cores(str(tmpdir)) == 3
+
+    v1_root = tmpdir.mkdir("v1")
+    v1_root.mkdir("cpu").join("cpu.cfs_quota_us").write("-1\n")
+    v1_root.join("cpu", "cpu.cfs_period_us").write("100000\n")
+    assert cgroup_cores(str(v1_root)) is None
+    v1_root.join("cpu", "cpu.cfs_quota_us").write("200000\n")
+    assert cgroup_cores(str(v1_root)) == 2
+    assert detect_cores(str(v1_root)) <= 2
+
+
+def test_with_nproc():
+    lst_single = ["dials.integrate", "integration.mp.nproc=64", "a.expt"]
+    assert with_nproc(lst_single, 3) == [
+        "dials.integrate",
+        "integration.mp.nproc=3",
+        "a.expt",
+    ]
+    assert with_nproc(["dials.index", "a.expt"], 3) == ["dials.index", "a.expt"]
+
+
+def test_budget_never_oversubscribed():
+    budget = CpuBudget(4, use_load=False)
+    assert budget.acquire() == 4
+    lst_got = []
+
+    def second_step():
+        lst_got.append(budget.acquire(2))
+
+    waiting_thread = threading.Thread(target=second_step)
+    waiting_thread.start()
+    time.sleep(0.2)
+    # queued until the first step gives its cores back
+    assert lst_got == []
+    budget.release(4)
+    waiting_thread.join(5)
+    assert lst_got == [2]
+    assert budget.n_free() == 2
+
+    with budget.cores(8) as n_cores:
+        assert n_cores == 2
+
+    budget.release(2)
+    assert budget.n_free() == 4
+
+
+def test_cancelled_while_waiting():
+    budget = CpuBudget(1, use_load=False)
+    n_first = budget.acquire(1)
+    assert budget.acquire(1, cancelled=lambda: True) == 0
+    budget.release(n_first)
+
+
+def test_no_wait_when_cancelled_from_the_start():
+    budget = CpuBudget(2, use_load=False)
+    with budget.cores(1, cancelled=lambda: True) as n_cores:
+        assert n_cores == 1
+        n_rest = budget.acquire()
+        # nothing free, the side command runs without a core
+        with budget.cores(1, cancelled=lambda: True) as n_none:
+            assert n_none == 0
+
+        budget.release(n_rest)
+
+    assert budget.n_free() == 2
+
+
+def test_external_load_is_recent(monkeypatch):
+    lst_percent = [50.0, 0.0]
+    monkeypatch.setattr(
+        cpu_budget.psutil, "cpu_percent", lambda interval: lst_percent.pop(0)
+    )
+    monkeypatch.setattr(cpu_budget.psutil, "cpu_count", lambda: 8)
+    monkeypatch.setitem(cpu_budget._cpu_sample, "time", None)
+    # 4 of 8 cores busy, 1 of them by DUI
+    assert cpu_budget.external_load(1, now=100.0) == 3
+    # the same measure until the next poll
+    assert cpu_budget.external_load(1, now=100.1) == 3
+    # the machine went idle, nothing left over from the minute before
+    assert cpu_budget.external_load(0, now=101.0) == 0
+
+
+def test_side_commands_wait_only_off_the_gui_thread(tmpdir):
+    str_cmd = sys.executable + " -c pass"
+    budget = budget_for_session()
+    n_all = budget.acquire()
+    try:
+        # the GUI thread runs the report without a core
+        assert run_side_cmd(str_cmd, str(tmpdir)) == 0
+
+        lst_status = []
+        info_thread = threading.Thread(
+            target=lambda: lst_status.append(run_side_cmd(str_cmd, str(tmpdir)))
+        )
+        info_thread.start()
+        time.sleep(0.3)
+        # an info worker waits for its core
+        assert lst_status == []
+
+    finally:
+        budget.release(n_all)
+
+    info_thread.join(30)
+    assert lst_status == [0]
@@ -0,0 +1,70 @@
+# coding: utf-8
+
+"""Test the deduplication of identical outputs"""
+
+import json
+import os
+import sys
+
+import pytest
+
+from dui.branch_scheduler import DONE
+from dui.dedupe import MIN_SIZE, Deduper, main
+from dui.disk_gc import DiskGC
+from dui.m_idials import Runner
+
+
+def test_identical_outputs_stored_once(tmpdir):
+    same_data = b"a" * MIN_SIZE
+    tmpdir.join("3_experiments.expt").write_binary(same_data)
+    tmpdir.join("4_experiments.expt").write_binary(same_data)
+    tmpdir.join("5_experiments.expt").write_binary(b"b" * MIN_SIZE)
+    tmpdir.join("6_experiments.expt").write_binary(same_data)
+    tmpdir.join("3_index.log").write_binary(same_data)
+
+    # node 6 is still running, its files are left alone
+    deduper = Deduper(str(tmpdir))
+    assert deduper.run(done_lins={3, 4, 5}) == MIN_SIZE
+
+    path_3 = str(tmpdir.join("3_experiments.expt"))
+    path_4 = str(tmpdir.join("4_experiments.expt"))
+    assert open(path_4, "rb").read() == same_data
+    if os.stat(path_3).st_ino == os.stat(path_4).st_ino:
+        assert os.stat(path_3).st_nlink == 2
+
+    assert os.stat(str(tmpdir.join("6_experiments.expt"))).st_nlink == 1
+    # nothing new to do on the next run, even with a fresh memo
+    assert deduper.run(done_lins={3, 4, 5}) == 0
+    assert Deduper(str(tmpdir)).run(done_lins={3, 4, 5}) == 0
+
+
+def test_nodes_run_by_the_scheduler_deduped(tmpdir):
+    runner = Runner()
+    lst_node = []
+    for command in ("import", "find_spots", "index"):
+        node = runner.current_node
+        node.ll_command_lst = [[command]]
+        node.success = True
+        # ran through the Queue button or a sweep
+        node.run_state = DONE
+        runner.run(["mkchi"], None)
+        lst_node.append(node)
+
+    same_data = b"a" * MIN_SIZE
+    for node in lst_node[1:]:
+        tmpdir.join(str(node.lin_num) + "_experiments.expt").write_binary(same_data)
+
+    gc_obj = DiskGC(runner, str(tmpdir), deduper=Deduper(str(tmpdir)))
+    assert gc_obj.collect()["deduped"] == MIN_SIZE
+
+
+def test_main_on_unsupported_session(tmpdir, monkeypatch, capsys):
+    tmpdir.mkdir("dui_files").join("session.snapshot.json").write(
+        json.dumps({"version": 99})
+    )
+    monkeypatch.setattr(sys, "argv", ["dui-dedupe", "directory=" + str(tmpdir)])
+    with pytest.raises(SystemExit) as exit_info:
+        main()
+
+    assert exit_info.value.code == 1
+    assert "no DUI session" in capsys.readouterr().out
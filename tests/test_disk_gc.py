@@ -0,0 +1,99 @@
+# coding: utf-8
+
+"""Test the garbage collection of dui_files"""
+
+import os
+
+from dui.branch_scheduler import DONE, QUEUED
+from dui.disk_gc import DiskGC, dir_size, owner_lin
+from dui.m_idials import Runner
+
+
+def _done_step(runner, command, success=True):
+    node = runner.current_node
+    node.ll_command_lst = [[command]]
+    node.success = success
+    runner.run(["mkchi"], None)
+    return node
+
+
+def test_owner_lin():
+    assert owner_lin("12_reflections.refl") == 12
+    assert owner_lin("lin_4_bravais_summary.json") == 4
+    assert owner_lin("session.journal") is None
+    assert owner_lin("bkp.pickle") is None
+
+
+def test_orphans_failed_outputs_and_quota(tmpdir):
+    runner = Runner()
+    imp_node = _done_step(runner, "import")
+    fnd_node = _done_step(runner, "find_spots")
+    fnd_node.report_out = "2_report.html"
+    # a child that failed, and a sibling of it then removed from the tree
+    idx_node = runner.current_node
+    idx_node.ll_command_lst = [["index"]]
+    idx_node.success = False
+    runner.run(["mksib"], None)
+    removed_lin = runner.bigger_lin
+    runner.run(["goto", str(imp_node.lin_num)], None)
+    runner.run(["clean"], None)
+    assert runner.get_node(removed_lin) is None
+
+    lst_file = [
+        ("1_experiments.expt", 100),
+        ("2_reflections.refl", 300),
+        ("2_report.html", 500),
+        (str(idx_node.lin_num) + "_experiments.expt", 200),
+        (str(idx_node.lin_num) + "_index.log", 50),
+        (str(removed_lin) + "_reflections.refl", 400),
+        ("session.journal", 10),
+    ]
+    for name, size in lst_file:
+        tmpdir.join(name).write("x" * size)
+
+    gc_plan = DiskGC(runner, str(tmpdir)).plan()
+    assert sorted(gc_plan["orphans"]) == sorted(
+        [
+            str(idx_node.lin_num) + "_experiments.expt",
+            str(removed_lin) + "_reflections.refl",
+        ]
+    )
+    assert gc_plan["reclaimable"][fnd_node.lin_num] == 500 + 200
+
+    summary = DiskGC(runner, str(tmpdir), quota_bytes=600).collect()
+    assert summary["freed"] == 200 + 400 + 500
+    assert summary["evicted"] == [(fnd_node.lin_num, "report")]
+    assert fnd_node.report_out is None
+    assert sorted(os.listdir(str(tmpdir))) == sorted(
+        [
+            "1_experiments.expt",
+            "2_reflections.refl",
+            str(idx_node.lin_num) + "_index.log",
+            "session.journal",
+        ]
+    )
+
+
+def test_nodes_run_by_the_scheduler_collected(tmpdir):
+    runner = Runner()
+    _done_step(runner, "import")
+    fnd_node = _done_step(runner, "find_spots")
+    fnd_node.report_out = "2_report.html"
+    tmpdir.join("2_report.html").write("x" * 500)
+    tmpdir.join("2_reflections.refl").write("x" * 300)
+    # the step cache counts in the quota
+    tmpdir.mkdir("step_cache").join("ab12").write("x" * 400)
+
+    # ran through the Queue button, the scheduler leaves DONE on it
+    fnd_node.run_state = DONE
+    summary = DiskGC(runner, str(tmpdir), quota_bytes=1000).collect()
+    assert summary["evicted"] == [(fnd_node.lin_num, "report")]
+    assert fnd_node.report_out is None
+
+    # while queued or running its files are left alone
+    fnd_node.report_out = "2_report.html"
+    tmpdir.join("2_report.html").write("x" * 500)
+    fnd_node.run_state = QUEUED
+    summary = DiskGC(runner, str(tmpdir), quota_bytes=1000).collect()
+    assert summary["evicted"] == []
+    assert dir_size(str(tmpdir)) == 500 + 300 + 400
@@ -0,0 +1,133 @@
+# coding: utf-8
+
+"""Test that every executor backend behaves the same"""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from dui.executors import (
+    CANCELLED_STATUS,
+    Job,
+    LocalExecutor,
+    PoolExecutor,
+    SpoolExecutor,
+    SpoolWorker,
+)
+from dui.proc_engine import LineBatcher
+
+PRINT_N_EXIT = "for i in range(3): print('line', i)\nraise SystemExit(2)"
+SLEEPER = "import time\nprint('started', flush=True)\ntime.sleep(60)"
+
+
+@pytest.fixture(params=["local", "pool", "spool"])
+def executor(request, tmpdir):
+    if request.param == "local":
+        yield LocalExecutor()
+
+    elif request.param == "pool":
+        pool_executor = PoolExecutor(n_workers=1)
+        yield pool_executor
+        pool_executor.shutdown()
+
+    else:
+        spool_dir = str(tmpdir.join("spool"))
+        spool_executor = SpoolExecutor(spool_dir)
+        worker = SpoolWorker(spool_dir, n_jobs=2)
+        worker_thread = threading.Thread(target=worker.serve_forever)
+        worker_thread.start()
+        yield spool_executor
+        worker.stop()
+        worker_thread.join()
+
+
+def test_output_and_exit_status(executor, tmpdir):
+    lst_batch = []
+    lst_pid = []
+    exit_status = executor.run(
+        Job([sys.executable, "-c", PRINT_N_EXIT], str(tmpdir)),
+        LineBatcher(on_lines=lst_batch.append),
+        on_start=lst_pid.append,
+    )
+    assert exit_status == 2
+    assert "\n".join(lst_batch).split("\n") == ["line 0", "line 1", "line 2"]
+    assert len(lst_pid) == 1
+
+
+def test_cancel_running_job(executor, tmpdir):
+    job = Job([sys.executable, "-c", SLEEPER], str(tmpdir))
+    batcher = LineBatcher()
+
+    def cancel_when_started():
+        while "started" not in batcher.tail_lines():
+            time.sleep(0.05)
+
+        executor.cancel(job)
+
+    cancel_thread = threading.Thread(target=cancel_when_started)
+    cancel_thread.start()
+    start = time.time()
+    exit_status = executor.run(job, batcher)
+    cancel_thread.join()
+    assert exit_status != 0
+    assert time.time() - start < 30
+
+
+def _spool_files(spool_dir):
+    return {
+        sub_dir: sorted(os.listdir(os.path.join(spool_dir, sub_dir)))
+        for sub_dir in ("new", "run", "done", "cancel")
+    }
+
+
+def test_spool_job_cancelled_before_any_worker_claims_it(tmpdir):
+    spool_dir = str(tmpdir.join("spool"))
+    spool_executor = SpoolExecutor(spool_dir)
+    job = Job([sys.executable, "-c", SLEEPER], str(tmpdir))
+
+    def cancel_when_queued():
+        while not os.listdir(os.path.join(spool_dir, "new")):
+            time.sleep(0.05)
+
+        spool_executor.cancel(job)
+
+    cancel_thread = threading.Thread(target=cancel_when_queued)
+    cancel_thread.start()
+    # no worker is running
+    assert spool_executor.run(job, LineBatcher()) == CANCELLED_STATUS
+    cancel_thread.join()
+    assert _spool_files(spool_dir) == {"new": [], "run": [], "done": [], "cancel": []}
+
+    # a worker started later finds nothing to run
+    assert SpoolWorker(spool_dir).claim() is None
+
+
+def test_spool_cancel_marker_removed(tmpdir):
+    spool_dir = str(tmpdir.join("spool"))
+    spool_executor = SpoolExecutor(spool_dir)
+    worker = SpoolWorker(spool_dir)
+    job = Job([sys.executable, "-c", SLEEPER], str(tmpdir))
+    batcher = LineBatcher()
+
+    def cancel_when_started():
+        while "started" not in batcher.tail_lines():
+            worker.run_once()
+            time.sleep(0.05)
+
+        spool_executor.cancel(job)
+
+    cancel_thread = threading.Thread(target=cancel_when_started)
+    cancel_thread.start()
+    assert spool_executor.run(job, batcher) == CANCELLED_STATUS
+    cancel_thread.join()
+    # waits for the job thread of the worker to end
+    worker.stop()
+    worker.serve_forever()
+    assert _spool_files(spool_dir) == {"new": [], "run": [], "done": [], "cancel": []}
+
+    # cancelling a job already over leaves nothing behind
+    spool_executor.cancel(job)
+    assert _spool_files(spool_dir)["cancel"] == []
@@ -0,0 +1,97 @@
+# coding: utf-8
+
+"""Test the cache of decoded images of the viewer"""
+
+import time
+
+import numpy as np
+
+from dui.outputs_n_viewers.frame_cache import FrameCache
+
+
+class _FakeImageSet(object):
+    """Sweep of << n_img >> frames of two 100x100 int32 panels"""
+
+    def __init__(self, n_img=20, path="/data/x_#####.cbf", first=0):
+        self.n_img = n_img
+        self.path = path
+        self.first = first
+        self.lst_decoded = []
+
+    def __len__(self):
+        return self.n_img
+
+    def indices(self):
+        return list(range(self.first, self.first + self.n_img))
+
+    def get_path(self, index):
+        return self.path
+
+    def get_raw_data(self, index):
+        self.lst_decoded.append(index)
+        value = self.first + index
+        return tuple(np.full((100, 100), value, dtype=np.int32) for _ in range(2))
+
+
+def test_frames_decoded_once_and_bounded():
+    # room for 3 frames of 80 kB
+    frame_cache = FrameCache(max_bytes=250 * 1000)
+    imageset = _FakeImageSet()
+    assert frame_cache.get(imageset, 0)[1][0, 0] == 0
+    frame_cache.get(imageset, 0)
+    # another imageset of the same images shares the frames
+    frame_cache.get(_FakeImageSet(), 0)
+    assert imageset.lst_decoded == [0]
+
+    for index in (1, 2, 3):
+        frame_cache.get(imageset, index)
+
+    assert frame_cache.n_bytes <= 250 * 1000
+    frame_cache.get(imageset, 0)
+    assert imageset.lst_decoded == [0, 1, 2, 3, 0]
+    stats = frame_cache.stats()
+    assert stats["hit_rate"] == 2 / 7.0
+    assert stats["n_frames"] == 3
+
+
+def test_slices_of_one_file_kept_apart():
+    frame_cache = FrameCache(max_bytes=250 * 1000)
+    first_half = _FakeImageSet(n_img=10, path="/data/x_master.h5")
+    second_half = _FakeImageSet(n_img=10, path="/data/x_master.h5", first=10)
+    assert frame_cache.get(first_half, 0)[0][0, 0] == 0
+    assert frame_cache.get(second_half, 0)[0][0, 0] == 10
+    assert second_half.lst_decoded == [0]
+
+
+def test_read_ahead_follows_direction_and_step():
+    frame_cache = FrameCache()
+    imageset = _FakeImageSet()
+    frame_cache.read_ahead(imageset, 10, -3, n_stack=2, n_ahead=2)
+    deadline = time.time() + 5
+    while frame_cache.n_read_ahead < 4 and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert sorted(imageset.lst_decoded) == [4, 5, 7, 8]
+    frame_cache.get(imageset, 7)
+    assert frame_cache.n_hits == 1
+
+    # never past the ends of the sweep
+    frame_cache.read_ahead(imageset, 18, 1, n_ahead=4)
+    deadline = time.time() + 5
+    while frame_cache.n_read_ahead < 5 and time.time() < deadline:
+        time.sleep(0.01)
+
+    time.sleep(0.1)
+    assert sorted(imageset.lst_decoded) == [4, 5, 7, 8, 19]
+
+
+def test_frames_read_without_keeping():
+    frame_cache = FrameCache()
+    imageset = _FakeImageSet()
+    frame_cache.get(imageset, 1)
+    assert frame_cache.get(imageset, 2, keep=False)[0][0, 0] == 2
+    # read again, the first one still there
+    frame_cache.get(imageset, 2, keep=False)
+    frame_cache.get(imageset, 1, keep=False)
+    assert imageset.lst_decoded == [1, 2, 2]
+    assert frame_cache.stats()["n_frames"] == 1
@@ -0,0 +1,98 @@
+# coding: utf-8
+
+"""Test the sliding window of stacked images and the scan projections"""
+
+import numpy as np
+import pytest
+
+from dui.outputs_n_viewers.frame_stack import FrameStack, ScanProjector
+
+
+def _frames(n_img=40, seed=3):
+    rnd = np.random.RandomState(seed)
+    return rnd.randint(-2, 1000, size=(n_img, 5, 7)).astype(np.double)
+
+
+class _Reader(object):
+    def __init__(self, np_frames):
+        self.np_frames = np_frames
+        self.lst_read = []
+
+    def __call__(self, index):
+        self.lst_read.append(index)
+        return self.np_frames[index]
+
+
+def _expected(np_frames, first, n_stack, mode):
+    window = np_frames[first : first + n_stack]
+    return {"sum": window.sum(0), "mean": window.mean(0), "max": window.max(0)}[
+        mode
+    ]
+
+
+@pytest.mark.parametrize("mode", ["sum", "mean", "max"])
+def test_window_moves_match_a_full_stack(mode):
+    np_frames = _frames()
+    frame_stack = FrameStack(_Reader(np_frames), mode)
+    lst_first = list(range(0, 20)) + [15, 14, 14, 30, 3, 4, 5, 6, 9]
+    for first in lst_first:
+        stacked = frame_stack.get(first, 8)
+        assert np.allclose(stacked, _expected(np_frames, first, 8, mode))
+
+    # another number of images starts again
+    assert np.allclose(frame_stack.get(6, 3), _expected(np_frames, 6, 3, mode))
+
+
+@pytest.mark.parametrize("mode", ["sum", "mean", "max"])
+def test_one_step_reads_at_most_two_frames(mode):
+    reader = _Reader(_frames())
+    frame_stack = FrameStack(reader, mode)
+    frame_stack.get(0, 10)
+    assert len(reader.lst_read) == 10
+    for first in range(1, 25):
+        n_read = len(reader.lst_read)
+        frame_stack.get(first, 10)
+        assert len(reader.lst_read) - n_read <= 2
+
+    # a step of the sum reads the frame leaving and the one entering
+    if mode != "max":
+        assert reader.lst_read[-2:] == [23, 33]
+
+
+def test_sum_does_not_drift():
+    np_frames = _frames(n_img=400)
+    frame_stack = FrameStack(_Reader(np_frames), "sum")
+    for first in range(0, 390):
+        stacked = frame_stack.get(first, 10)
+
+    assert np.array_equal(stacked, np_frames[389:399].sum(0))
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        FrameStack(_Reader(_frames()), "median")
+
+
+@pytest.mark.parametrize("mode", ["sum", "mean", "max"])
+def test_scan_projection_in_chunks(mode):
+    np_frames = _frames(n_img=37)
+    projector = ScanProjector(_Reader(np_frames), 37, mode, chunk=5)
+    projector.start()
+    projector.wait(30)
+    assert projector.done()
+    assert projector.progress() == 1.0
+    assert np.allclose(projector.result, _expected(np_frames, 0, 37, mode))
+
+
+def test_scan_projection_cancelled():
+    def frame_fun(index):
+        if index == 3:
+            projector.cancel()
+
+        return np.ones((2, 2))
+
+    projector = ScanProjector(frame_fun, 100, "sum", chunk=4)
+    projector.start()
+    projector.wait(30)
+    assert not projector.done()
+    assert projector.n_done == 4
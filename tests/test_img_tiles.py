@@ -0,0 +1,87 @@
+# coding: utf-8
+
+"""Test the pyramid of tiles the image viewer paints"""
+
+import numpy as np
+
+from dui.outputs_n_viewers.img_tiles import TilePyramid, bin2
+
+
+def _image(height, width):
+    img_arr = np.zeros((height, width, 4), dtype=np.uint8)
+    img_arr[:, :, 0] = np.arange(width) % 256
+    img_arr[:, :, 1] = (np.arange(height) % 256)[:, None]
+    return img_arr
+
+
+def test_bin2_mean_of_blocks():
+    img_arr = np.zeros((2, 4, 4), dtype=np.uint8)
+    img_arr[:, 0:2, 2] = [[0, 255], [255, 255]]
+    img_arr[:, 2:4, 2] = [[10, 20], [30, 40]]
+    binned = bin2(img_arr)
+    assert binned.shape == (1, 2, 4)
+    assert binned.dtype == np.uint8
+    assert list(binned[0, :, 2]) == [191, 25]
+
+    # odd sizes repeat the last row and column
+    assert bin2(_image(5, 7)).shape == (3, 4, 4)
+    assert bin2(_image(5, 7))[2, 3, 0] == 6
+
+
+def test_level_follows_the_zoom():
+    pyramid = TilePyramid(_image(1000, 600), list, tile=100)
+    assert pyramid.top_level == 4
+    assert pyramid.level_for_scale(3.0) == 0
+    assert pyramid.level_for_scale(1.0) == 0
+    assert pyramid.level_for_scale(0.6) == 0
+    assert pyramid.level_for_scale(0.5) == 1
+    assert pyramid.level_for_scale(0.3) == 1
+    assert pyramid.level_for_scale(0.2) == 2
+    assert pyramid.level_for_scale(0.001) == 4
+    assert pyramid.level(2).shape == (250, 150, 4)
+    # built when first needed, once
+    assert len(pyramid.levels) == 3
+
+
+def _covered(lst_tile, height, width):
+    np_count = np.zeros((height, width), dtype=int)
+    for _, (x_tile, y_tile, w_tile, h_tile) in lst_tile:
+        np_count[y_tile : y_tile + h_tile, x_tile : x_tile + w_tile] += 1
+
+    return np_count
+
+
+def test_visible_tiles_cover_without_gaps():
+    pyramid = TilePyramid(_image(1000, 600), lambda tile_arr: tile_arr, tile=100)
+    for scale in (2.0, 1.0, 0.7, 0.45, 0.2):
+        scaled_h = int(round(1000 * scale))
+        scaled_w = int(round(600 * scale))
+        lst_tile = pyramid.visible_tiles(scale, 0, 0, scaled_w, scaled_h)
+        np_count = _covered(lst_tile, scaled_h, scaled_w)
+        assert (np_count == 1).all()
+
+
+def test_only_exposed_tiles_made_and_kept():
+    pyramid = TilePyramid(_image(1000, 600), lambda tile_arr: tile_arr, tile=100)
+    # a 150 x 150 corner at full size
+    lst_tile = pyramid.visible_tiles(1.0, 120, 220, 270, 370)
+    assert sorted(rect[:2] for _, rect in lst_tile) == [
+        (100, 200),
+        (100, 300),
+        (200, 200),
+        (200, 300),
+    ]
+    tile_arr = [tile for tile, rect in lst_tile if rect[:2] == (200, 300)][0]
+    assert tile_arr.shape == (100, 100, 4)
+    assert tile_arr[0, 0, 0] == 200 and tile_arr[0, 0, 1] == 44
+    assert pyramid.n_made == 4
+
+    # painting again, panning a bit, makes no new tile
+    pyramid.visible_tiles(1.0, 125, 225, 270, 370)
+    assert pyramid.n_made == 4
+
+    # the last tiles are smaller
+    lst_tile = pyramid.visible_tiles(1.0, 550, 950, 600, 1000)
+    assert [rect for _, rect in lst_tile] == [(500, 900, 100, 100)]
+    narrow = TilePyramid(_image(1000, 650), lambda tile_arr: tile_arr, tile=100)
+    assert narrow.get_tile(0, 9, 6).shape == (100, 50, 4)
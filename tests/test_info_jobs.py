@@ -0,0 +1,57 @@
+# coding: utf-8
+
+"""Test the background queue of reports and predictions"""
+
+import threading
+
+from dui.info_jobs import InfoJobQueue
+
+
+class _FakeNode(object):
+    def __init__(self, lin_num, lst_ran, gate=None):
+        self.lin_num = lin_num
+        self.success = True
+        self.report_out = None
+        self.predict_pickle_out = None
+        self.lst_ran = lst_ran
+        self.gate = gate
+
+    def gen_repr_n_pred(self, to_run=None):
+        if self.gate is not None:
+            self.gate.wait(5)
+
+        self.lst_ran.append((self.lin_num, to_run))
+        if to_run == "report":
+            self.report_out = str(self.lin_num) + "_report.html"
+
+
+def test_urgent_first_and_no_duplicates():
+    lst_ran = []
+    gate = threading.Event()
+    all_done = threading.Event()
+
+    def on_done(lin_num, kind):
+        if len(lst_ran) == 5:
+            all_done.set()
+
+    info_jobs = InfoJobQueue(on_done=on_done)
+    busy_node = _FakeNode(1, lst_ran, gate)
+    info_jobs.request(busy_node, "report")
+    old_node = _FakeNode(2, lst_ran)
+    info_jobs.prefetch(old_node)
+    seen_node = _FakeNode(3, lst_ran)
+    info_jobs.prefetch(seen_node)
+    # the user now looks at the report of node 3, and asks twice
+    info_jobs.request(seen_node, "report")
+    info_jobs.request(seen_node, "report")
+    assert info_jobs.is_pending(seen_node, "report")
+
+    gate.set()
+    assert all_done.wait(5)
+    info_jobs.shutdown()
+
+    assert lst_ran[:2] == [(1, "report"), (3, "report")]
+    assert sorted(lst_ran[2:4]) == [(2, "predict"), (2, "report")]
+    # prefetched after node 2, and the report of node 3 ran only once
+    assert lst_ran[4:] == [(3, "predict")]
+    assert not info_jobs.request(seen_node, "report")
@@ -0,0 +1,36 @@
+# coding: utf-8
+
+"""Test reading big logs by line number"""
+
+from dui.line_log import INDEX_STRIDE, LineIndexedLog
+
+
+def test_write_and_page(tmpdir):
+    path = str(tmpdir / "1_dials.index_out.log")
+    new_log = LineIndexedLog(path)
+    new_log.open_new()
+    n_lines = INDEX_STRIDE * 5 + 7
+    for num in range(n_lines):
+        new_log.append("line " + str(num))
+
+    new_log.append(b"bytes line")
+    new_log.close()
+
+    old_log = LineIndexedLog.open_existing(path)
+    assert len(old_log) == n_lines + 1
+    assert old_log.get_lines(INDEX_STRIDE - 1, INDEX_STRIDE + 2) == [
+        "line " + str(INDEX_STRIDE - 1),
+        "line " + str(INDEX_STRIDE),
+        "line " + str(INDEX_STRIDE + 1),
+    ]
+    assert old_log.tail(2) == ["line " + str(n_lines - 1), "bytes line"]
+    assert old_log.get_lines(n_lines + 5, n_lines + 9) == []
+
+
+def test_plain_file_gets_indexed(tmpdir):
+    path = tmpdir / "2_find_spots.log"
+    path.write("\n".join("spot " + str(num) for num in range(200)) + "\n")
+    old_log = LineIndexedLog.open_existing(str(path))
+    assert len(old_log) == 200
+    assert old_log.get_lines(130, 132) == ["spot 130", "spot 131"]
+    assert LineIndexedLog.open_existing(str(tmpdir / "missing.log")) is None
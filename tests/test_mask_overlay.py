@@ -0,0 +1,59 @@
+# coding: utf-8
+
+"""Test the red overlay of the mask in the image viewer"""
+
+import numpy as np
+
+from dui.outputs_n_viewers.mask_overlay import (
+    MASK_BGRA,
+    PANEL_GAP,
+    MaskOverlayCache,
+    overlay_bgra,
+    stacked_mask,
+)
+
+
+def test_overlay_red_where_masked():
+    np_mask = np.ones((3, 5), dtype=bool)
+    np_mask[1, 2] = False
+    np_mask[2, 4] = False
+    img_array = overlay_bgra(np_mask)
+    assert img_array.shape == (3, 5, 4)
+    assert img_array.dtype == np.uint8
+    assert tuple(img_array[1, 2]) == MASK_BGRA
+    assert tuple(img_array[2, 4]) == MASK_BGRA
+    assert img_array.sum() == 2 * sum(MASK_BGRA)
+
+
+def test_panels_stacked_as_the_image():
+    lst_np_mask = [np.ones((4, 3), dtype=bool) for _ in range(24)]
+    lst_np_mask[1][0, 0] = False
+    np_stacked = stacked_mask(lst_np_mask)
+    assert np_stacked.shape == (24 * (4 + PANEL_GAP), 3)
+    assert not np_stacked[4 + PANEL_GAP, 0]
+    # the gaps between panels are not masked
+    assert np_stacked.sum() == np_stacked.size - 1
+
+    # other numbers of panels show only the first one
+    assert stacked_mask(lst_np_mask[:2]).shape == (4, 3)
+
+
+def test_cache_by_file_and_mtime():
+    overlays = MaskOverlayCache(n_overlays=2)
+    lst_built = []
+
+    def build(name):
+        return lambda: lst_built.append(name) or name
+
+    assert overlays.get(("m1", 1.0), build("a")) == "a"
+    assert overlays.get(("m1", 1.0), build("b")) == "a"
+    # the file was written again
+    assert overlays.get(("m1", 2.0), build("c")) == "c"
+    overlays.get(("m2", 1.0), build("d"))
+    # the oldest is forgotten
+    assert overlays.get(("m1", 1.0), build("e")) == "e"
+    # no key, nothing kept
+    overlays.get(None, build("f"))
+    overlays.get(None, build("g"))
+    assert lst_built == ["a", "c", "d", "e", "f", "g"]
+    assert overlays.n_built == 6
@@ -0,0 +1,82 @@
+# coding: utf-8
+
+"""Test the parameter sweep engine"""
+
+from dui.m_idials import Runner
+from dui.param_sweep import (
+    ParamSweep,
+    apply_params,
+    expand_grid,
+    parse_grid_text,
+    read_step_metrics,
+)
+
+
+class _RecordingScheduler(object):
+    max_running = 2
+
+    def __init__(self):
+        self.lst_sub = []
+
+    def is_busy(self, node):
+        return False
+
+    def submit(self, node, cmd_lst):
+        self.lst_sub.append((node, cmd_lst))
+        node.run_state = "queued"
+        return True
+
+
+def test_grid_and_params():
+    grid = parse_grid_text("sigma_strong=3, 6\n# comment\nmin_local=0,2\n")
+    assert len(expand_grid(grid)) == 4
+    assert expand_grid(grid)[1] == {"sigma_strong": "3", "min_local": "2"}
+    assert apply_params(
+        [["find_spots", "sigma_strong=2", "d_max=20"]], {"sigma_strong": "6"}
+    ) == [["find_spots", "d_max=20", "sigma_strong=6"]]
+
+
+def test_sweep_forks_siblings():
+    runner = Runner()
+    runner.current_node.ll_command_lst = [["import"]]
+    runner.current_node.success = True
+    runner.run(["mkchi"], None)
+    base_node = runner.current_node
+
+    scheduler = _RecordingScheduler()
+    param_sweep = ParamSweep(runner, scheduler)
+    lst_node = param_sweep.start(
+        base_node, [["find_spots"]], parse_grid_text("sigma_strong=3,4,6")
+    )
+    assert lst_node[0] is base_node
+    assert runner.current_node is base_node
+    assert [node.prev_step for node in lst_node] == [base_node.prev_step] * 3
+    assert [cmd for _, cmd in scheduler.lst_sub] == [
+        [["find_spots", "sigma_strong=" + val]] for val in ["3", "4", "6"]
+    ]
+    assert [row["state"] for row in param_sweep.results()] == ["queued"] * 3
+
+
+def test_read_step_metrics(tmpdir):
+    log_path = tmpdir.join("3_index.log")
+    log_path.write(
+        "Saved 5012 reflections to 2_reflections.refl\n"
+        "+------------+-------------+---------------+-------------+\n"
+        "|   Imageset |   # indexed |   # unindexed |   % indexed |\n"
+        "|------------+-------------+---------------+-------------|\n"
+        "|          0 |        4800 |           212 |        95.8 |\n"
+        "+------------+-------------+---------------+-------------+\n"
+        "RMSDs by experiment:\n"
+        "+-------+--------+----------+----------+------------+\n"
+        "|   Exp |   Nref |   RMSD_X |   RMSD_Y |     RMSD_Z |\n"
+        "|    id |        |     (px) |     (px) |   (images) |\n"
+        "|-------+--------+----------+----------+------------|\n"
+        "|     0 |   4000 |  0.31    |  0.29    |    0.22    |\n"
+    )
+    assert read_step_metrics(str(log_path)) == {
+        "strong_spots": 5012,
+        "indexed_%": 95.8,
+        "rmsd_x": 0.31,
+        "rmsd_y": 0.29,
+        "rmsd_z": 0.22,
+    }
@@ -0,0 +1,123 @@
+# coding: utf-8
+
+"""Test the decoder processes and shared ring of the movie player"""
+
+import time
+
+import numpy as np
+
+from dui.outputs_n_viewers.playback import PlaybackEngine
+
+
+def fake_load(expt_path):
+    # number of images, the only thing the fake render needs
+    return int(expt_path)
+
+
+def fake_render(n_img, index, pan_num, palette, i_min, i_max):
+    # as slow as a small decode, the frame tells which image it was
+    time.sleep(0.01)
+    bgrx_arr = np.zeros((6, 4, 4), dtype=np.uint8)
+    bgrx_arr[:, :, 0] = index
+    bgrx_arr[:, :, 1] = i_max
+    return bgrx_arr
+
+
+def fake_render_fails(n_img, index, pan_num, palette, i_min, i_max):
+    raise IOError("truncated file")
+
+
+def _engine(render_fun=fake_render, n_img=20):
+    return PlaybackEngine(
+        str(n_img),
+        (6, 4),
+        n_img,
+        n_decoders=2,
+        n_slots=4,
+        load_fun=fake_load,
+        render_fun=render_fun,
+    )
+
+
+def _wait_frame(engine, now, timeout=60):
+    end_time = time.time() + timeout
+    while time.time() < end_time:
+        frame = engine.next_frame(now)
+        if frame is not None:
+            return frame
+
+        time.sleep(0.01)
+
+    raise AssertionError("no frame from the decoders")
+
+
+def _wait_ready(engine, n_ready, timeout=60):
+    end_time = time.time() + timeout
+    while engine.n_ready() < n_ready:
+        if time.time() > end_time:
+            raise AssertionError("the decoders did not fill the ring")
+
+        time.sleep(0.01)
+
+
+def test_frames_in_order_with_their_look():
+    engine = _engine()
+    try:
+        engine.set_look("hot ascend", -3, 77)
+        # a frame rate of 1 so the test sets the clock
+        engine.play(18, fps=1, now=0.0)
+        for n_sec, index in [(0, 18), (1, 19), (2, 0)]:
+            img_pos, bgrx_arr = _wait_frame(engine, float(n_sec))
+            assert img_pos == index
+            assert bgrx_arr.shape == (6, 4, 4)
+            assert bgrx_arr[0, 0, 0] == index
+            assert bgrx_arr[0, 0, 1] == 77
+
+        # nothing new before the next frame is due
+        assert engine.next_frame(2.5) is None
+        assert engine.n_dropped == 0
+
+    finally:
+        engine.close()
+
+
+def test_late_frames_dropped():
+    engine = _engine()
+    try:
+        engine.play(0, fps=1, now=0.0)
+        assert _wait_frame(engine, 0.0)[0] == 0
+        # the decoders fill the other 3 slots, then the GUI comes back late
+        _wait_ready(engine, 3)
+        # the latest of the ready frames 1, 2, 3 is shown, 4 to 10 are
+        # never decoded and the movie goes on at 11
+        img_pos, _ = _wait_frame(engine, 10.0)
+        assert img_pos == 3
+        assert _wait_frame(engine, 11.0)[0] == 11
+        assert engine.n_dropped == 9
+        assert engine.n_shown == 3
+        assert "9 dropped" in engine.stats_txt()
+
+        # playing again forgets what was decoded for the old movie
+        engine.play(5, step=2, fps=1, now=100.0)
+        assert _wait_frame(engine, 100.0)[0] == 5
+        assert _wait_frame(engine, 101.0)[0] == 7
+
+    finally:
+        engine.close()
+
+
+def test_failed_decode_skipped():
+    engine = _engine(fake_render_fails)
+    try:
+        engine.play(0, fps=1, now=0.0)
+        for _ in range(1200):
+            assert engine.next_frame(0.0) is None
+            if engine.n_dropped:
+                break
+
+            time.sleep(0.05)
+
+        assert engine.n_dropped >= 1
+
+    finally:
+        engine.close()
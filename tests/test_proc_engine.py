@@ -0,0 +1,49 @@
+# coding: utf-8
+
+"""Test the process engine and its batched output"""
+
+import sys
+import time
+
+from dui.line_log import LineIndexedLog
+from dui.proc_engine import MAX_UI_RATE, LineBatcher, run_process
+
+N_LINES = 20000
+
+
+def test_output_batched_and_logged(tmpdir):
+    log_path = str(tmpdir.join("1_test_out.log"))
+    out_log = LineIndexedLog(log_path)
+    out_log.open_new()
+    lst_batch = []
+    lst_pid = []
+    batcher = LineBatcher(out_log, on_lines=lst_batch.append, tail_lines=100)
+
+    start = time.time()
+    exit_status = run_process(
+        [
+            sys.executable,
+            "-c",
+            "import sys\n"
+            "for i in range({}): print('line', i)\n"
+            "sys.stdout.write('no line end')\n"
+            "sys.exit(3)".format(N_LINES),
+        ],
+        cwd_path=str(tmpdir),
+        batcher=batcher,
+        on_start=lst_pid.append,
+    )
+    elapsed = time.time() - start
+    out_log.close()
+
+    assert exit_status == 3
+    assert len(lst_pid) == 1
+    assert batcher.n_lines == N_LINES + 1
+    assert len(lst_batch) <= elapsed * MAX_UI_RATE + 2
+    assert lst_batch[-1].split("\n")[-1] == "no line end"
+    assert batcher.tail_lines()[0] == "line {}".format(N_LINES - 99)
+
+    # the UI may skip lines, the log file has every one of them
+    reread = LineIndexedLog.open_existing(log_path)
+    assert len(reread) == N_LINES + 1
+    assert reread.get_lines(1234, 1235) == ["line 1234"]
@@ -0,0 +1,75 @@
+# coding: utf-8
+
+"""Test the nice level, cores and memory limits of the steps"""
+
+import os
+import subprocess
+import sys
+
+import psutil
+import pytest
+
+from dui.cli_utils import DialsCommand, sys_arg
+from dui.proc_limits import StepLimits, says_out_of_memory
+
+GROW = (
+    "import time\n"
+    "lst_block = []\n"
+    "for _ in range(100):\n"
+    "    lst_block.append(bytearray(16 * 1024 ** 2))\n"
+    "    time.sleep(0.05)\n"
+    "time.sleep(60)"
+)
+
+
+def test_limits_applied_to_a_process():
+    sleeper = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        StepLimits(nice=7, gui_cores=1, vmem_limit_mb=4096).apply(sleeper.pid)
+        proc = psutil.Process(sleeper.pid)
+        assert proc.nice() >= 7
+        if hasattr(psutil, "RLIMIT_AS"):
+            assert proc.rlimit(psutil.RLIMIT_AS)[0] == 4096 * 1024 ** 2
+
+        lst_cpu = StepLimits(gui_cores=1).cpus()
+        if lst_cpu is not None:
+            assert proc.cpu_affinity() == lst_cpu
+            assert len(lst_cpu) == len(os.sched_getaffinity(0)) - 1
+
+    finally:
+        sleeper.kill()
+        sleeper.wait()
+
+    assert StepLimits(gui_cores=0).cpus() is None
+
+
+def test_out_of_memory_marks():
+    assert says_out_of_memory(["Traceback", "MemoryError"])
+    assert not says_out_of_memory(["all fine"])
+
+
+@pytest.fixture
+def dui_files(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys_arg, "directory", str(tmpdir))
+    tmpdir.mkdir("dui_files")
+    return tmpdir.join("dui_files")
+
+
+def test_step_over_memory_limit_fails(dui_files, monkeypatch):
+    monkeypatch.setattr(sys_arg, "mem_limit_mb", 200)
+    dials_command = DialsCommand()
+    out_path = str(dui_files.join("8_out.log"))
+    assert dials_command([[sys.executable, "-c", GROW]], None, out_path) is False
+    assert dials_command.out_of_memory
+    with open(out_path) as log_in:
+        assert "out of memory" in log_in.read()
+
+
+@pytest.mark.skipif(not hasattr(psutil, "RLIMIT_AS"), reason="no RLIMIT_AS")
+def test_address_space_limit_fails_allocation(dui_files, monkeypatch):
+    monkeypatch.setattr(sys_arg, "vmem_limit_mb", 512)
+    dials_command = DialsCommand()
+    big_alloc = "import time; time.sleep(0.5); bytearray(1024 ** 3)"
+    out_path = str(dui_files.join("9_out.log"))
+    assert dials_command([[sys.executable, "-c", big_alloc]], None, out_path) is False
+    assert dials_command.out_of_memory
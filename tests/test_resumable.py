@@ -0,0 +1,128 @@
+# coding: utf-8
+
+"""Test stopping steps gracefully and resuming them"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+import psutil
+import pytest
+
+from dui.cli_utils import DialsCommand, sys_arg
+from dui.executors import stop_tree
+from dui.resumable import QUARANTINE_DIR, image_blocks, split_integrate
+
+
+@pytest.fixture
+def dui_files(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys_arg, "directory", str(tmpdir))
+    tmpdir.mkdir("dui_files")
+    return tmpdir.join("dui_files")
+
+
+def py_cmd(code, *args):
+    # python -c ignores the arguments after the code
+    return [sys.executable, "-c", code] + list(args)
+
+
+def test_image_blocks_and_split_integrate(tmpdir):
+    assert image_blocks(1, 10, 3) == [(1, 3), (4, 6), (7, 10)]
+    assert image_blocks(5, 6, 4) == [(5, 5), (6, 6)]
+
+    tmpdir.join("3_experiments.expt").write(
+        json.dumps({"scan": [{"image_range": [1, 100]}]})
+    )
+    lst_inner = [
+        "dials.integrate",
+        "nproc=4",
+        "input.experiments=3_experiments.expt",
+        "input.reflections=3_reflections.refl",
+        "output.experiments=4_experiments.expt",
+        "output.reflections=4_reflections.refl",
+    ]
+    lst_cmd = split_integrate(lst_inner, 4, str(tmpdir), 2)
+    assert [cmd[0] for cmd in lst_cmd] == [
+        "dials.slice_sequence",
+        "dials.integrate",
+        "dials.slice_sequence",
+        "dials.integrate",
+        "dials.combine_experiments",
+    ]
+    assert "image_range=51,100" in lst_cmd[2]
+    assert "nproc=4" in lst_cmd[3]
+    assert lst_cmd[-1][-1] == "output.reflections=4_reflections.refl"
+    # nothing to split without a scan
+    assert split_integrate(lst_inner, 4, str(tmpdir.mkdir("empty")), 2) == [
+        lst_inner
+    ]
+    # nor with several scans
+    multi_dir = tmpdir.mkdir("multi")
+    multi_dir.join("3_experiments.expt").write(
+        json.dumps(
+            {"scan": [{"image_range": [1, 100]}, {"image_range": [1, 50]}]}
+        )
+    )
+    assert split_integrate(lst_inner, 4, str(multi_dir), 2) == [lst_inner]
+
+
+def test_resume_skips_finished_commands(dui_files):
+    lst_cmd = [
+        py_cmd(
+            "open('count', 'a').write('x'); open('a.out', 'w').write('a')",
+            "output.file=a.out",
+        ),
+        py_cmd("import os, sys; sys.exit(0 if os.path.exists('ok') else 1)"),
+    ]
+    out_path = str(dui_files.join("5_integrate_out.log"))
+    assert DialsCommand()(lst_cmd, None, out_path) is False
+
+    dui_files.join("ok").write("")
+    assert DialsCommand()(lst_cmd, None, out_path) is True
+    assert dui_files.join("count").read() == "x"
+    assert not os.path.exists(out_path + ".ckpt")
+
+
+def test_stopped_command_outputs_quarantined(dui_files):
+    dials_command = DialsCommand()
+    lst_cmd = [
+        py_cmd(
+            "import time; open('part.out', 'w').write('half'); time.sleep(60)",
+            "output.reflections=part.out",
+        )
+    ]
+
+    def stop_when_written():
+        while not dui_files.join("part.out").exists():
+            time.sleep(0.05)
+
+        dials_command.cancel()
+
+    stop_thread = threading.Thread(target=stop_when_written)
+    stop_thread.start()
+    success = dials_command(lst_cmd, None, str(dui_files.join("6_out.log")))
+    stop_thread.join()
+
+    assert success is False
+    assert dials_command.was_cancelled
+    assert not dui_files.join("part.out").exists()
+    assert dui_files.join(QUARANTINE_DIR, "part.out").read() == "half"
+
+
+def test_stop_tree_kills_after_grace():
+    stubborn = psutil.Popen(
+        py_cmd(
+            "import signal, time\n"
+            "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+            "print('ready', flush=True)\n"
+            "time.sleep(60)"
+        ),
+        stdout=-1,
+    )
+    stubborn.stdout.readline()
+    start = time.time()
+    stop_tree(stubborn.pid, grace_s=0.5)
+    assert stubborn.wait(5) != 0
+    assert 0.4 < time.time() - start < 5
@@ -0,0 +1,94 @@
+# coding: utf-8
+
+"""Test the node index and the cached lookups of the navigation tree"""
+
+import threading
+import time
+
+import pytest
+
+from dui.m_idials import CommandNode, Runner
+
+
+def _add_done_step(runner, command):
+    node = runner.current_node
+    node.ll_command_lst = [[command]]
+    node.success = True
+    node.json_file_out = str(node.lin_num) + "_experiments.expt"
+    runner.run(["mkchi"], None)
+    return node
+
+
+def test_goto_and_ancestor_lookups():
+    runner = Runner()
+    imp_node = _add_done_step(runner, "import")
+    fnd_node = _add_done_step(runner, "find_spots")
+    idx_node = _add_done_step(runner, "index")
+
+    runner.run(["goto", str(fnd_node.lin_num)], None)
+    assert runner.current_node is fnd_node
+    runner.run(["mkchi"], None)
+    branch_node = runner.current_node
+
+    assert runner.get_node(idx_node.lin_num) is idx_node
+    assert runner.get_ancestor_path(idx_node) == [
+        runner.step_list[0],
+        imp_node,
+        fnd_node,
+        idx_node,
+    ]
+    assert runner.find_ancestor(idx_node, "find_spots") is fnd_node
+    assert runner.find_ancestor(fnd_node, "find_spots") is None
+    assert runner.find_ancestor(branch_node, "import") is imp_node
+    assert runner.get_datablock_path() == imp_node.json_file_out
+
+    # the cached answers must follow changes in the tree
+    imp_node.success = False
+    runner.tree_changed()
+    assert runner.get_datablock_path() is None
+
+    runner.run(["clean"], None)
+    assert runner.get_node(branch_node.lin_num) is branch_node
+    runner.run(["goto", str(idx_node.lin_num)], None)
+    runner.run(["clean"], None)
+    assert runner.get_node(branch_node.lin_num) is None
+
+
+def test_deep_tree():
+    runner = Runner()
+    _add_done_step(runner, "import")
+    for num in range(3000):
+        _add_done_step(runner, "find_spots" if num % 100 == 0 else "index")
+
+    node = runner.current_node
+    assert runner.get_node(node.lin_num) is node
+    assert len(runner.get_ancestor_path(node)) == node.lin_num + 1
+    assert runner.find_ancestor(node, "find_spots").lin_num == 2902
+    assert runner.get_datablock_path() == "1_experiments.expt"
+
+
+def test_lazy_node_loaded_once_by_racing_threads():
+    lst_loaded = []
+
+    def details_loader(node):
+        lst_loaded.append(node.lin_num)
+        # slow enough for the other threads to arrive while loading
+        time.sleep(0.1)
+        node.json_file_out = "1_experiments.expt"
+
+    node = CommandNode.lazy(None, 1, [["import"]], True, details_loader)
+    lst_seen = []
+    lst_thread = [
+        threading.Thread(target=lambda: lst_seen.append(node.json_file_out))
+        for _ in range(4)
+    ]
+    for tmp_thread in lst_thread:
+        tmp_thread.start()
+
+    for tmp_thread in lst_thread:
+        tmp_thread.join(5)
+
+    assert lst_loaded == [1]
+    assert lst_seen == ["1_experiments.expt"] * 4
+    with pytest.raises(AttributeError):
+        node.not_an_attribute
@@ -0,0 +1,97 @@
+# coding: utf-8
+
+"""Test saving and replaying the navigation tree through the journal"""
+
+import os
+import pickle
+
+from dui.m_idials import Runner
+from dui.session_format import load_legacy_pickle
+from dui.session_journal import JOURNAL_NAME, SessionJournal
+
+
+def _make_session(dir_path):
+    runner = Runner()
+    journal = SessionJournal(dir_path)
+    journal.attach(runner)
+    for command in ["import", "find_spots", "index"]:
+        runner.current_node.ll_command_lst = [[command]]
+        runner.current_node.success = True
+        runner.current_node.json_file_out = command + ".expt"
+        journal.log_node(runner.current_node)
+        runner.run(["mkchi"], None)
+
+    runner.run(["goto", "2"], None)
+    runner.run(["mksib"], None)
+    return runner, journal
+
+
+def _tree(runner):
+    return [
+        (
+            node.lin_num,
+            node.prev_step.lin_num if node.prev_step else None,
+            node.ll_command_lst,
+            node.success,
+        )
+        for node in runner.step_list
+    ]
+
+
+def test_replay(tmpdir):
+    runner, journal = _make_session(str(tmpdir))
+    journal.close()
+
+    new_journal = SessionJournal(str(tmpdir))
+    loaded = new_journal.load()
+    assert _tree(loaded) == _tree(runner)
+    assert loaded.current_line == runner.current_line
+    assert loaded.get_datablock_path() == "import.expt"
+
+    # keeps appending after a reload
+    new_journal.attach(loaded, fresh=False)
+    loaded.run(["clean"], None)
+    new_journal.close()
+    assert _tree(SessionJournal(str(tmpdir)).load()) == _tree(loaded)
+
+
+def test_torn_record_and_compaction(tmpdir):
+    runner, journal = _make_session(str(tmpdir))
+    journal.compact(wait=True)
+    runner.run(["goto", "3"], None)
+    journal.close()
+
+    # a crash while writing leaves half a line behind
+    with open(os.path.join(str(tmpdir), JOURNAL_NAME), "ab") as jrn_out:
+        jrn_out.write(b'0badc0de\t{"op": "go')
+
+    new_journal = SessionJournal(str(tmpdir))
+    loaded = new_journal.load()
+    assert _tree(loaded) == _tree(runner)
+    assert loaded.current_line == 3
+
+
+def test_lazy_details(tmpdir):
+    runner, journal = _make_session(str(tmpdir))
+    journal.compact(wait=True)
+    journal.close()
+
+    loaded = SessionJournal(str(tmpdir)).load()
+    idx_node = loaded.get_node(3)
+    assert "json_file_out" not in idx_node.__dict__
+    assert idx_node.ll_command_lst == [["index"]]
+    assert idx_node.json_file_out == "index.expt"
+    assert idx_node.dials_command.full_cmd_lst == [None]
+
+
+def test_migrate_bkp_pickle(tmpdir):
+    runner = Runner()
+    runner.current_node.ll_command_lst = [["import"]]
+    runner.current_node.success = True
+    with open(str(tmpdir / "bkp.pickle"), "wb") as bkp_out:
+        pickle.dump(runner, bkp_out)
+
+    loaded = load_legacy_pickle(str(tmpdir / "bkp.pickle"))
+    SessionJournal(str(tmpdir)).attach(loaded)
+    assert SessionJournal.exists(str(tmpdir))
+    assert _tree(SessionJournal(str(tmpdir)).load()) == _tree(runner)
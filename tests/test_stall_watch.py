@@ -0,0 +1,94 @@
+# coding: utf-8
+
+"""Test flagging, stopping and queuing again stalled steps"""
+
+import os
+import sys
+import time
+
+import pytest
+
+from dui.cli_utils import DialsCommand, sys_arg
+from dui.disk_gc import DiskGC
+from dui.m_idials import Runner
+from dui.stall_watch import StallWatchdog, stack_dump
+
+
+class _FakeBatcher(object):
+    last_output = 0.0
+
+
+def test_silent_and_idle_is_stalled():
+    lst_call = []
+    cpu_now = [50.0]
+    batcher = _FakeBatcher()
+    watchdog = StallWatchdog(
+        batcher,
+        lambda stalled, silent_s: lst_call.append(stalled),
+        cpu_fun=lambda: cpu_now[0],
+        stall_s=10,
+    )
+    assert watchdog.check(now=5) is False
+    # silent but working
+    assert watchdog.check(now=20) is False
+    cpu_now[0] = 0.5
+    assert watchdog.check(now=21) is True
+    assert watchdog.check(now=22) is True
+    assert lst_call == [True]
+
+    batcher.last_output = 21.5
+    assert watchdog.check(now=22) is False
+    assert lst_call == [True, False]
+
+
+def test_stack_dump_without_tools(monkeypatch):
+    monkeypatch.setattr("shutil.which", lambda name: None)
+    assert "py-spy" in stack_dump(12345)
+
+
+@pytest.fixture
+def dui_files(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys_arg, "directory", str(tmpdir))
+    tmpdir.mkdir("dui_files")
+    return tmpdir.join("dui_files")
+
+
+def test_stalled_step_queued_again(dui_files, monkeypatch):
+    monkeypatch.setattr(sys_arg, "stall_s", 0.5)
+    monkeypatch.setattr(sys_arg, "stall_action", "requeue")
+    hang_once = (
+        "import os, sys, time\n"
+        "if os.path.exists('tried'):\n"
+        "    sys.exit(0)\n"
+        "open('tried', 'w').close()\n"
+        "print('going to hang', flush=True)\n"
+        "time.sleep(60)"
+    )
+    out_path = str(dui_files.join("7_out.log"))
+    start = time.time()
+    dials_command = DialsCommand()
+    assert dials_command([[sys.executable, "-c", hang_once]], None, out_path)
+    assert time.time() - start < 30
+    assert dials_command.stalled is False
+    assert dui_files.join("7_out.log.stacks").exists()
+
+
+def test_stacks_of_a_cancelled_step_survive_the_gc(dui_files, monkeypatch):
+    monkeypatch.setattr(sys_arg, "stall_s", 0.5)
+    monkeypatch.setattr(sys_arg, "stall_action", "cancel")
+    runner = Runner()
+    node = runner.current_node
+    node.ll_command_lst = [["find_spots"]]
+    out_path = str(dui_files.join("{}_find_spots_out.log".format(node.lin_num)))
+    dials_command = DialsCommand()
+    node.success = dials_command(
+        [[sys.executable, "-c", "import time; time.sleep(60)"]], None, out_path
+    )
+    assert node.success is False
+    runner.run(["mkchi"], None)
+    dui_files.join("{}_strong.refl".format(node.lin_num)).write("x")
+
+    DiskGC(runner, str(dui_files)).collect()
+    assert not dui_files.join("{}_strong.refl".format(node.lin_num)).exists()
+    assert os.path.exists(out_path)
+    assert os.path.exists(out_path + ".stacks")
@@ -0,0 +1,120 @@
+# coding: utf-8
+
+"""Test the content-addressed cache of step results"""
+
+import os
+
+from dui.cli_utils import sys_arg
+from dui.m_idials import Runner
+from dui.step_cache import StepCache, normalized_params
+
+
+def _fake_run(node, cmd_lst, cwd_path, txt):
+    """Builds the command of << node >> and writes outputs as DIALS would"""
+    node.ll_command_lst = cmd_lst
+    node.build_command(cmd_lst)
+    for lst_single in node.cmd_lst_to_run:
+        for arg in lst_single:
+            if arg.startswith("output."):
+                with open(os.path.join(cwd_path, arg.split("=")[1]), "w") as f_out:
+                    f_out.write(txt + arg)
+
+    out_path = os.path.join(cwd_path, str(node.lin_num) + "_out.log")
+    with open(out_path, "w") as f_out:
+        f_out.write(txt)
+
+    return out_path
+
+
+def test_hit_links_outputs_and_miss_on_new_input(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys_arg, "directory", str(tmpdir))
+    cwd_path = str(tmpdir.mkdir("dui_files"))
+    runner = Runner()
+    imp_node = runner.current_node
+    imp_node.success = True
+    imp_node.json_file_out = "1_experiments.expt"
+    imp_node.refl_pickle_file_out = "1_reflections.refl"
+    tmpdir.join("dui_files", "1_experiments.expt").write("expt")
+    tmpdir.join("dui_files", "1_reflections.refl").write("refl")
+
+    step_cache = StepCache(os.path.join(cwd_path, "step_cache"))
+    cmd_lst = [["index", "indexing.method=fft1d"]]
+    first_node = runner.add_branch(imp_node)
+    out_path = _fake_run(first_node, cmd_lst, cwd_path, "first")
+    assert not step_cache.fetch(first_node, cwd_path, out_path)
+    step_cache.store(first_node, cwd_path, out_path)
+
+    second_node = runner.add_branch(imp_node)
+    second_node.ll_command_lst = [["index", " indexing.method=fft1d "]]
+    second_node.build_command(second_node.ll_command_lst)
+    second_out = os.path.join(cwd_path, str(second_node.lin_num) + "_out.log")
+    assert step_cache.fetch(second_node, cwd_path, second_out)
+    assert os.path.samefile(
+        os.path.join(cwd_path, first_node.refl_pickle_file_out),
+        os.path.join(cwd_path, second_node.refl_pickle_file_out),
+    )
+    assert open(second_out).read() == "first"
+
+    # same parameters on a different input
+    tmpdir.join("dui_files", "1_reflections.refl").write("other refl")
+    third_node = runner.add_branch(imp_node)
+    third_node.build_command(cmd_lst)
+    third_node.ll_command_lst = cmd_lst
+    assert not step_cache.fetch(third_node, cwd_path, second_out)
+
+    stats = StepCache(os.path.join(cwd_path, "step_cache")).stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 1)
+
+
+def test_params_normalized():
+    assert normalized_params(["b=2 a=1"]) == normalized_params(["a = 1", " b=2"])
+    assert normalized_params(["a=1", 'title="x y"']) == ["a=1", "title=x y"]
+    # repeated parameters keep their order
+    assert normalized_params(["d=3", "c=2", "d=1"]) == ["c=2", "d=3", "d=1"]
+    assert normalized_params(["a=2"]) != normalized_params(["a=1"])
+
+
+def test_reordered_params_hit(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys_arg, "directory", str(tmpdir))
+    cwd_path = str(tmpdir.mkdir("dui_files"))
+    runner = Runner()
+    imp_node = runner.current_node
+    imp_node.success = True
+    imp_node.json_file_out = "1_experiments.expt"
+    imp_node.refl_pickle_file_out = "1_reflections.refl"
+    tmpdir.join("dui_files", "1_experiments.expt").write("expt")
+    tmpdir.join("dui_files", "1_reflections.refl").write("refl")
+
+    step_cache = StepCache(os.path.join(cwd_path, "step_cache"))
+    first_node = runner.add_branch(imp_node)
+    cmd_lst = [["index", "indexing.method=fft1d", "d_min=2.5"]]
+    out_path = _fake_run(first_node, cmd_lst, cwd_path, "first")
+    step_cache.store(first_node, cwd_path, out_path)
+
+    second_node = runner.add_branch(imp_node)
+    second_node.ll_command_lst = [["index", "d_min = 2.5", "indexing.method=fft1d"]]
+    second_node.build_command(second_node.ll_command_lst)
+    second_out = os.path.join(cwd_path, str(second_node.lin_num) + "_out.log")
+    assert step_cache.fetch(second_node, cwd_path, second_out)
+
+
+def test_least_recently_used_evicted(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys_arg, "directory", str(tmpdir))
+    cwd_path = str(tmpdir.mkdir("dui_files"))
+    runner = Runner()
+    imp_node = runner.current_node
+    imp_node.success = True
+    imp_node.json_file_out = "1_experiments.expt"
+    imp_node.refl_pickle_file_out = "1_reflections.refl"
+    tmpdir.join("dui_files", "1_experiments.expt").write("expt")
+    tmpdir.join("dui_files", "1_reflections.refl").write("refl")
+
+    step_cache = StepCache(os.path.join(cwd_path, "step_cache"), max_bytes=300)
+    for method in ["fft1d", "fft3d", "real_space_grid_search"]:
+        node = runner.add_branch(imp_node)
+        cmd_lst = [["index", "indexing.method=" + method]]
+        out_path = _fake_run(node, cmd_lst, cwd_path, "x" * 40)
+        step_cache.store(node, cwd_path, out_path)
+
+    assert step_cache.stats()["size"] <= 300
+    assert step_cache.stats()["entries"] < 3
@@ -0,0 +1,88 @@
+# coding: utf-8
+
+"""Test the sampling and export of what each step used"""
+
+import csv
+import json
+import subprocess
+import sys
+
+import pytest
+
+from dui.m_idials import Runner
+from dui.telemetry import ProcSampler, export_session, main, merge, telemetry_tip
+
+
+def test_process_tree_sampled_and_exported(tmpdir):
+    # a parent holding ~50 MB and a busy child
+    my_process = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import subprocess, sys\n"
+            "ballast = bytearray(50 * 1024 ** 2)\n"
+            "subprocess.call([sys.executable, '-c', 'sum(range(10 ** 7))'])",
+        ]
+    )
+    sampler = ProcSampler(my_process.pid, interval=0.05)
+    sampler.start()
+    my_process.wait()
+    telemetry = sampler.stop()
+
+    assert telemetry["rss_peak"] > 50 * 1024 ** 2
+    assert telemetry["threads_max"] >= 1
+    assert telemetry["wall_s"] > 0
+    assert telemetry["samples"]
+    both = merge(telemetry, telemetry)
+    assert both["wall_s"] == round(2 * telemetry["wall_s"], 2)
+    assert both["rss_peak"] == telemetry["rss_peak"]
+
+    runner = Runner()
+    node = runner.current_node
+    node.ll_command_lst = [["import"]]
+    node.success = True
+    node.telemetry = both
+    runner.run(["mkchi"], None)
+    assert "RSS peak" in telemetry_tip(node)
+    assert telemetry_tip(runner.current_node) == ""
+
+    assert export_session(runner, str(tmpdir)) == 1
+    json_dict = json.loads(tmpdir.join("telemetry.json").read())
+    assert json_dict[str(node.lin_num)]["command"] == ["import"]
+    with open(str(tmpdir.join("telemetry.csv"))) as csv_in:
+        lst_row = list(csv.DictReader(csv_in))
+
+    assert [row["command"] for row in lst_row] == ["import"]
+
+
+class _WorkerSampler(ProcSampler):
+    """Counters of a long-lived worker, set by the test"""
+
+    io_now = (0, 0)
+
+    def sample(self):
+        self._io_dict[self.pid] = self.io_now
+
+
+def test_warm_worker_io_counted_from_start():
+    for baseline, expected in ((True, (300, 100)), (False, (1300, 600))):
+        sampler = _WorkerSampler(1, interval=60, baseline=baseline)
+        # what the worker read and wrote for the jobs before this one
+        sampler.io_now = (1000, 500)
+        sampler.start()
+        sampler.io_now = (1300, 600)
+        sampler.sample()
+        telemetry = sampler.stop()
+        assert (telemetry["read_bytes"], telemetry["write_bytes"]) == expected
+
+
+def test_main_on_unsupported_session(tmpdir, monkeypatch, capsys):
+    tmpdir.mkdir("dui_files").join("session.snapshot.json").write(
+        json.dumps({"version": 99})
+    )
+    monkeypatch.setattr(sys, "argv", ["dui-telemetry", "directory=" + str(tmpdir)])
+    with pytest.raises(SystemExit) as exit_info:
+        main()
+
+    assert exit_info.value.code == 1
+    assert "no DUI session" in capsys.readouterr().out
@@ -0,0 +1,61 @@
+# coding: utf-8
+
+"""Test the Chrome trace of what DUI does"""
+
+import json
+import sys
+import threading
+
+from dui.proc_engine import run_process
+from dui.tracing import Tracer, tracer
+
+
+def test_disabled_tracer_records_nothing():
+    my_tracer = Tracer()
+
+    @my_tracer.traced()
+    def double(num):
+        return 2 * num
+
+    with my_tracer.span("outer"):
+        assert double(2) == 4
+
+    assert my_tracer.events == []
+
+
+def test_nested_spans_and_processes(tmpdir):
+    out_path = str(tmpdir.join("out.json"))
+    tracer.enable(out_path)
+    try:
+
+        @tracer.traced("inner")
+        def inner():
+            return run_process([sys.executable, "-c", "pass"])
+
+        with tracer.span("outer", lin_num=3):
+            assert inner() == 0
+            worker = threading.Thread(target=inner, name="worker")
+            worker.start()
+            worker.join()
+
+        tracer.save()
+
+    finally:
+        tracer.path = None
+
+    lst_event = json.loads(open(out_path).read())["traceEvents"]
+    spans = [evt for evt in lst_event if evt["ph"] == "X"]
+    outer = [evt for evt in spans if evt["name"] == "outer"][0]
+    lst_inner = [evt for evt in spans if evt["name"] == "inner"]
+    assert outer["args"] == {"lin_num": 3}
+    assert len(lst_inner) == 2
+    assert lst_inner[0]["tid"] == outer["tid"] != lst_inner[1]["tid"]
+    assert outer["ts"] <= lst_inner[0]["ts"]
+    assert lst_inner[0]["ts"] + lst_inner[0]["dur"] <= outer["ts"] + outer["dur"]
+
+    lst_proc = [evt for evt in spans if evt["cat"] == "process"]
+    assert len(lst_proc) == 2
+    assert all(evt["args"]["exit_status"] == 0 for evt in lst_proc)
+    assert any(
+        evt["ph"] == "M" and evt["args"]["name"] == "worker" for evt in lst_event
+    )
@@ -0,0 +1,117 @@
+# coding: utf-8
+
+"""Test running DIALS commands in warm worker processes"""
+
+import os
+import textwrap
+import threading
+import time
+
+import pytest
+
+from dui.executors import Job, WarmExecutor
+from dui.proc_engine import LineBatcher
+
+COMMANDS = {
+    "hello": """
+        import os, sys
+        print("args", " ".join(sys.argv[1:]))
+        print("cwd", os.path.basename(os.getcwd()))
+        print("no line end", end="")
+        sys.exit(3)
+        """,
+    "crash": """
+        import os
+        print("about to crash", flush=True)
+        os._exit(9)
+        """,
+    "sleeper": """
+        import time
+        print("started", flush=True)
+        time.sleep(60)
+        """,
+    "hog": """
+        import sys
+        sys.hog = bytearray(64 * 1024 ** 2)
+        """,
+}
+
+
+@pytest.fixture
+def fake_dials(tmpdir, monkeypatch):
+    """A dials.command_line package with the commands above"""
+    pkg_dir = tmpdir.mkdir("fake_dials").mkdir("dials")
+    pkg_dir.join("__init__.py").write("")
+    cmd_dir = pkg_dir.mkdir("command_line")
+    cmd_dir.join("__init__.py").write("")
+    for name, code in COMMANDS.items():
+        cmd_dir.join(name + ".py").write(textwrap.dedent(code))
+
+    monkeypatch.setenv(
+        "PYTHONPATH",
+        os.pathsep.join(
+            [str(tmpdir.join("fake_dials")), os.environ.get("PYTHONPATH", "")]
+        ),
+    )
+    executor = WarmExecutor(n_workers=1, max_growth_mb=32)
+    yield executor
+    executor.shutdown()
+
+
+def run(executor, tmpdir, run_cmd):
+    lst_pid = []
+    batcher = LineBatcher()
+    exit_status = executor.run(
+        Job(run_cmd, str(tmpdir)), batcher, on_start=lst_pid.append
+    )
+    return exit_status, batcher.tail_lines(), lst_pid[0]
+
+
+def test_output_exit_status_and_reuse(fake_dials, tmpdir):
+    exit_status, lst_lin, first_pid = run(fake_dials, tmpdir, ["dials.hello", "a=1"])
+    assert exit_status == 3
+    assert lst_lin == ["args a=1", "cwd " + tmpdir.basename, "no line end"]
+
+    exit_status, lst_lin, second_pid = run(fake_dials, tmpdir, ["dials.hello"])
+    assert exit_status == 3
+    assert second_pid == first_pid
+    assert fake_dials.n_recycled == 0
+
+
+def test_recycled_after_crash_and_growth(fake_dials, tmpdir):
+    exit_status, lst_lin, crashed_pid = run(fake_dials, tmpdir, ["dials.crash"])
+    assert exit_status != 0
+    assert lst_lin == ["about to crash"]
+    assert fake_dials.n_recycled == 1
+
+    _, _, first_pid = run(fake_dials, tmpdir, ["dials.hello"])
+    assert first_pid != crashed_pid
+    run(fake_dials, tmpdir, ["dials.hog"])
+    assert fake_dials.n_recycled == 2
+    _, _, new_pid = run(fake_dials, tmpdir, ["dials.hello"])
+    assert new_pid != first_pid
+
+
+def test_other_commands_run_as_processes(fake_dials, tmpdir):
+    exit_status, lst_lin, _ = run(fake_dials, tmpdir, ["echo", "plain"])
+    assert exit_status == 0
+    assert lst_lin == ["plain"]
+
+
+def test_cancel_running_command(fake_dials, tmpdir):
+    job = Job(["dials.sleeper"], str(tmpdir))
+    batcher = LineBatcher()
+
+    def cancel_when_started():
+        while "started" not in batcher.tail_lines():
+            time.sleep(0.05)
+
+        fake_dials.cancel(job)
+
+    cancel_thread = threading.Thread(target=cancel_when_started)
+    cancel_thread.start()
+    start = time.time()
+    assert fake_dials.run(job, batcher) != 0
+    cancel_thread.join()
+    assert time.time() - start < 30
+    assert fake_dials.n_recycled == 1